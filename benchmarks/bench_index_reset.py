@@ -0,0 +1,114 @@
+""" Benchmarks a full rebuild of the Whoosh full-text index with a single
+    writer, and with Whoosh's multi-process writer.
+
+    Usage: python benchmarks/bench_index_reset.py [--pages 10000 50000]
+                                                  [--procs 1 4]
+"""
+import os
+import os.path
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from wikked.wiki import WikiParameters  # NOQA
+from wikked.indexer.whooshidx import WhooshWikiIndex  # NOQA
+
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do "
+         "eiusmod tempor incididunt ut labore et dolore magna aliqua enim "
+         "minim veniam quis nostrud exercitation ullamco laboris nisi "
+         "aliquip commodo consequat duis aute irure reprehenderit voluptate "
+         "velit esse cillum fugiat nulla pariatur excepteur sint occaecat "
+         "cupidatat non proident sunt culpa officia deserunt mollit anim "
+         "id est laborum").split()
+
+
+class _BenchWiki(object):
+    def __init__(self, root):
+        self.root = root
+
+
+class _BenchPage(object):
+    def __init__(self, url, title, text, path):
+        self.url = url
+        self.title = title
+        self.raw_text = text
+        self.text = text
+        self.path = path
+
+
+def make_pages(root, count, words_per_page):
+    rnd = random.Random(42)
+    pages_dir = os.path.join(root, 'pages')
+    os.makedirs(pages_dir)
+    paths = []
+    for i in range(count):
+        path = os.path.join(pages_dir, 'Page %d.md' % i)
+        with open(path, 'w') as fp:
+            fp.write(' '.join(rnd.choice(WORDS)
+                              for _ in range(words_per_page)))
+        paths.append(path)
+    return paths
+
+
+def iter_pages(paths):
+    # Stream pages like the database does, instead of loading them all
+    # in memory first.
+    for i, path in enumerate(paths):
+        with open(path, 'r') as fp:
+            text = fp.read()
+        yield _BenchPage('/Page %d' % i, 'Page %d' % i, text, path)
+
+
+def run_reset(root, paths, procs, limitmb):
+    params = WikiParameters(root)
+    params.config.set('whoosh', 'procs', str(procs))
+    params.config.set('whoosh', 'limitmb', str(limitmb))
+    index_dir = os.path.join(root, '.wiki', 'index')
+    if os.path.isdir(index_dir):
+        shutil.rmtree(index_dir)
+
+    index = WhooshWikiIndex(params.config)
+    index.start(_BenchWiki(root))
+    before = time.perf_counter()
+    index.reset(iter_pages(paths), page_count=len(paths))
+    return time.perf_counter() - before
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks rebuilding the Whoosh index.")
+    parser.add_argument(
+        '--pages', type=int, nargs='+', default=[10000, 50000],
+        help="The numbers of synthetic pages to index")
+    parser.add_argument(
+        '--procs', type=int, nargs='+', default=[1, os.cpu_count()],
+        help="The numbers of indexing processes to compare")
+    parser.add_argument(
+        '--words', type=int, default=300,
+        help="The number of words per page")
+    parser.add_argument(
+        '--limitmb', type=int, default=128,
+        help="The memory limit of each indexing process")
+    args = parser.parse_args()
+
+    print("%10s %8s %12s %12s" % ('pages', 'procs', 'seconds', 'pages/s'))
+    for count in args.pages:
+        root = tempfile.mkdtemp(prefix='wikked_bench_')
+        try:
+            paths = make_pages(root, count, args.words)
+            for procs in args.procs:
+                duration = run_reset(root, paths, procs, args.limitmb)
+                print("%10d %8d %12.2f %12.1f" % (
+                    count, procs, duration, count / duration))
+        finally:
+            shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,7 @@ import io
 from collections import deque
 from contextlib import closing
 from configparser import SafeConfigParser
+from wikked.cache import DiskCache
 from wikked.fs import FileSystem
 from wikked.db.base import Database
 from wikked.indexer.base import WikiIndex
@@ -45,6 +46,12 @@ class MockWikiParameters(WikiParameters):
             return super(MockWikiParameters, self).scm_factory(for_init)
         return self.mock_scm or MockSourceControl()
 
+    def format_cache_factory(self):
+        if self.mock_fs is False:
+            return super(MockWikiParameters, self).format_cache_factory()
+        # Mock wikis don't have a real root to put the cache in.
+        return DiskCache(None, 0)
+
     def getFormatters(self):
         formatters = {
             passthrough_formatter: ['txt', 'html']
@@ -214,6 +221,40 @@ class MockWikiIndex(WikiIndex):
         return None
 
 
+class RecordingWikiIndex(MockWikiIndex):
+    page_fields = ['url']
+
+    def __init__(self):
+        super(RecordingWikiIndex, self).__init__()
+        self.calls = []
+
+    def updatePage(self, page):
+        self.calls.append(('update', page.url))
+
+    def flush(self):
+        self.calls.append(('flush',))
+
+
+class MockWiki(object):
+    """ A bare wiki, for testing sub-systems on their own. """
+    def __init__(self, root):
+        self.root = root
+
+
+class MockPage(object):
+    """ A bare page. Its text is written to a file in `root`, if any. """
+    def __init__(self, root, url, title=None, text=None):
+        self.url = url
+        self.title = title
+        self.raw_text = text
+        self.text = text
+        self.path = None
+        if root is not None:
+            self.path = os.path.join(root, url.lstrip('/') + '.txt')
+            with open(self.path, 'w') as fp:
+                fp.write(text)
+
+
 class MockSourceControl(SourceControl):
     def __init__(self):
         super(MockSourceControl, self).__init__()
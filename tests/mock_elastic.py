@@ -0,0 +1,175 @@
+import re
+import json
+import threading
+import urllib.parse
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+
+class MockElasticServer(object):
+    """ A tiny stand-in for an ElasticSearch node, running on a local
+        port. It only supports what `ElasticWikiIndex` needs: creating
+        and deleting an index, bulk indexing, scrolling searches, and
+        naive word matching for `query_string` queries.
+    """
+    def __init__(self):
+        self.indices = {}
+        self.requests = []
+        self._scrolls = {}
+        self._next_scroll_id = 1
+        self._server = HTTPServer(('127.0.0.1', 0), _make_handler(self))
+        self._thread = None
+
+    @property
+    def host(self):
+        return '127.0.0.1:%d' % self._server.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def resetRequests(self):
+        self.requests = []
+
+    def handle(self, method, path, params, body):
+        self.requests.append((method, path))
+        bits = [b for b in path.split('/') if b]
+
+        if bits[:2] == ['_search', 'scroll']:
+            if method == 'DELETE':
+                for sid in body.get('scroll_id', []):
+                    self._scrolls.pop(sid, None)
+                return 200, {'succeeded': True}
+            return 200, self._nextScrollPage(body['scroll_id'])
+
+        if bits == ['_bulk']:
+            return 200, self._bulk(body)
+
+        index = bits[0]
+        if len(bits) == 1:
+            if method == 'HEAD':
+                return (200 if index in self.indices else 404), None
+            if method == 'PUT':
+                self.indices[index] = {}
+                return 200, {'acknowledged': True}
+            if method == 'DELETE':
+                if self.indices.pop(index, None) is None:
+                    return 404, {'error': 'index_not_found_exception'}
+                return 200, {'acknowledged': True}
+
+        if bits[-1] == '_search':
+            return 200, self._search(index, params, body or {})
+
+        return 400, {'error': 'Unsupported request: %s %s' % (method, path)}
+
+    def _bulk(self, lines):
+        items = []
+        i = 0
+        while i < len(lines):
+            op_type, op = list(lines[i].items())[0]
+            docs = self.indices.setdefault(op['_index'], {})
+            if op_type == 'delete':
+                status = 200 if docs.pop(op['_id'], None) else 404
+                i += 1
+            else:
+                status = 200 if op['_id'] in docs else 201
+                docs[op['_id']] = lines[i + 1]
+                i += 2
+            items.append({op_type: {'_id': op['_id'], 'status': status}})
+        return {'took': 1, 'errors': False, 'items': items}
+
+    def _search(self, index, params, body):
+        docs = self.indices.get(index, {})
+        query = body.get('query', {'match_all': {}})
+        hits = []
+        for doc_id, source in sorted(docs.items()):
+            if 'query_string' in query:
+                qs = query['query_string']
+                matched = _match_fields(source, qs['fields'], qs['query'])
+                if not matched:
+                    continue
+                highlight = {f: [source[f]] for f in matched}
+            else:
+                highlight = None
+            hit = {'_id': doc_id, '_index': index, '_type': 'page',
+                   '_source': _filter_source(source, body.get('_source'))}
+            if highlight:
+                hit['highlight'] = highlight
+            hits.append(hit)
+
+        scroll = params.get('scroll')
+        if scroll is None:
+            return {'hits': {'total': len(hits), 'hits': hits}}
+
+        size = int(params.get('size', body.get('size', 10)))
+        scroll_id = 'scroll%d' % self._next_scroll_id
+        self._next_scroll_id += 1
+        self._scrolls[scroll_id] = (hits, size)
+        return self._nextScrollPage(scroll_id)
+
+    def _nextScrollPage(self, scroll_id):
+        hits, size = self._scrolls[scroll_id]
+        self._scrolls[scroll_id] = (hits[size:], size)
+        return {'_scroll_id': scroll_id,
+                '_shards': {'total': 1, 'successful': 1,
+                            'skipped': 0, 'failed': 0},
+                'hits': {'total': len(hits), 'hits': hits[:size]}}
+
+
+def _match_fields(source, fields, query):
+    words = [w.lower() for w in re.findall(r'\w+', query)]
+    matched = []
+    for f in fields:
+        value = (source.get(f) or '').lower()
+        if all(w in value for w in words):
+            matched.append(f)
+    return matched
+
+
+def _filter_source(source, includes):
+    if includes is None:
+        return dict(source)
+    return {k: v for k, v in source.items() if k in includes}
+
+
+def _make_handler(server):
+    class _Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _run(self):
+            parsed = urllib.parse.urlparse(self.path)
+            params = dict(urllib.parse.parse_qsl(parsed.query))
+            length = int(self.headers.get('Content-Length') or 0)
+            raw_body = self.rfile.read(length).decode('utf8')
+            if parsed.path.rstrip('/') == '/_bulk':
+                body = [json.loads(line) for line in raw_body.splitlines()
+                        if line]
+            elif raw_body:
+                body = json.loads(raw_body)
+            else:
+                body = None
+
+            status, res = server.handle(self.command, parsed.path,
+                                        params, body)
+            data = b''
+            if res is not None and self.command != 'HEAD':
+                data = json.dumps(res).encode('utf8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = _run
+        do_PUT = _run
+        do_POST = _run
+        do_HEAD = _run
+        do_DELETE = _run
+
+    return _Handler
@@ -15,3 +15,44 @@ class DatabaseTest(WikkedTest):
         self.assertEqual('/foo', page.url)
         self.assertEqual('/foo.txt', page.path)
         self.assertEqual('A test page.', page.raw_text)
+
+    def testUncacheDependentPages(self):
+        wiki = self._getWikiFromStructure({
+            '/foo.txt': 'A test page.',
+            '/bar.txt': 'Bar includes:\n{{include: foo}}\n',
+            '/baz.txt': 'Baz links to [[Foo]].'
+            })
+        uncached = wiki.db.uncachePages(except_url='/foo', only_required=True)
+        self.assertEqual(['/bar'], uncached)
+        self.assertFalse(wiki.getPage('/bar').is_resolved)
+        self.assertTrue(wiki.getPage('/foo').is_resolved)
+        self.assertTrue(wiki.getPage('/baz').is_resolved)
+
+        uncached = wiki.db.uncachePages(except_url='/foo')
+        self.assertEqual(['/baz'], uncached)
+        self.assertTrue(wiki.getPage('/foo').is_resolved)
+
+    def testUncachePagesIncludingEditedPages(self):
+        wiki = self._getWikiFromStructure({
+            '/foo.txt': 'A test page.',
+            '/bar.txt': 'Bar includes:\n{{include: foo}}\n',
+            '/baz.txt': 'Baz includes:\n{{include: other}}\n',
+            '/other.txt': 'Other page.',
+            '/qux.txt': '{{query: category=Stuff}}\n'
+            })
+        uncached = wiki.db.uncacheDependentPages(['/foo'])
+        self.assertEqual(['/bar', '/qux'], sorted(uncached))
+        self.assertFalse(wiki.getPage('/bar').is_resolved)
+        self.assertTrue(wiki.getPage('/baz').is_resolved)
+        self.assertTrue(wiki.getPage('/foo').is_resolved)
+
+    def testUncacheManyDependentPages(self):
+        structure = {'/foo.txt': 'A test page.'}
+        for i in range(5):
+            structure['/inc%d.txt' % i] = '{{include: foo}}\n'
+        wiki = self._getWikiFromStructure(structure)
+        wiki.db.QUERY_CHUNK_SIZE = 2
+        uncached = wiki.db.uncacheDependentPages(['/foo'])
+        self.assertEqual(['/inc%d' % i for i in range(5)], sorted(uncached))
+        for i in range(5):
+            self.assertFalse(wiki.getPage('/inc%d' % i).is_resolved)
@@ -0,0 +1,101 @@
+import os
+import os.path
+import unittest
+from tests import WikkedTest
+from .mock import MockWikiParameters, MockWiki, MockPage
+
+try:
+    from wikked.indexer.elastic import ElasticWikiIndex, get_doc_id
+    from .mock_elastic import MockElasticServer
+    SUPPORTS_ELASTIC = True
+except ImportError:
+    SUPPORTS_ELASTIC = False
+
+
+@unittest.skipIf(not SUPPORTS_ELASTIC, "ElasticSearch is not available.")
+class ElasticIndexTest(WikkedTest):
+    def setUp(self):
+        super(ElasticIndexTest, self).setUp()
+        os.makedirs(self.test_data_dir, exist_ok=True)
+        self.server = MockElasticServer()
+        self.server.start()
+
+        config = MockWikiParameters(self.test_data_dir).config
+        config.set('elastic', 'hosts', self.server.host)
+        self.index = ElasticWikiIndex(config)
+        self.index.start(MockWiki(self.test_data_dir))
+
+    def tearDown(self):
+        self.server.stop()
+        super(ElasticIndexTest, self).tearDown()
+
+    def _page(self, url, title, text):
+        return MockPage(self.test_data_dir, url, title, text)
+
+    def _indexedUrls(self):
+        docs = self.server.indices['pages']
+        return sorted([d['url'] for d in docs.values()])
+
+    def testReset(self):
+        self.index.reset([self._page('/foo', 'Foo', 'Some cheese.'),
+                          self._page('/bar', 'Bar', 'Some wine.')])
+        self.assertEqual(['/bar', '/foo'], self._indexedUrls())
+        self.assertIn(get_doc_id('/foo'), self.server.indices['pages'])
+        hits = list(self.index.search('cheese'))
+        self.assertEqual(['/foo'], [h.url for h in hits])
+
+    def testUpdatePageIsOneRequest(self):
+        self.index.reset([self._page('/foo', 'Foo', 'Some cheese.')])
+        self.server.resetRequests()
+
+        self.index.updatePage(self._page('/foo', 'Foo', 'Some ham.'))
+        self.index.updatePage(self._page('/foo', 'Foo', 'Some wine.'))
+        self.assertEqual([('POST', '/_bulk'), ('POST', '/_bulk')],
+                         self.server.requests)
+        self.assertEqual(['/foo'], self._indexedUrls())
+        self.assertEqual(['/foo'],
+                         [h.url for h in self.index.search('wine')])
+        self.assertEqual([], list(self.index.search('cheese')))
+
+    def testUpdateAll(self):
+        foo = self._page('/foo', 'Foo', 'Some cheese.')
+        bar = self._page('/bar', 'Bar', 'Some wine.')
+        self.index.reset([foo, bar])
+
+        os.utime(foo.path, (0, 0))
+        foo.text = 'Some ham.'
+        baz = self._page('/baz', 'Baz', 'Some bread.')
+        os.utime(bar.path, None)
+        os.utime(bar.path, (os.path.getatime(bar.path),
+                            os.path.getmtime(bar.path) + 10))
+        bar.text = 'Some beer.'
+        self.server.resetRequests()
+
+        self.index.updateAll([foo, bar, baz])
+        self.assertEqual(['/bar', '/baz', '/foo'], self._indexedUrls())
+        # The old time for `foo` means it didn't get re-indexed.
+        self.assertEqual(['/foo'],
+                         [h.url for h in self.index.search('cheese')])
+        self.assertEqual(['/bar'],
+                         [h.url for h in self.index.search('beer')])
+        self.assertEqual(['/baz'],
+                         [h.url for h in self.index.search('bread')])
+
+        # Deleted pages are removed.
+        self.index.updateAll([foo, baz])
+        self.assertEqual(['/baz', '/foo'], self._indexedUrls())
+
+    def testUpdateAllUsesOneScroll(self):
+        pages = [self._page('/page%d' % i, 'Page %d' % i, 'Text.')
+                 for i in range(25)]
+        self.index.reset(pages)
+        self.server.resetRequests()
+
+        self.index.updateAll(pages[5:])
+        self.assertEqual(20, len(self._indexedUrls()))
+        paths = [r[1] for r in self.server.requests]
+        self.assertEqual(1, paths.count('/pages/page/_search'))
+        self.assertEqual(1, paths.count('/_bulk'))
+        self.assertEqual(
+            set(['/pages/page/_search', '/_search/scroll', '/_bulk']),
+            set(paths))
@@ -0,0 +1,89 @@
+import os
+import os.path
+import unittest
+from tests import WikkedTest
+from tests.mock import MockWiki
+from wikked.fs import FileSystem
+from wikked.scm.base import ACTION_ADD, ACTION_EDIT, STATE_COMMITTED
+from wikked.scm.git import SUPPORTS_GIT
+
+if SUPPORTS_GIT:
+    from wikked.scm.git import GitLibSourceControl
+
+
+@unittest.skipIf(not SUPPORTS_GIT, "pygit2 is not available.")
+class GitSourceControlTest(WikkedTest):
+    def _getScm(self):
+        root = os.path.join(self.test_data_dir, 'repo')
+        os.makedirs(root)
+        wiki = MockWiki(root)
+        wiki.formatters = {None: ['txt']}
+        wiki.getSpecialFilenames = lambda: ['.wiki']
+        wiki.fs = FileSystem(root, self._getParameters(root).config)
+        wiki.fs.include_builtin_endpoints = False
+        wiki.scm = GitLibSourceControl(root)
+        wiki.fs.start(wiki)
+        wiki.scm.init(wiki)
+        return wiki.scm
+
+    def _setPage(self, scm, name, text, message):
+        path = os.path.join(scm.root, name)
+        with open(path, 'w') as fp:
+            fp.write(text)
+        scm.commit([path], {'author': 'Joe <joe@example.org>',
+                            'message': message})
+        return path
+
+    def testHistory(self):
+        scm = self._getScm()
+        foo = self._setPage(scm, 'foo.txt', "Foo", "Add foo")
+        self._setPage(scm, 'bar.txt', "Bar", "Add bar")
+        self._setPage(scm, 'foo.txt', "Foo 2", "Edit foo")
+        self.assertEqual(STATE_COMMITTED, scm.getState(foo))
+
+        history = scm.getHistory()
+        self.assertEqual(
+                ["Edit foo", "Add bar", "Add foo", "Created `.gitignore`."],
+                [r.description for r in history])
+        self.assertEqual('Joe', history[0].author.name)
+        self.assertEqual('joe@example.org', history[0].author.email)
+        self.assertEqual([('foo.txt', ACTION_EDIT, '/foo')],
+                         [(f.path, f.action, f.url)
+                          for f in history[0].files])
+        self.assertEqual([('bar.txt', ACTION_ADD, '/bar')],
+                         [(f.path, f.action, f.url)
+                          for f in history[1].files])
+
+        history = scm.getHistory(limit=2, after_rev=history[0].rev_id)
+        self.assertEqual(["Add bar", "Add foo"],
+                         [r.description for r in history])
+
+        history = scm.getHistory(foo)
+        self.assertEqual(["Edit foo", "Add foo"],
+                         [r.description for r in history])
+
+    def testRevisionAndDiff(self):
+        scm = self._getScm()
+        foo = self._setPage(scm, 'foo.txt', "Foo\n", "Add foo")
+        self._setPage(scm, 'bar.txt', "Bar\n", "Add bar")
+        self._setPage(scm, 'foo.txt', "Foo 2\n", "Edit foo")
+        rev3, rev2, rev1 = [r.rev_id for r in scm.getHistory(limit=3)]
+
+        self.assertEqual("Foo\n", scm.getRevision(foo, rev1))
+        self.assertEqual("Foo 2\n", scm.getRevision(foo, rev3))
+
+        diff = scm.diff(foo, rev1, rev3)
+        self.assertIn("-Foo\n+Foo 2\n", diff)
+        self.assertEqual(diff, scm.diff(foo, rev3, None))
+        self.assertEqual('', scm.diff(foo, rev2, None))
+        self.assertIn("+Bar\n", scm.diff(None, rev2, None))
+
+    def testRevert(self):
+        scm = self._getScm()
+        foo = self._setPage(scm, 'foo.txt', "Foo", "Add foo")
+        with open(foo, 'w') as fp:
+            fp.write("Changed")
+        self.assertNotEqual(STATE_COMMITTED, scm.getState(foo))
+        scm.revert([foo])
+        with open(foo, 'r') as fp:
+            self.assertEqual("Foo", fp.read())
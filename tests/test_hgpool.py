@@ -0,0 +1,93 @@
+import threading
+from tests import WikkedTest
+from hglib.error import ServerError
+from wikked.scm.mercurial import HgClientPool
+
+
+class _FakeStdin(object):
+    closed = False
+
+
+class _FakeServer(object):
+    def __init__(self):
+        self.stdin = _FakeStdin()
+        self.returncode = None
+
+    def poll(self):
+        return self.returncode
+
+
+class _FakeClient(object):
+    def __init__(self, num):
+        self.num = num
+        self.server = _FakeServer()
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+        self.server = None
+
+
+class _FakePool(HgClientPool):
+    def __init__(self, size):
+        super(_FakePool, self).__init__('/fake/root', size)
+        self.created = []
+
+    def _createClient(self):
+        client = _FakeClient(len(self.created))
+        self.created.append(client)
+        return client
+
+
+class HgClientPoolTest(WikkedTest):
+    def testReuseClients(self):
+        pool = _FakePool(2)
+        self.assertEqual(0, pool.run(lambda c: c.num))
+        self.assertEqual(0, pool.run(lambda c: c.num))
+        self.assertEqual(1, len(pool.created))
+
+    def testConcurrentCheckouts(self):
+        pool = _FakePool(2)
+        with pool.checkout() as c1:
+            with pool.checkout() as c2:
+                self.assertNotEqual(c1, c2)
+                got = []
+                t = threading.Thread(
+                        target=lambda: got.append(pool.run(lambda c: c)))
+                t.start()
+                t.join(0.1)
+                # The pool is full, so the thread is waiting.
+                self.assertEqual([], got)
+        t.join()
+        self.assertIn(got[0], [c1, c2])
+        self.assertEqual(2, len(pool.created))
+
+    def testDeadClientIsReplaced(self):
+        pool = _FakePool(1)
+        pool.run(lambda c: c)
+        pool.created[0].server.returncode = 1
+        self.assertEqual(1, pool.run(lambda c: c.num))
+        self.assertTrue(pool.created[0].closed)
+
+    def testBrokenClientIsRetried(self):
+        pool = _FakePool(1)
+
+        def _run(c):
+            if c.num == 0:
+                raise ServerError()
+            return c.num
+
+        self.assertEqual(1, pool.run(_run))
+        self.assertTrue(pool.created[0].closed)
+
+        pool = _FakePool(1)
+        self.assertRaises(ServerError, pool.run, _run, retry=False)
+        self.assertEqual(0, pool._count)
+
+    def testClose(self):
+        pool = _FakePool(2)
+        with pool.checkout():
+            pool.run(lambda c: c)
+        pool.close()
+        self.assertTrue(all([c.closed for c in pool.created]))
+        self.assertEqual(0, pool._count)
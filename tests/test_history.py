@@ -0,0 +1,79 @@
+import os.path
+from tests import WikkedTest
+from wikked.scm.base import (
+        Author, Revision, ACTION_ADD, ACTION_EDIT, ACTION_DELETE)
+from wikked.scm.history import RevisionStore
+
+
+def _make_rev(rev_id, author, timestamp, files):
+    rev = Revision(rev_id)
+    rev.rev_name = rev_id[:4]
+    rev.author = Author(author)
+    rev.timestamp = timestamp
+    rev.description = 'Revision %s' % rev_id
+    for path, action, url in files:
+        rev.addFile(path, action, url)
+    return rev
+
+
+class RevisionStoreTest(WikkedTest):
+    def _getStore(self):
+        return RevisionStore(os.path.join(self.test_data_dir, 'history.db'))
+
+    def _fillStore(self, store):
+        store.addRevisions([
+            (0, _make_rev('aaaa0000', 'Joe <joe@example.org>', 10, [
+                ('foo.md', ACTION_ADD, '/Foo'),
+                ('.hgignore', ACTION_ADD, None)])),
+            (1, _make_rev('bbbb1111', 'Ann', 20, [
+                ('bar.md', ACTION_ADD, '/Bar')])),
+            (2, _make_rev('cccc2222', 'Joe <joe@example.org>', 30, [
+                ('foo.md', ACTION_EDIT, '/Foo'),
+                ('bar.md', ACTION_DELETE, '/Bar')]))])
+
+    def testEmptyStore(self):
+        store = self._getStore()
+        self.assertEqual((-1, None), store.getTip())
+        self.assertEqual([], store.getHistory())
+
+    def testSiteHistory(self):
+        store = self._getStore()
+        self._fillStore(store)
+        self.assertEqual((2, 'cccc2222'), store.getTip())
+
+        history = store.getHistory()
+        self.assertEqual(['cccc2222', 'bbbb1111', 'aaaa0000'],
+                         [r.rev_id for r in history])
+        rev = history[0]
+        self.assertEqual('cccc', rev.rev_name)
+        self.assertEqual('Joe', rev.author.name)
+        self.assertEqual('joe@example.org', rev.author.email)
+        self.assertEqual(30, rev.timestamp)
+        self.assertEqual([('foo.md', ACTION_EDIT, '/Foo'),
+                          ('bar.md', ACTION_DELETE, '/Bar')],
+                         [(f.path, f.action, f.url) for f in rev.files])
+        self.assertEqual(['/Foo', None], [f.url for f in history[2].files])
+
+        history = store.getHistory(limit=2, after_rev='cccc')
+        self.assertEqual(['bbbb1111', 'aaaa0000'],
+                         [r.rev_id for r in history])
+
+    def testPageHistory(self):
+        store = self._getStore()
+        self._fillStore(store)
+        history = store.getHistory('foo.md')
+        self.assertEqual(['cccc2222', 'aaaa0000'],
+                         [r.rev_id for r in history])
+        self.assertEqual([], store.getHistory('missing.md'))
+
+    def testAddRevisionsIsIdempotent(self):
+        store = self._getStore()
+        self._fillStore(store)
+        self._fillStore(store)
+        self.assertEqual(3, len(store.getHistory(limit=None)))
+        self.assertEqual(2, len(store.getHistory()[0].files))
+
+        store.addRevisions([(0, _make_rev('dddd3333', 'Bob', 40, []))],
+                           clear=True)
+        self.assertEqual(['dddd3333'],
+                         [r.rev_id for r in store.getHistory()])
@@ -0,0 +1,93 @@
+import os.path
+import datetime
+import unittest
+from tests import WikkedTest
+from wikked.db.pagecache import PageDataCache
+from wikked.db.sharedcache import SharedPageCache, SUPPORTS_SHARED_CACHE
+from wikked.page import PageData
+
+
+def _make_data(url, text=''):
+    data = PageData()
+    data.url = url
+    data.text = text
+    return data
+
+
+class PageDataCacheTest(WikkedTest):
+    def testGenerations(self):
+        cache = PageDataCache(10, 1024 * 1024)
+        cache.put(('/foo', None), 1, _make_data('/foo', "Foo"))
+        self.assertEqual("Foo", cache.get(('/foo', None), 1).text)
+        self.assertIsNone(cache.get(('/foo', None), 2))
+        self.assertIsNone(cache.get(('/bar', None), 1))
+        self.assertEqual(1, cache.hits)
+        self.assertEqual(2, cache.misses)
+
+    def testReturnsCopies(self):
+        cache = PageDataCache(10, 1024 * 1024)
+        cache.put(('/foo', None), 1, _make_data('/foo', "Foo"))
+        cache.get(('/foo', None), 1).text = "Changed"
+        self.assertEqual("Foo", cache.get(('/foo', None), 1).text)
+
+    def testMaxEntries(self):
+        cache = PageDataCache(2, 1024 * 1024)
+        cache.put('/foo', 1, _make_data('/foo'))
+        cache.put('/bar', 1, _make_data('/bar'))
+        cache.get('/foo', 1)
+        cache.put('/baz', 1, _make_data('/baz'))
+        self.assertIsNotNone(cache.get('/foo', 1))
+        self.assertIsNone(cache.get('/bar', 1))
+        self.assertIsNotNone(cache.get('/baz', 1))
+
+    def testMaxBytes(self):
+        cache = PageDataCache(10, 2000)
+        cache.put('/foo', 1, _make_data('/foo', 'x' * 1000))
+        cache.put('/bar', 1, _make_data('/bar', 'x' * 1000))
+        cache.put('/big', 1, _make_data('/big', 'x' * 5000))
+        self.assertIsNone(cache.get('/foo', 1))
+        self.assertIsNotNone(cache.get('/bar', 1))
+        self.assertIsNone(cache.get('/big', 1))
+
+
+@unittest.skipIf(not SUPPORTS_SHARED_CACHE,
+                 "The shared page cache isn't supported here.")
+class SharedPageCacheTest(WikkedTest):
+    def _getCache(self, size=1024 * 1024):
+        return SharedPageCache(
+                os.path.join(self.test_data_dir, 'pagecache.bin'), size,
+                slot_size=4096)
+
+    def tearDown(self):
+        for c in getattr(self, 'caches', []):
+            c.close()
+        super(SharedPageCacheTest, self).tearDown()
+
+    def testRoundtrip(self):
+        cache = self._getCache()
+        self.caches = [cache]
+        data = _make_data('/foo', "Foo")
+        data.cache_time = datetime.datetime(2020, 1, 2, 3, 4, 5, 6)
+        data.ext_meta = {'category': ['Bar', 'Baz'], 'hidden': [True]}
+        key = ('/foo', frozenset(['url', 'text', 'meta']))
+        cache.put(key, 3, data)
+
+        cached = cache.get(key, 3)
+        self.assertEqual("Foo", cached.text)
+        self.assertEqual(data.cache_time, cached.cache_time)
+        self.assertEqual(data.ext_meta, cached.ext_meta)
+        self.assertIsNone(cache.get(key, 4))
+        self.assertIsNone(cache.get(('/foo', None), 3))
+
+    def testSharedBetweenInstances(self):
+        cache1 = self._getCache()
+        cache2 = self._getCache()
+        self.caches = [cache1, cache2]
+        cache1.put(('/foo', None), 1, _make_data('/foo', "Foo"))
+        self.assertEqual("Foo", cache2.get(('/foo', None), 1).text)
+
+    def testEntryTooBig(self):
+        cache = self._getCache()
+        self.caches = [cache]
+        cache.put(('/foo', None), 1, _make_data('/foo', 'x' * 5000))
+        self.assertIsNone(cache.get(('/foo', None), 1))
@@ -1,5 +1,7 @@
 # flake8: noqa
 from tests import WikkedTest, format_link, format_include
+from wikked.resolver import PageResolver
+from wikked.scheduler import ResolveScheduler
 
 
 class ResolverTest(WikkedTest):
@@ -32,6 +34,19 @@ class ResolverTest(WikkedTest):
         self.assertEqual(['/Somewhere'], foo.links)
         self.assertEqual({'bar': ['42'], 'given': ['hope'], 'include': ['trans-desc']}, foo.getMeta())
 
+    def testLocalOnlyResolve(self):
+        wiki = self._getWikiFromStructure({
+            'foo.txt': "A test page about [[Bar]].\n{{include: trans-desc}}\n",
+            'bar.txt': "Bar.",
+            'trans-desc.txt': "BLAH\n"
+            })
+        foo = wiki.getPage('/foo')
+        output = PageResolver(foo, local_only=True).run()
+        self.assertEqual(
+                "A test page about %s.\n" % format_link('Bar', '/bar'),
+                output.text)
+        self.assertEqual(['/bar'], output.out_links)
+
     def testPageIncludeWithNamedTemplating(self):
         wiki = self._getWikiFromStructure({
             'foo.txt': "A test page.\n{{include: greeting|name=Dave|what=drink}}\n",
@@ -109,7 +124,7 @@ class ResolverTest(WikkedTest):
         tpl1 = wiki.getPage('/Template 1')
         self.assertEqual({
             'foo': ['bar'],
-            '+category': ['blah', 'yolo'],
+            '+category': ['blah'],
             '+include': ['Template 2'],
             '__secret1': ['ssh']
             }, tpl1.getMeta())
@@ -291,3 +306,70 @@ class ResolverTest(WikkedTest):
 
         source = wiki.getPage('blah:/Folder/Source')
         self.assertEqual(format_link('Other', '/Folder/Other'), source.text)
+
+    def testIncludeMemo(self):
+        wiki = self._getWikiFromStructure({
+            'A.txt': "{{include: Box}}\n{{include: Nav}}\n{{category: stuff}}\n",
+            'B.txt': "{{include: Box}}\n{{include: Nav}}\n{{category: stuff}}\n",
+            'Box.txt': "BOX",
+            'Nav.txt': "{{query: category=stuff}}\n"
+            })
+        s = ResolveScheduler(wiki, ['/A', '/B'])
+        s.run()
+        # Both pages get the same box, but the navigation query needs to
+        # exclude the page that includes it.
+        self.assertEqual(1, s.memo.hits)
+        self.assertEqual(
+                "BOX\n\n\n* %s\n\n\n" % format_link('B', '/B'),
+                wiki.getPage('/A').text)
+        self.assertEqual(
+                "BOX\n\n\n* %s\n\n\n" % format_link('A', '/A'),
+                wiki.getPage('/B').text)
+
+    def testQueryMemo(self):
+        wiki = self._getWikiFromStructure({
+            'A.txt': "{{include: Nav}}\n{{category: stuff}}\n",
+            'B.txt': "{{include: Nav}}\n{{category: stuff}}\n",
+            'C.txt': "{{include: Nav}}\n",
+            'D.txt': "{{include: Nav}}\n",
+            'Nav.txt': "{{query: category=stuff}}\n"
+            })
+        s = ResolveScheduler(wiki, ['/A', '/B', '/C', '/D'])
+        s.run()
+        self.assertEqual(1, s.memo.query_misses)
+        self.assertEqual(2, s.memo.query_hits)
+        # Pages that aren't listed by the query can share the same output.
+        self.assertEqual(1, s.memo.hits)
+        self.assertEqual(
+                "\n* %s\n\n\n" % format_link('B', '/B'),
+                wiki.getPage('/A').text)
+        self.assertEqual(
+                "\n* %s\n* %s\n\n" % (format_link('A', '/A'),
+                                      format_link('B', '/B')),
+                wiki.getPage('/D').text)
+
+    def testResolveOrder(self):
+        wiki = self._getWikiFromStructure({
+            'A.txt': "{{include: B}}\n",
+            'B.txt': "{{include: /C}}\n",
+            'C.txt': "C",
+            'X.txt': "{{include: Y}}\n",
+            'Y.txt': "{{include: X}}\n",
+            'Z.txt': "{{include: X}}\n"
+            })
+        s = ResolveScheduler(wiki, ['/A', '/B', '/C', '/X', '/Y', '/Z'])
+        # Only the pages to resolve should be loaded.
+        s.getPagesMeta = None
+        self.assertEqual(['/C', '/B', '/A', '/X', '/Y', '/Z'],
+                         s.getResolveOrder())
+        self.assertEqual(['/X', '/Y', '/Z'], s.circular_urls)
+
+    def testPartialResolveOrder(self):
+        wiki = self._getWikiFromStructure({
+            'A.txt': "{{include: B}}\n",
+            'B.txt': "{{include: C}}\n",
+            'C.txt': "C"
+            })
+        s = ResolveScheduler(wiki, ['/A', '/B'])
+        s.getPagesMeta = None
+        self.assertEqual(['/B', '/A'], s.getResolveOrder())
@@ -0,0 +1,58 @@
+import os
+import os.path
+from tests import WikkedTest
+from wikked.scm.cache import RevisionCache, is_immutable_rev
+
+
+class RevisionCacheTest(WikkedTest):
+    def _getCache(self, max_size=1024 * 1024):
+        return RevisionCache(os.path.join(self.test_data_dir, 'revs'),
+                             max_size)
+
+    def testImmutableRevs(self):
+        self.assertTrue(is_immutable_rev('a' * 40))
+        self.assertTrue(is_immutable_rev('0123456789' * 6 + 'abcd'))
+        self.assertFalse(is_immutable_rev(None))
+        self.assertFalse(is_immutable_rev('tip'))
+        self.assertFalse(is_immutable_rev('12'))
+        self.assertFalse(is_immutable_rev('a' * 12))
+
+    def testGetSet(self):
+        cache = self._getCache()
+        self.assertIsNone(cache.get(('rev', 'abc', 'foo.md')))
+        cache.set(('rev', 'abc', 'foo.md'), 'Some text')
+        self.assertEqual('Some text', cache.get(('rev', 'abc', 'foo.md')))
+        self.assertIsNone(cache.get(('rev', 'abc', 'bar.md')))
+
+        cache = self._getCache()
+        self.assertEqual('Some text', cache.get(('rev', 'abc', 'foo.md')))
+
+    def testGetOrCreate(self):
+        calls = []
+
+        def _create():
+            calls.append(1)
+            return 'Diff'
+
+        cache = self._getCache()
+        self.assertEqual('Diff', cache.getOrCreate(('diff', 'a'), _create))
+        self.assertEqual('Diff', cache.getOrCreate(('diff', 'a'), _create))
+        self.assertEqual(1, len(calls))
+
+    def testDisabled(self):
+        cache = self._getCache(0)
+        cache.set(('rev', 'abc', 'foo.md'), 'Some text')
+        self.assertIsNone(cache.get(('rev', 'abc', 'foo.md')))
+        self.assertFalse(os.path.isdir(cache.cache_dir))
+
+    def testEviction(self):
+        cache = self._getCache(1000)
+        for i in range(5):
+            key = ('rev', str(i), 'foo.md')
+            cache.set(key, str(i) * 300)
+            # Make sure modification times are ordered.
+            path = cache._getCachePath(key)
+            os.utime(path, (i, i))
+        self.assertIsNone(cache.get(('rev', '0', 'foo.md')))
+        self.assertIsNone(cache.get(('rev', '1', 'foo.md')))
+        self.assertEqual('4' * 300, cache.get(('rev', '4', 'foo.md')))
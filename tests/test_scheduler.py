@@ -0,0 +1,87 @@
+from tests import WikkedTest
+from wikked.resolver import IncludeError
+from wikked.scheduler import ResolveScheduler
+
+
+class ResolveSchedulerTest(WikkedTest):
+    def _getScheduler(self, wiki, **kwargs):
+        urls = ['/A', '/B', '/C', '/D']
+        s = ResolveScheduler(wiki, urls, **kwargs)
+        # Load the pages from the main thread, since workers can't use
+        # the in-memory database.
+        for url in urls:
+            s.getPage(url)
+        s.getPagesMeta()
+        return s
+
+    def _getUnresolvedWiki(self):
+        wiki = self._getWikiFromStructure({
+            'A.txt': "A", 'B.txt': "B", 'C.txt': "C", 'D.txt': "D"})
+        wiki.db.uncachePages()
+        return wiki
+
+    def testProgressAndPriority(self):
+        wiki = self._getUnresolvedWiki()
+        progress = []
+        s = self._getScheduler(
+                wiki, priority_urls=['/C'],
+                progress_callback=lambda d, t: progress.append((d, t)))
+        resolved = []
+        orig_resolve = s.resolvePage
+        s.resolvePage = lambda url: resolved.append(url) or orig_resolve(url)
+        s.run()
+        self.assertEqual(['/C', '/A', '/B', '/D'], resolved)
+        self.assertEqual([(1, 4), (2, 4), (3, 4), (4, 4)], progress)
+        self.assertTrue(wiki.getPage('/D').is_resolved)
+
+    def testCancel(self):
+        wiki = self._getUnresolvedWiki()
+        s = self._getScheduler(wiki)
+        s.progress_callback = lambda d, t: s.cancel()
+        s.run()
+        self.assertTrue(s.is_cancelled)
+        self.assertTrue(wiki.getPage('/A').is_resolved)
+        self.assertFalse(wiki.getPage('/B').is_resolved)
+
+    def testRetries(self):
+        wiki = self._getUnresolvedWiki()
+        s = self._getScheduler(wiki, max_retries=1)
+        attempts = []
+        orig_resolve = s.resolvePage
+
+        def resolve_page(url, raise_on_failure=True):
+            attempts.append(url)
+            if url == '/A' or (url == '/B' and attempts.count(url) == 1):
+                raise Exception("Oops")
+            return orig_resolve(url, raise_on_failure)
+
+        s.resolvePage = resolve_page
+        s.run(num_workers=2)
+        self.assertEqual(2, attempts.count('/A'))
+        self.assertEqual(2, attempts.count('/B'))
+        self.assertEqual(['/A'], s.failed_urls)
+        self.assertFalse(wiki.getPage('/A').is_resolved)
+        for url in ['/B', '/C', '/D']:
+            self.assertTrue(wiki.getPage(url).is_resolved)
+
+    def testFailedPageDoesNotStopResolve(self):
+        wiki = self._getUnresolvedWiki()
+        s = self._getScheduler(wiki)
+        attempts = []
+        orig_resolve = s.resolvePage
+
+        def resolve_page(url, raise_on_failure=True):
+            attempts.append(url)
+            if url == '/A':
+                raise Exception("Oops")
+            if url == '/B':
+                raise IncludeError('/Foo', url, "Page not found")
+            return orig_resolve(url, raise_on_failure)
+
+        s.resolvePage = resolve_page
+        s.run()
+        # Include errors aren't retried.
+        self.assertEqual(
+                ['/A', '/A', '/A', '/B', '/C', '/D'], attempts)
+        self.assertEqual(['/A', '/B'], s.failed_urls)
+        self.assertTrue(wiki.getPage('/D').is_resolved)
@@ -0,0 +1,77 @@
+# flake8: noqa
+from tests import WikkedTest
+from wikked.indexer.sqlfts import SQLFtsWikiIndex, get_fts_query
+
+
+class SQLFtsIndexTest(WikkedTest):
+    def _getParameters(self, root=None):
+        params = super(SQLFtsIndexTest, self)._getParameters(root)
+        params.mock_index = SQLFtsWikiIndex()
+        return params
+
+    def testFtsQuery(self):
+        self.assertEqual('"foo" "bar"', get_fts_query('foo "bar'))
+        self.assertEqual('title: ("fo"*)',
+                         get_fts_query('fo', prefix=True, column='title'))
+        self.assertIsNone(get_fts_query('"-'))
+
+    def testSearchResolvedText(self):
+        wiki = self._getWikiFromStructure({
+            '/foo.txt': "Some stuff.\n{{include: cheese}}\n",
+            '/cheese.txt': "Some <em>cheese</em> and wine.",
+            '/bar.txt': "Only wine here."
+            })
+        hits = wiki.index.search('cheese')
+        self.assertEqual(['/cheese', '/foo'], sorted([h.url for h in hits]))
+        hits = wiki.index.search('wine', highlight=False)
+        self.assertEqual(['/bar', '/cheese', '/foo'],
+                         sorted([h.url for h in hits]))
+        bar = [h for h in hits if h.url == '/bar'][0]
+        self.assertEqual('Only wine here.', bar.hl_text)
+
+    def testPreviewSearch(self):
+        wiki = self._getWikiFromStructure({
+            '/Cheese Platter.txt': "Some cheese.",
+            '/Wine.txt': "Some wine."
+            })
+        hits = wiki.index.previewSearch('chee')
+        self.assertEqual(['/Cheese Platter'], [h.url for h in hits])
+        self.assertEqual('<b>Cheese</b> Platter', hits[0].title)
+
+    def testIndexedOnCache(self):
+        wiki = self._getWikiFromStructure({
+            '/foo.txt': "{{include: cheese}}",
+            '/cheese.txt': "Some cheese."
+            })
+        wiki.db.uncachePages()
+        wiki.db.session.execute('DELETE FROM pages_fts')
+        wiki.db.session.commit()
+        self.assertEqual([], wiki.index.search('cheese'))
+        wiki.resolve(only_urls=['/foo'])
+        self.assertEqual(['/foo'],
+                         [h.url for h in wiki.index.search('cheese')])
+
+    def testResetIndexesPagesOnce(self):
+        wiki = self._getWikiFromStructure({
+            '/foo.txt': "{{include: cheese}}",
+            '/cheese.txt': "Some cheese."
+            })
+        indexed = []
+        orig_index_page = wiki.index._indexPage
+        wiki.index._indexPage = lambda s, p: (
+            indexed.append(p.url) or orig_index_page(s, p))
+        wiki.reset()
+        self.assertEqual(['/cheese', '/foo'], sorted(indexed))
+        self.assertEqual(['/cheese', '/foo'],
+                         sorted([h.url for h in wiki.index.search('cheese')]))
+
+    def testUpdateAll(self):
+        wiki = self._getWikiFromStructure({
+            '/foo.txt': "Some cheese.",
+            '/bar.txt': "Some wine."
+            })
+        pages = list(wiki.getPages(fields=wiki.index.page_fields))
+        wiki.index.updateAll([p for p in pages if p.url == '/foo'])
+        self.assertEqual([], wiki.index.search('wine'))
+        self.assertEqual(['/foo'],
+                         [h.url for h in wiki.index.search('cheese')])
@@ -0,0 +1,130 @@
+import os
+import os.path
+import datetime
+from whoosh.index import LockError
+from wikked.indexer.whooshidx import WhooshWikiIndex
+from tests import WikkedTest
+from .mock import MockWikiParameters, MockWiki, MockPage
+
+
+class WhooshIndexTest(WikkedTest):
+    def _getIndex(self, **options):
+        os.makedirs(self.test_data_dir, exist_ok=True)
+        config = MockWikiParameters(self.test_data_dir).config
+        for name, value in options.items():
+            config.set('whoosh', name, str(value))
+        index = WhooshWikiIndex(config)
+        index.start(MockWiki(self.test_data_dir))
+        return index
+
+    def _page(self, url, title, text):
+        return MockPage(self.test_data_dir, url, title, text)
+
+    def _searchUrls(self, index, query):
+        return sorted([h.url for h in index.search(query)])
+
+    def testSearch(self):
+        index = self._getIndex()
+        index.reset([self._page('/foo', 'Foo', 'Something about cheese.'),
+                     self._page('/bar', 'Bar', 'Nothing to see here.')])
+        self.assertEqual(['/foo'], self._searchUrls(index, 'cheese'))
+        self.assertEqual(['/bar'],
+                         [h.url for h in index.previewSearch('Ba')])
+
+    def testBufferedUpdates(self):
+        index = self._getIndex(commit_delay=60, commit_limit=3)
+        index.reset([self._page('/foo', 'Foo', 'Something about cheese.')])
+
+        index.updatePage(self._page('/bar', 'Bar', 'More cheese.'))
+        self.assertEqual(['/foo'], self._searchUrls(index, 'cheese'))
+
+        index.updatePage(self._page('/foo', 'Foo', 'No more dairy.'))
+        index.flush()
+        self.assertEqual(['/bar'], self._searchUrls(index, 'cheese'))
+
+    def testFailedFlushKeepsUpdates(self):
+        index = self._getIndex(commit_delay=60, commit_limit=10)
+        index.reset([])
+        index.updatePage(self._page('/foo', 'Foo', 'Cheese.'))
+
+        def failing_writer(*args, **kwargs):
+            raise LockError()
+
+        state = index._state
+        state.writer = failing_writer
+        self.assertRaises(LockError, index.flush)
+        # Failing from the timer thread doesn't raise, and tries again
+        # later.
+        state._onTimer()
+        self.assertIsNotNone(state._timer)
+
+        del state.writer
+        index.flush()
+        self.assertIsNone(state._timer)
+        self.assertEqual(['/foo'], self._searchUrls(index, 'cheese'))
+
+    def testCommitLimit(self):
+        index = self._getIndex(commit_delay=60, commit_limit=2)
+        index.reset([])
+        index.updatePage(self._page('/foo', 'Foo', 'Cheese.'))
+        self.assertEqual([], self._searchUrls(index, 'cheese'))
+        index.updatePage(self._page('/bar', 'Bar', 'Cheese.'))
+        self.assertEqual(['/bar', '/foo'], self._searchUrls(index, 'cheese'))
+
+    def testSmallResetDoesntUseProcesses(self):
+        index = self._getIndex(procs=4)
+        procs = []
+        orig_writer = index._state.writer
+        index._state.writer = lambda p, *args: (
+            procs.append(p) or orig_writer(p, *args))
+        index.reset([self._page('/foo', 'Foo', 'Cheese.'),
+                     self._page('/bar', 'Bar', 'Cheese.')])
+        self.assertEqual([1], procs)
+        self.assertEqual(['/bar', '/foo'], self._searchUrls(index, 'cheese'))
+
+        # Streamed pages aren't counted, that's up to the caller.
+        pages = iter([self._page('/foo', 'Foo', 'Cheese.')])
+        index.reset(pages, page_count=1)
+        self.assertEqual([1, 1], procs)
+        self.assertEqual(['/foo'], self._searchUrls(index, 'cheese'))
+
+    def testSearcherIsReused(self):
+        index = self._getIndex(commit_delay=0)
+        index.reset([self._page('/foo', 'Foo', 'Cheese.')])
+        searcher = index._state.searcher()
+        self.assertIs(searcher, index._state.searcher())
+        index.updatePage(self._page('/bar', 'Bar', 'Cheese.'))
+        self.assertIsNot(searcher, index._state.searcher())
+
+    def testOldSearcherStaysOpen(self):
+        index = self._getIndex(commit_delay=0)
+        index.reset([self._page('/foo', 'Foo', 'Cheese.')])
+        searcher = index._state.searcher()
+        index.updatePage(self._page('/bar', 'Bar', 'Cheese.'))
+        index._state.searcher()
+        index.updatePage(self._page('/baz', 'Baz', 'Cheese.'))
+        index._state.searcher()
+        # Another thread could still be using the first searcher.
+        self.assertEqual(1, searcher.doc_count())
+
+    def testIndexRenderedText(self):
+        index = self._getIndex(commit_delay=0, index_rendered_text=True)
+        foo = self._page('/foo', 'Foo', '{{include: Cheese}}')
+        foo.text = '<p>Some <em>cheese</em> &amp; wine.</p>'
+        foo.ready_time = datetime.datetime(2018, 1, 1)
+        bar = self._page('/bar', 'Bar', 'Bar.')
+        bar.text = '<p>Bar.</p>'
+        bar.ready_time = datetime.datetime(2018, 1, 1)
+        index.reset([foo, bar])
+        self.assertEqual(['/foo'], self._searchUrls(index, 'cheese'))
+        self.assertEqual([], self._searchUrls(index, 'include'))
+        self.assertEqual([], self._searchUrls(index, 'em'))
+
+        # The included text changed, but not the page's file.
+        foo.text = '<p>Some <em>ham</em> &amp; wine.</p>'
+        foo.ready_time = datetime.datetime(2018, 1, 2)
+        os.remove(foo.path)
+        index.updateAll([foo])
+        self.assertEqual([], self._searchUrls(index, 'cheese'))
+        self.assertEqual(['/foo'], self._searchUrls(index, 'ham'))
+        self.assertEqual([], self._searchUrls(index, 'bar'))
@@ -0,0 +1,357 @@
+import os
+import os.path
+import time
+import threading
+from tests import WikkedTest
+from tests.mock import MockSourceControl, RecordingWikiIndex
+from wikked.db.sql import SQLDatabase
+from wikked.page import FileSystemPage
+from wikked.wiki import Wiki, synchronous_wiki_updater
+from wikked.worker import WikiWorker
+
+
+class RecordingSourceControl(MockSourceControl):
+    def __init__(self):
+        super(RecordingSourceControl, self).__init__()
+        self.commits = []
+
+    def commit(self, paths, op_meta):
+        self.commits.append((sorted(paths), op_meta))
+
+
+def _start_wiki(wiki):
+    wiki.start()
+    return wiki
+
+
+class FileWikiTest(WikkedTest):
+    def _getWikiFromFiles(self, files, edit_worker=False,
+                          resolve_worker=False):
+        root = os.path.join(self.test_data_dir, 'wiki')
+        os.makedirs(root)
+        for name, text in files.items():
+            with open(os.path.join(root, name), 'w') as fp:
+                fp.write(text)
+
+        params = self._getParameters(root)
+        params.mock_fs = False
+        params.mock_scm = RecordingSourceControl()
+        params.db_factory = lambda: SQLDatabase(params.config)
+        # In-memory databases always need a schema update, so we can't
+        # use one when updating pages.
+        params.config_text = (
+                "[wiki]\ndefault_extension = txt\n"
+                "database_url = sqlite:///%s\n" %
+                os.path.join(self.test_data_dir, 'wiki.db'))
+        updates = []
+        params.wiki_updater = lambda wiki, url: updates.append(url)
+        if edit_worker:
+            params.edit_worker = WikiWorker(
+                    lambda: _start_wiki(Wiki(params)))
+        if resolve_worker:
+            params.resolve_worker = WikiWorker(
+                    lambda: _start_wiki(Wiki(params)))
+        wiki = self._getStartedWiki(parameters=params)
+        return wiki, updates
+
+
+class BulkEditTest(FileWikiTest):
+    def testSetPages(self):
+        wiki, updates = self._getWikiFromFiles({
+            'foo.txt': "Foo links to [[Bar]].",
+            'bar.txt': "Bar."})
+        wiki.setPages(
+                {'/bar': "New bar.",
+                 '/baz': "Baz includes:\n{{include: bar}}\n"},
+                {'author': 'joe', 'message': "Bulk edit"})
+
+        commits = wiki.scm.commits
+        self.assertEqual(1, len(commits))
+        self.assertEqual(
+                [os.path.join(wiki.root, 'bar.txt'),
+                 os.path.join(wiki.root, 'baz.txt')],
+                commits[0][0])
+        self.assertEqual({'author': 'joe', 'message': "Bulk edit"},
+                         commits[0][1])
+        self.assertEqual(['/bar', '/baz'], updates)
+
+        self.assertEqual(['/bar', '/baz', '/foo'],
+                         sorted([u for u in wiki.getPageUrls()
+                                 if u.startswith('/')]))
+        self.assertEqual("New bar.", wiki.getPage('/bar').text)
+        self.assertEqual("Baz includes:\nNew bar.",
+                         wiki.getPage('/baz').text)
+
+    def testSetPagesUpdatesIncludingPages(self):
+        wiki, updates = self._getWikiFromFiles({
+            'foo.txt': "Foo includes:\n{{include: bar}}\n",
+            'bar.txt': "Bar."})
+        self.assertEqual("Foo includes:\nBar.", wiki.getPage('/foo').text)
+        wiki._wiki_updater = synchronous_wiki_updater
+        wiki.setPages({'/bar': "New bar."},
+                      {'author': 'joe', 'message': "Bulk edit"})
+        wiki.db.session.expire_all()
+        page = wiki.getPage('/foo')
+        self.assertTrue(page.is_resolved)
+        self.assertEqual("Foo includes:\nNew bar.", page.text)
+
+    def testSetPagesFlushesIndex(self):
+        wiki, updates = self._getWikiFromFiles({'foo.txt': "Foo."})
+        wiki.index = RecordingWikiIndex()
+        wiki.setPages({'/foo': "New foo."},
+                      {'author': 'joe', 'message': "Edit"})
+        self.assertEqual([('update', '/foo'), ('flush',)], wiki.index.calls)
+
+    def testBulkEdit(self):
+        wiki, updates = self._getWikiFromFiles({'foo.txt': "Foo."})
+        with wiki.bulkEdit({'author': 'joe', 'message': "Bulk"}) as e:
+            e.setPage('/foo', "New foo.")
+            e.setPage('/bar', "Bar.")
+        self.assertEqual(1, len(wiki.scm.commits))
+        self.assertEqual("New foo.", wiki.getPage('/foo').text)
+        self.assertEqual("Bar.", wiki.getPage('/bar').text)
+
+    def testBulkEditAbortsOnError(self):
+        wiki, updates = self._getWikiFromFiles({'foo.txt': "Foo."})
+        with self.assertRaises(Exception):
+            with wiki.bulkEdit({'author': 'joe', 'message': "Bulk"}) as e:
+                e.setPage('/foo', "New foo.")
+                raise Exception("Oops")
+        self.assertEqual([], wiki.scm.commits)
+        self.assertEqual([], updates)
+        self.assertEqual("Foo.", wiki.getPage('/foo').text)
+
+
+class EditWorkerTest(FileWikiTest):
+    def testBackgroundEdit(self):
+        wiki, updates = self._getWikiFromFiles(
+                {'foo.txt': "Foo.",
+                 'bar.txt': "Bar includes:\n{{include: foo}}\n"},
+                edit_worker=True)
+
+        # Block the worker until we've checked the page's pending state.
+        gate = threading.Event()
+        wiki.edit_worker.enqueue(lambda w: gate.wait(5))
+        wiki.setPage('/foo', {'text': "New foo.", 'author': 'joe',
+                              'message': "Edit"})
+
+        self.assertEqual(1, len(wiki.scm.commits))
+        self.assertTrue(wiki.isPagePending('/foo'))
+        self.assertFalse(wiki.isPagePending('/bar'))
+        page = wiki.getPage('/foo')
+        self.assertEqual("New foo.", page.raw_text)
+        # The edited page is resolved right away, only the pages that
+        # depend on it are updated in the background.
+        self.assertTrue(page.is_resolved)
+        self.assertEqual("New foo.", page.text)
+        self.assertEqual([], updates)
+
+        gate.set()
+        wiki.edit_worker.join()
+        self.assertFalse(wiki.isPagePending('/foo'))
+        self.assertEqual(['/foo'], updates)
+        wiki.db.session.expire_all()
+        page = wiki.getPage('/foo')
+        self.assertTrue(page.is_resolved)
+        self.assertEqual("New foo.", page.text)
+        wiki.edit_worker.stop()
+
+    def testRevalidationIsNotPendingEdit(self):
+        wiki, updates = self._getWikiFromFiles(
+                {'foo.txt': "Foo."}, edit_worker=True, resolve_worker=True)
+
+        gate = threading.Event()
+        wiki.resolve_worker.enqueue(lambda w: gate.wait(5))
+        self.assertTrue(wiki.revalidatePage('/foo'))
+        self.assertTrue(wiki.resolve_worker.isPending('/foo'))
+        self.assertFalse(wiki.isPagePending('/foo'))
+
+        gate.set()
+        wiki.resolve_worker.stop()
+        wiki.edit_worker.stop()
+
+
+class PageCacheTest(FileWikiTest):
+    def testCachedPages(self):
+        wiki, updates = self._getWikiFromFiles({'foo.txt': "Foo."})
+        cache = wiki.db.page_cache
+        cache.clear()
+        hits = cache.hits
+
+        self.assertEqual("Foo.", wiki.getPage('/foo').text)
+        self.assertEqual("Foo.", wiki.getPage('/foo').text)
+        self.assertEqual(hits + 1, cache.hits)
+
+        wiki.setPage('/foo', {'text': "New foo.", 'author': 'joe',
+                              'message': "Edit"})
+        self.assertEqual("New foo.", wiki.getPage('/foo').text)
+
+
+class ResolvePageTest(FileWikiTest):
+    def testResolveLease(self):
+        wiki, updates = self._getWikiFromFiles({'foo.txt': "Foo."})
+        self.assertTrue(wiki.db.acquireResolveLease('/foo', 'a', 60))
+        self.assertFalse(wiki.db.acquireResolveLease('/foo', 'b', 60))
+        self.assertTrue(wiki.db.acquireResolveLease('/bar', 'b', 60))
+        wiki.db.releaseResolveLease('/foo', 'a')
+        self.assertTrue(wiki.db.acquireResolveLease('/foo', 'b', -1))
+        # Expired leases can be taken over.
+        self.assertTrue(wiki.db.acquireResolveLease('/foo', 'c', 60))
+
+    def testSingleFlightResolve(self):
+        wiki, updates = self._getWikiFromFiles({'foo.txt': "Foo."})
+        wiki.db.uncachePages()
+        self.assertFalse(wiki.getPage('/foo').is_resolved)
+
+        resolves = []
+        orig_resolve = wiki.resolve
+
+        def slow_resolve(*args, **kwargs):
+            resolves.append(kwargs.get('only_urls'))
+            time.sleep(0.2)
+            orig_resolve(*args, **kwargs)
+
+        wiki.resolve = slow_resolve
+        results = []
+        threads = [threading.Thread(
+                       target=lambda: results.append(wiki.resolvePage('/foo')))
+                   for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual([['/foo']], resolves)
+        self.assertEqual([True] * 4, results)
+        self.assertTrue(wiki.getPage('/foo').is_resolved)
+
+    def testResolveWaitsForOtherProcess(self):
+        wiki, updates = self._getWikiFromFiles({'foo.txt': "Foo."})
+        wiki.db.uncachePages()
+        self.assertTrue(wiki.db.acquireResolveLease('/foo', 'other', 60))
+        self.assertFalse(wiki.resolvePage('/foo', wait_time=0.3))
+        self.assertFalse(wiki.getPage('/foo').is_resolved)
+
+
+class StalePageTest(FileWikiTest):
+    def testUncacheKeepsResolvedData(self):
+        wiki, updates = self._getWikiFromFiles({'foo.txt': "Foo."})
+        self.assertIsNone(wiki.getPage('/foo').invalidate_time)
+
+        wiki.db.uncachePages()
+        page = wiki.getPage('/foo')
+        self.assertFalse(page.is_resolved)
+        self.assertIsNotNone(page.invalidate_time)
+        self.assertEqual("Foo.", page.text)
+
+        self.assertTrue(wiki.resolvePage('/foo'))
+        page = wiki.getPage('/foo')
+        self.assertTrue(page.is_resolved)
+        self.assertIsNone(page.invalidate_time)
+
+    def testRevalidatePage(self):
+        wiki, updates = self._getWikiFromFiles(
+                {'foo.txt': "Foo."}, resolve_worker=True)
+        worker = wiki.resolve_worker
+        wiki.resolve_worker = None
+        self.assertFalse(wiki.revalidatePage('/foo'))
+        wiki.resolve_worker = worker
+
+        wiki.db.uncachePages()
+        self.assertTrue(wiki.revalidatePage('/foo'))
+        self.assertTrue(wiki.revalidatePage('/foo'))
+        wiki.resolve_worker.join()
+        self.assertFalse(wiki.resolve_worker.isPending('/foo'))
+        self.assertTrue(wiki.getPage('/foo').is_resolved)
+        wiki.resolve_worker.stop()
+
+
+class UpdatePageTest(FileWikiTest):
+    def testUpdateKeepsPageId(self):
+        wiki, updates = self._getWikiFromFiles({
+            'foo.txt': "Foo.\n\n{{category: Bar}}\n{{category: Baz}}\n"})
+        page_id = wiki.getPage('/foo')._id
+
+        wiki.setPage('/foo', {
+            'text': "New foo.\n\n{{category: Bar}}\n{{category: Other}}\n",
+            'author': 'joe', 'message': "Edit"})
+        page = wiki.getPage('/foo')
+        self.assertEqual(page_id, page._id)
+        self.assertEqual("New foo.", page.text.strip())
+        self.assertEqual(['Bar', 'Other'], page.getLocalMeta('category'))
+        self.assertTrue(page.is_resolved)
+
+    def testUnchangedPageStaysResolved(self):
+        wiki, updates = self._getWikiFromFiles({'foo.txt': "Foo."})
+        ready_time = wiki.getPage('/foo').ready_time
+
+        wiki.db.updatePage(wiki.fs.findPageInfo('/foo'))
+        page = wiki.getPage('/foo')
+        self.assertTrue(page.is_resolved)
+        self.assertEqual(ready_time, page.ready_time)
+
+        with open(page.path, 'w') as fp:
+            fp.write("Changed foo.")
+        wiki.db.updatePage(wiki.fs.findPageInfo('/foo'))
+        page = wiki.getPage('/foo')
+        self.assertFalse(page.is_resolved)
+        self.assertEqual("Changed foo.", page.raw_text)
+
+    def testTouchedPageIsNotReformatted(self):
+        wiki, updates = self._getWikiFromFiles({
+            'foo.txt': "Foo.", 'bar.txt': "Bar."})
+        foo_path = os.path.join(wiki.root, 'foo.txt')
+        bar_path = os.path.join(wiki.root, 'bar.txt')
+        cache_time = wiki.getPage('/foo').cache_time
+        future = time.time() + 10
+        os.utime(foo_path, (future, future))
+        with open(bar_path, 'w') as fp:
+            fp.write("New bar.")
+        os.utime(bar_path, (future, future))
+
+        formatted = []
+        orig_load = FileSystemPage._loadFromPageInfo
+
+        def load(page, wiki, page_info):
+            formatted.append(page_info.url)
+            return orig_load(page, wiki, page_info)
+
+        FileSystemPage._loadFromPageInfo = load
+        try:
+            wiki.updateAll()
+        finally:
+            FileSystemPage._loadFromPageInfo = orig_load
+
+        self.assertEqual(['/bar'], formatted)
+        page = wiki.getPage('/foo')
+        self.assertTrue(page.is_resolved)
+        self.assertGreater(page.cache_time, cache_time)
+        self.assertEqual("New bar.", wiki.getPage('/bar').text)
+
+
+class FormatCacheTest(FileWikiTest):
+    def testResetReusesFormatting(self):
+        wiki, updates = self._getWikiFromFiles({
+            'foo.txt': "Foo links to [[Bar]].\n\n{{category: Stuff}}\n",
+            'bar.txt': "Bar."})
+        with open(os.path.join(wiki.root, 'bar.txt'), 'w') as fp:
+            fp.write("New bar.")
+
+        formatted = []
+        orig_format = FileSystemPage._formatText
+
+        def format_text(page, data):
+            formatted.append(data.url)
+            return orig_format(page, data)
+
+        FileSystemPage._formatText = format_text
+        try:
+            wiki.reset()
+        finally:
+            FileSystemPage._formatText = orig_format
+
+        self.assertEqual(['/bar'], formatted)
+        page = wiki.getPage('/foo')
+        self.assertEqual(['Stuff'], page.getLocalMeta('category'))
+        self.assertEqual(['/bar'], page.links)
+        self.assertEqual("New bar.", wiki.getPage('/bar').text)
@@ -0,0 +1,160 @@
+import os.path
+import time
+from tests import WikkedTest
+from tests.mock import MockPage, RecordingWikiIndex
+from wikked.worker import (
+        TaskStore, TaskRunner, CoalescingUpdater, FULL_UPDATE)
+
+
+class RecordingDatabase(object):
+    def __init__(self, uncached_urls):
+        self.uncached_urls = uncached_urls
+        self.calls = []
+
+    def uncacheDependentPages(self, urls):
+        self.calls.append(('uncache', urls))
+        return list(self.uncached_urls)
+
+    def getPage(self, url, fields=None):
+        return MockPage(None, url)
+
+
+class RecordingWiki(object):
+    def __init__(self, uncached_urls=None):
+        self.db = RecordingDatabase(uncached_urls or [])
+        self.index = RecordingWikiIndex()
+        self.calls = []
+
+    def updateAll(self):
+        self.calls.append('updateAll')
+
+    def resolve(self, only_urls=None, priority_urls=None):
+        self.calls.append(('resolve', only_urls, priority_urls))
+
+    def stop(self):
+        self.calls.append('stop')
+
+
+class TaskRunnerTest(WikkedTest):
+    def _getStore(self):
+        return TaskStore(os.path.join(self.test_data_dir, 'tasks.db'))
+
+    def testCoalesceJobs(self):
+        store = self._getStore()
+        store.addJob('/foo')
+        store.addJob('/bar')
+        store.addJob('/foo')
+        self.assertEqual(2, store.getCount())
+        self.assertEqual(['/bar', '/foo'], [j[1] for j in store.getJobs()])
+
+    def testRequeuedJobSurvivesRemoval(self):
+        store = self._getStore()
+        store.addJob('/foo')
+        jobs = store.getJobs()
+        store.addJob('/foo')
+        store.removeJobs([j[0] for j in jobs])
+        self.assertEqual(['/foo'], [j[1] for j in store.getJobs()])
+
+    def testTargetedUpdate(self):
+        wiki = RecordingWiki(['/baz'])
+        runner = TaskRunner(lambda: wiki, self._getStore())
+        runner.queueUpdate('/foo')
+        runner.queueUpdate('/foo')
+        self.assertEqual(1, runner.getQueueDepth())
+
+        self.assertEqual(1, runner.runPending())
+        self.assertEqual(0, runner.getQueueDepth())
+        self.assertEqual([('uncache', ['/foo'])], wiki.db.calls)
+        self.assertEqual([('resolve', ['/baz'], ['/foo']), 'stop'],
+                         wiki.calls)
+        self.assertEqual([('update', '/baz')], wiki.index.calls)
+
+    def testFullUpdate(self):
+        wiki = RecordingWiki()
+        runner = TaskRunner(lambda: wiki, self._getStore())
+        runner.queueUpdate('/foo')
+        runner.queueUpdate(None)
+        self.assertEqual(
+                ['/foo', FULL_UPDATE],
+                [j[1] for j in runner.store.getJobs()])
+
+        self.assertEqual(2, runner.runPending())
+        self.assertEqual(['updateAll', 'stop'], wiki.calls)
+        self.assertEqual(0, runner.runPending())
+
+    def testFailedUpdateStaysQueued(self):
+        wiki = RecordingWiki(['/baz'])
+
+        def fail(only_urls=None, priority_urls=None):
+            raise Exception("Oops")
+
+        wiki.resolve = fail
+        runner = TaskRunner(lambda: wiki, self._getStore())
+        runner.queueUpdate('/foo')
+        self.assertEqual(0, runner.runPending())
+        self.assertEqual(1, runner.failure_count)
+        self.assertEqual(['/foo'], [j[1] for j in runner.store.getJobs()])
+
+        del wiki.resolve
+        self.assertEqual(1, runner.runPending())
+        self.assertEqual(0, runner.failure_count)
+        self.assertEqual(0, runner.getQueueDepth())
+
+    def testJobsArePersisted(self):
+        TaskRunner(None, self._getStore()).queueUpdate('/foo')
+
+        wiki = RecordingWiki()
+        runner = TaskRunner(lambda: wiki, self._getStore())
+        self.assertEqual(1, runner.getQueueDepth())
+        runner.start()
+        runner.queueUpdate('/bar')
+        for i in range(50):
+            if runner.getQueueDepth() == 0:
+                break
+            time.sleep(0.1)
+        runner.stop()
+        self.assertEqual(0, runner.getQueueDepth())
+        self.assertIn('stop', wiki.calls)
+
+
+class CoalescingUpdaterTest(WikkedTest):
+    def testCoalesceUpdates(self):
+        runs = []
+        updater = CoalescingUpdater(runs.append, delay=60)
+        updater(None, '/foo')
+        updater(None, '/bar')
+        updater(None, '/foo')
+        self.assertEqual([], runs)
+        self.assertEqual(
+                {'requested': 3, 'executed': 0, 'coalesced': 0,
+                 'pending': 2},
+                updater.getStats())
+
+        updater.flush()
+        self.assertEqual([['/bar', '/foo']], runs)
+        self.assertEqual(
+                {'requested': 3, 'executed': 1, 'coalesced': 2,
+                 'pending': 0},
+                updater.getStats())
+
+        updater.flush()
+        self.assertEqual(1, len(runs))
+
+    def testFullUpdateWins(self):
+        runs = []
+        updater = CoalescingUpdater(runs.append, delay=60)
+        updater(None, '/foo')
+        updater(None, None)
+        updater.flush()
+        self.assertEqual([[FULL_UPDATE]], runs)
+
+    def testDelayedUpdate(self):
+        runs = []
+        updater = CoalescingUpdater(runs.append, delay=0.1)
+        updater(None, '/foo')
+        updater(None, '/bar')
+        for i in range(50):
+            if runs:
+                break
+            time.sleep(0.1)
+        self.assertEqual([['/bar', '/foo']], runs)
@@ -7,6 +7,19 @@ from wikked.webimpl.decorators import requires_permission
 @requires_permission('index')
 def api_admin_reindex():
     wiki = get_wiki()
-    wiki.index.reset(wiki.getPages())
+    wiki.index.reset(wiki.getPages(),
+                     page_count=len(list(wiki.db.getPageUrls())))
     result = {'ok': 1}
     return jsonify(result)
+
+
+@app.route('/api/admin/tasks')
+@requires_permission('index')
+def api_admin_tasks():
+    # We only know about the local task runner's queue.
+    runner = app.wiki_task_runner
+    depth = runner.getQueueDepth() if runner is not None else None
+    updater = app.wiki_async_updater
+    stats = updater.getStats() if updater is not None else None
+    result = {'queue_depth': depth, 'updates': stats}
+    return jsonify(result)
@@ -1,6 +1,9 @@
 import os
 import os.path
+import hashlib
 import logging
+import tempfile
+import threading
 
 try:
     import simplejson as json
@@ -57,3 +60,109 @@ class Cache(object):
 
         return cache_path, True
 
+
+# The total size of each cache directory, shared by all the wikis of this
+# process so we don't have to scan the directory on each request.
+cache_sizes = {}
+sizes_lock = threading.Lock()
+
+
+class DiskCache(object):
+    """ A content-addressed disk cache for values that never change for a
+        given key, so entries don't need to be invalidated. Instead, the
+        least recently used ones are evicted when the cache grows over
+        its maximum size.
+    """
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        path = self._getCachePath(key)
+        try:
+            with open(path, 'r', encoding='utf8') as fp:
+                value = fp.read()
+        except FileNotFoundError:
+            return None
+        # Bump the modification time, which we use for eviction.
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def set(self, key, value):
+        if not self.enabled:
+            return
+        path = self._getCachePath(key)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname, exist_ok=True)
+        # Write to a temp file first so that other processes never read
+        # half-written entries.
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf8') as fp:
+            fp.write(value)
+        os.replace(tmp_path, path)
+        self._addSize(os.path.getsize(path))
+
+    def getOrCreate(self, key, func):
+        """ Returns the cached value for the given key, or calls `func`
+            to create and cache it. """
+        value = self.get(key)
+        if value is None:
+            value = func()
+            if value is not None:
+                self.set(key, value)
+        return value
+
+    def _getCachePath(self, key):
+        h = hashlib.sha1('\0'.join(key).encode('utf8')).hexdigest()
+        return os.path.join(self.cache_dir, h[:2], h[2:])
+
+    def _addSize(self, size):
+        with sizes_lock:
+            total = cache_sizes.get(self.cache_dir)
+            if total is None:
+                total = sum([s for _, _, s in self._getEntries()])
+            else:
+                total += size
+            if total > self.max_size:
+                total = self._evict()
+            cache_sizes[self.cache_dir] = total
+
+    def _evict(self):
+        # Remove the oldest entries until we're well under the maximum
+        # size, so we don't end up doing this on every write.
+        entries = sorted(self._getEntries(), key=lambda e: e[1])
+        total = sum([s for _, _, s in entries])
+        target = self.max_size * 3 // 4
+        removed = 0
+        for path, _, size in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        logger.debug("Evicted %d entries from '%s'." %
+                     (removed, self.cache_dir))
+        return total
+
+    def _getEntries(self):
+        for dirpath, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield path, st.st_mtime, st.st_size
@@ -1,5 +1,6 @@
 import os
 import os.path
+import time
 import shutil
 import logging
 from wikked.commands.base import WikkedCommand, register_command
@@ -9,6 +10,22 @@ from wikked.wiki import INIT_CONTEXT
 logger = logging.getLogger(__name__)
 
 
+class ResolveProgressLogger(object):
+    """ Logs the progress of resolving pages, at most once per
+        `interval` seconds. """
+    def __init__(self, interval=2):
+        self.interval = interval
+        self._last_time = time.time()
+
+    def __call__(self, done, total):
+        now = time.time()
+        if done < total and now - self._last_time < self.interval:
+            return
+        self._last_time = now
+        logger.info("Resolved %d/%d pages (%d%%)" %
+                    (done, total, 100 * done // total))
+
+
 @register_command
 class InitCommand(WikkedCommand):
     def __init__(self):
@@ -81,9 +98,12 @@ class ResetCommand(WikkedCommand):
     def run(self, ctx):
         parallel = not ctx.args.single_threaded
         if ctx.args.index_only:
-            ctx.wiki.index.reset(ctx.wiki.getPages())
+            ctx.wiki.index.reset(
+                ctx.wiki.getPages(fields=ctx.wiki.index.page_fields),
+                page_count=len(list(ctx.wiki.db.getPageUrls())))
         else:
-            ctx.wiki.reset(parallel=parallel)
+            ctx.wiki.reset(parallel=parallel,
+                           progress_callback=ResolveProgressLogger())
 
 
 @register_command
@@ -152,7 +172,8 @@ class ResolveCommand(WikkedCommand):
     def run(self, ctx):
         ctx.wiki.resolve(
             force=ctx.args.force,
-            parallel=ctx.args.parallel)
+            parallel=ctx.args.parallel,
+            progress_callback=ResolveProgressLogger())
 
 
 @register_command
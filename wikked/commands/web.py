@@ -27,8 +27,9 @@ class RunServerCommand(WikkedCommand):
         parser.add_argument(
                 '--usetasks',
                 help="Use background tasks for updating the wiki after a "
-                     "page has been edited. You will have to run "
-                     "`wk runtasks` at the same time as `wk runserver`.",
+                     "page has been edited. If `WIKI_TASK_RUNNER` is set "
+                     "to `celery`, you will have to run `wk runtasks` at "
+                     "the same time as `wk runserver`.",
                 action='store_true')
         parser.add_argument(
                 '-d', '--dev',
@@ -109,8 +110,8 @@ class RunTasksCommand(WikkedCommand):
     def __init__(self):
         super(RunTasksCommand, self).__init__()
         self.name = 'runtasks'
-        self.description = ("Runs the tasks to update the wiki in the "
-                            "background.")
+        self.description = ("Runs the Celery tasks to update the wiki in "
+                            "the background.")
 
     def setupParser(self, parser):
         pass
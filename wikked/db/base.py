@@ -47,6 +47,12 @@ class Database(object):
             info. """
         pass
 
+    def updatePages(self, page_infos):
+        """ Update the given pages' cache info based on the given page
+            infos, all at once. """
+        for page_info in page_infos:
+            self.updatePage(page_info)
+
     def updateAll(self, page_infos, force=False):
         """ Update all the pages in the wiki based on the given pages
             infos. """
@@ -82,7 +88,26 @@ class Database(object):
         pass
 
     def uncachePages(self, except_url=None, only_required=False):
-        """ Invalidates resolved information for pages in the wiki. """
+        """ Invalidates resolved information for pages in the wiki. If
+            `only_required` is set, only the pages that depend on other
+            pages are invalidated. Returns the URLs of the invalidated
+            pages. """
+        return []
+
+    def uncacheDependentPages(self, urls):
+        """ Invalidates resolved information for the pages that include
+            or query the given pages. Returns the URLs of the invalidated
+            pages. """
+        return []
+
+    def acquireResolveLease(self, url, owner, duration):
+        """ Tries to mark the given page as being resolved by `owner` for
+            the next `duration` seconds. Returns whether it worked, i.e.
+            whether nobody else is resolving that page. """
+        return True
+
+    def releaseResolveLease(self, url, owner):
+        """ Releases a lease taken with `acquireResolveLease`. """
         pass
 
     def pageExists(self, url):
@@ -0,0 +1,82 @@
+import copy
+import logging
+import threading
+import collections
+
+
+logger = logging.getLogger(__name__)
+
+
+def _get_data_size(data):
+    # A rough estimate of how much memory a page's data takes, mostly
+    # based on its texts.
+    size = 256
+    for text in (data.raw_text, data.formatted_text, data.text):
+        if text:
+            size += len(text)
+    return size
+
+
+class PageDataCache(object):
+    """ An in-process LRU cache of page data, in front of the database.
+        Each entry is tagged with the database's page generation at the
+        time it was loaded, and is only valid as long as the generation
+        didn't change.
+    """
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, generation):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != generation:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            data = entry[1]
+        # Callers may modify the page data they get.
+        return copy.deepcopy(data)
+
+    def put(self, key, generation, data):
+        data = copy.deepcopy(data)
+        size = _get_data_size(data)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old[2]
+            self._entries[key] = (generation, data, size)
+            self._size += size
+            while (len(self._entries) > self.max_entries or
+                    self._size > self.max_bytes):
+                _, (_, _, s) = self._entries.popitem(last=False)
+                self._size -= s
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+# The caches are shared by all the wikis of this process, since a new wiki
+# gets created for every request.
+page_caches = {}
+caches_lock = threading.Lock()
+
+
+def get_page_cache(name, max_entries, max_bytes):
+    with caches_lock:
+        cache = page_caches.get(name)
+        if cache is None:
+            logger.debug("Creating page cache for: %s" % name)
+            cache = PageDataCache(max_entries, max_bytes)
+            page_caches[name] = cache
+        return cache
@@ -0,0 +1,176 @@
+import os
+import os.path
+import json
+import mmap
+import struct
+import hashlib
+import logging
+import datetime
+import threading
+import contextlib
+from wikked.page import PageData
+
+try:
+    import fcntl
+    SUPPORTS_SHARED_CACHE = True
+except ImportError:
+    SUPPORTS_SHARED_CACHE = False
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_SLOT_SIZE = 64 * 1024
+
+# Each slot starts with a magic number, the page generation of the entry,
+# and the lengths of the key and data that follow.
+SLOT_HEADER = struct.Struct('<4sqII')
+SLOT_MAGIC = b'WKPC'
+
+
+def _encode_value(v):
+    if isinstance(v, datetime.datetime):
+        return {'__datetime__': v.isoformat()}
+    raise TypeError("Can't encode: %r" % v)
+
+
+def _decode_object(d):
+    if '__datetime__' in d:
+        return datetime.datetime.fromisoformat(d['__datetime__'])
+    return d
+
+
+def _encode_data(data):
+    return json.dumps(data.__dict__, default=_encode_value).encode('utf8')
+
+
+def _decode_data(raw):
+    data = PageData()
+    data.__dict__.update(json.loads(
+        raw.decode('utf8'), object_hook=_decode_object))
+    return data
+
+
+def _encode_key(key):
+    url, fields = key
+    fields = ','.join(sorted(fields)) if fields else '*'
+    return ('%s\0%s' % (url, fields)).encode('utf8')
+
+
+class SharedPageCache(object):
+    """ A page data cache shared by all the processes on a machine, stored
+        in a memory-mapped file. The file is split into fixed-size slots,
+        and each entry goes into the slot picked by the hash of its key,
+        replacing whatever was there. Like `PageDataCache`, entries are
+        tagged with the database's page generation.
+    """
+    def __init__(self, path, size, slot_size=DEFAULT_SLOT_SIZE):
+        if not SUPPORTS_SHARED_CACHE:
+            raise Exception("The shared page cache isn't supported on "
+                            "this platform.")
+        self.path = path
+        self.slot_size = slot_size
+        self.slot_count = max(1, size // slot_size)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._fd = None
+        self._map = None
+
+    def get(self, key, generation):
+        key = _encode_key(key)
+        offset = self._getSlotOffset(key)
+        with self._lock, self._fileLock(fcntl.LOCK_SH):
+            magic, gen, key_len, data_len = SLOT_HEADER.unpack_from(
+                self._map, offset)
+            start = offset + SLOT_HEADER.size
+            if (magic != SLOT_MAGIC or gen != generation or
+                    self._map[start:start + key_len] != key):
+                self.misses += 1
+                return None
+            start += key_len
+            raw = self._map[start:start + data_len]
+            self.hits += 1
+        return _decode_data(raw)
+
+    def put(self, key, generation, data):
+        key = _encode_key(key)
+        raw = _encode_data(data)
+        if SLOT_HEADER.size + len(key) + len(raw) > self.slot_size:
+            return
+        offset = self._getSlotOffset(key)
+        with self._lock, self._fileLock(fcntl.LOCK_EX):
+            start = offset + SLOT_HEADER.size
+            self._map[start:start + len(key)] = key
+            start += len(key)
+            self._map[start:start + len(raw)] = raw
+            SLOT_HEADER.pack_into(
+                self._map, offset,
+                SLOT_MAGIC, generation, len(key), len(raw))
+
+    def clear(self):
+        with self._lock, self._fileLock(fcntl.LOCK_EX):
+            self._map[:] = b'\0' * len(self._map)
+
+    def close(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                os.close(self._fd)
+                self._map = None
+                self._fd = None
+
+    def _getSlotOffset(self, key):
+        h = int.from_bytes(hashlib.sha1(key).digest()[:8], 'little')
+        return (h % self.slot_count) * self.slot_size
+
+    @contextlib.contextmanager
+    def _fileLock(self, mode):
+        # Must be called with `_lock` held: file locks don't do anything
+        # between threads of the same process.
+        self._ensureMap()
+        fcntl.flock(self._fd, mode)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _ensureMap(self):
+        if self._map is not None:
+            return
+
+        dirname = os.path.dirname(self.path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname, exist_ok=True)
+
+        # Other processes may be using the file with a different size, so
+        # only ever grow it, since shrinking it would crash them.
+        size = self.slot_count * self.slot_size
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_size < size:
+                    logger.debug("Creating shared page cache: %s" %
+                                 self.path)
+                    os.ftruncate(fd, size)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            self._map = mmap.mmap(fd, size)
+        except:  # NOQA
+            os.close(fd)
+            raise
+        self._fd = fd
+
+
+shared_caches = {}
+shared_caches_lock = threading.Lock()
+
+
+def get_shared_page_cache(path, size):
+    with shared_caches_lock:
+        cache = shared_caches.get(path)
+        if cache is None:
+            cache = SharedPageCache(path, size)
+            shared_caches[path] = cache
+        return cache
@@ -1,5 +1,7 @@
 import os
 import os.path
+import random
+import hashlib
 import string
 import logging
 import datetime
@@ -14,11 +16,13 @@ from sqlalchemy.orm import (
     scoped_session,
     relationship, backref, load_only, subqueryload, joinedload,
     Load)
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.orm.session import Session
 from wikked.db.base import (
     Database,
     DatabaseUpgradeRequired, PageListNotFound, NoWantedPages)
+from wikked.db.pagecache import get_page_cache
 from wikked.page import Page, PageData, FileSystemPage, WantedPage
 from wikked.utils import split_page_url, lower_url
 
@@ -26,6 +30,10 @@ from wikked.utils import split_page_url, lower_url
 logger = logging.getLogger(__name__)
 
 
+INCLUDE_META_NAMES = ['include', '+include', '__include']
+QUERY_META_NAMES = ['query', '+query', '__query']
+
+
 Base = declarative_base()
 
 
@@ -43,6 +51,7 @@ class SQLPage(Base):
     endpoint = Column(String(64))
     title = Column(UnicodeText)
     raw_text = Column(UnicodeText(length=2 ** 31))
+    content_hash = Column(String(40))
     formatted_text = Column(UnicodeText(length=2 ** 31))
 
     meta = relationship(
@@ -57,6 +66,8 @@ class SQLPage(Base):
         cascade='all, delete, delete-orphan')
 
     ready_text = Column(UnicodeText(length=2 ** 31))
+    ready_time = Column(DateTime)
+    invalidate_time = Column(DateTime)
     is_ready = Column(Boolean)
     needs_invalidate = Column(Boolean)
 
@@ -130,6 +141,14 @@ class SQLInfo(Base):
     time_value = Column(DateTime)
 
 
+class SQLResolveLease(Base):
+    __tablename__ = 'resolve_leases'
+
+    url = Column(String(260), primary_key=True)
+    owner = Column(String(64))
+    expire_time = Column(DateTime)
+
+
 class SQLWantedPage(Base):
     __tablename__ = 'wanted_pages'
 
@@ -243,7 +262,11 @@ class _EmbeddedSQLState(_SQLStateBase):
 class SQLDatabase(Database):
     """ A database cache based on SQL.
     """
-    schema_version = 10
+    schema_version = 14
+
+    # The maximum number of values to put in an `IN` clause, since SQLite
+    # has a limit on the number of bound variables in a query.
+    QUERY_CHUNK_SIZE = 500
 
     def __init__(self, config):
         Database.__init__(self)
@@ -251,6 +274,29 @@ class SQLDatabase(Database):
         self.auto_update = config.getboolean('wiki', 'auto_update')
         self._state = None
         self._state_lock = threading.Lock()
+        self.page_cached_hooks = []
+
+        # Memory databases are different for each engine, so we can't
+        # share a page cache between them.
+        self.page_cache = None
+        self.shared_page_cache = None
+        self._page_caches = []
+        if not self._isMemoryDatabase():
+            cache_size = config.getint('wiki', 'page_cache_size')
+            if cache_size > 0:
+                self.page_cache = get_page_cache(
+                        self.engine_url, cache_size,
+                        config.getint('wiki', 'page_cache_memory') *
+                        1024 * 1024)
+                self._page_caches.append(self.page_cache)
+
+            shared_size = config.getint('wiki', 'shared_page_cache_size')
+            if shared_size > 0:
+                from wikked.db.sharedcache import get_shared_page_cache
+                self.shared_page_cache = get_shared_page_cache(
+                        config.get('wiki', 'shared_page_cache_path'),
+                        shared_size * 1024 * 1024)
+                self._page_caches.append(self.shared_page_cache)
 
     def hookupWebApp(self, app):
         """ Hook up a Flask application with all the stuff we need.
@@ -293,9 +339,12 @@ class SQLDatabase(Database):
                 self._state = _EmbeddedSQLState(self.engine_url)
         return self._state
 
+    def _isMemoryDatabase(self):
+        return (self.engine_url == 'sqlite://' or
+                self.engine_url == 'sqlite:///:memory:')
+
     def _needsSchemaUpdate(self):
-        if (self.engine_url == 'sqlite://' or
-                self.engine_url == 'sqlite:///:memory:'):
+        if self._isMemoryDatabase():
             # Always create the schema for a memory database.
             return True
 
@@ -327,8 +376,36 @@ class SQLDatabase(Database):
         wanted_valid.int_value = 0
         self.session.add(wanted_valid)
 
+        # Start the page generation at a random number so that page caches
+        # don't mistake the new database for the old one.
+        page_gen = SQLInfo()
+        page_gen.name = 'page_generation'
+        page_gen.int_value = random.randint(1, 2**30)
+        self.session.add(page_gen)
+
         self.session.commit()
 
+    def _getPageGeneration(self):
+        q = self.session.query(SQLInfo.int_value).\
+            filter(SQLInfo.name == 'page_generation').\
+            first()
+        if q is None:
+            return None
+        return q.int_value
+
+    def _bumpPageGeneration(self):
+        """ Invalidates all cached page data. This must be called as part
+            of any transaction that changes pages. """
+        count = self.session.query(SQLInfo).\
+            filter(SQLInfo.name == 'page_generation').\
+            update({SQLInfo.int_value: SQLInfo.int_value + 1},
+                   synchronize_session=False)
+        if count == 0:
+            page_gen = SQLInfo()
+            page_gen.name = 'page_generation'
+            page_gen.int_value = random.randint(1, 2**30)
+            self.session.add(page_gen)
+
     def _getSchemaVersion(self):
         try:
             q = self.session.query(SQLInfo).\
@@ -368,19 +445,46 @@ class SQLDatabase(Database):
 
         logger.debug("Updating SQL database for page: %s" % page_info.url)
 
-        db_page = self.session.query(SQLPage).\
-            options(load_only('id', 'url')).\
+        db_page = self._queryPagesForUpdate().\
             filter(SQLPage.url == page_info.url).\
             first()
-        if db_page:
-            logger.debug(
-                    "Removing page '%s' [%d] from SQL database." %
-                    (db_page.url, db_page.id))
-            self.session.delete(db_page)
-            self.session.commit()
 
-        page = FileSystemPage(self.wiki, page_info)
-        self._addPage(page)
+        if db_page and self._touchIfUnchanged(db_page, page_info):
+            pass
+        elif db_page:
+            page = FileSystemPage(self.wiki, page_info)
+            self._updatePage(db_page, page)
+        else:
+            page = FileSystemPage(self.wiki, page_info)
+            self._addPage(page)
+        self._bumpPageGeneration()
+        self.session.commit()
+
+    def updatePages(self, page_infos):
+        if self._needsSchemaUpdate():
+            raise DatabaseUpgradeRequired()
+
+        page_infos = list(page_infos)
+        logger.debug("Updating SQL database for %d pages." % len(page_infos))
+
+        # Don't put too many URLs in each query, SQLite doesn't like it.
+        db_pages = {}
+        urls = [pi.url for pi in page_infos]
+        chunk_size = self.QUERY_CHUNK_SIZE
+        for i in range(0, len(urls), chunk_size):
+            q = self._queryPagesForUpdate().\
+                filter(SQLPage.url.in_(urls[i:i + chunk_size]))
+            for p in q.all():
+                db_pages[p.url] = p
+
+        for pi in page_infos:
+            db_page = db_pages.get(pi.url)
+            if db_page is not None:
+                if not self._touchIfUnchanged(db_page, pi):
+                    self._updatePage(db_page, FileSystemPage(self.wiki, pi))
+            else:
+                self._addPage(FileSystemPage(self.wiki, pi))
+        self._bumpPageGeneration()
         self.session.commit()
 
     def updateAll(self, page_infos, force=False):
@@ -389,13 +493,15 @@ class SQLDatabase(Database):
 
         logger.debug("Updating SQL database...")
 
-        to_update = set()
+        to_update = {}
         already_added = set()
         to_remove = []
         page_infos = list(page_infos)
         page_urls = set([p.url for p in page_infos])
+        page_infos_by_path = dict([(p.path, p) for p in page_infos])
         db_pages = self.session.query(SQLPage).\
-            options(load_only('id', 'url', 'path', 'cache_time')).\
+            options(load_only('id', 'url', 'path', 'cache_time',
+                              'content_hash')).\
             all()
         for p in db_pages:
             if not os.path.isfile(p.path):
@@ -403,26 +509,46 @@ class SQLDatabase(Database):
                 to_remove.append(p)
             else:
                 already_added.add(p.path)
+                if force and p.url in page_urls:
+                    to_update[p.path] = p
+                    continue
                 path_time = datetime.datetime.fromtimestamp(
                     os.path.getmtime(p.path))
-                if path_time > p.cache_time or (force and p.url in page_urls):
-                    # File has changed since last index.
-                    to_remove.append(p)
-                    to_update.add(p.path)
+                if path_time > p.cache_time:
+                    # File was touched since last index, but maybe only
+                    # its timestamp changed, like after a checkout.
+                    pi = page_infos_by_path.get(p.path)
+                    if pi is None or not self._touchIfUnchanged(p, pi):
+                        to_update[p.path] = p
         for p in to_remove:
             logger.debug("Removing page '%s' [%d] from SQL database." %
                          (p.url, p.id))
             self.session.delete(p)
 
+        self._bumpPageGeneration()
         self.session.commit()
 
+        # Load the full rows of the pages we'll update.
+        update_ids = [p.id for p in to_update.values()]
+        chunk_size = self.QUERY_CHUNK_SIZE
+        for i in range(0, len(update_ids), chunk_size):
+            q = self._queryPagesForUpdate().\
+                filter(SQLPage.id.in_(update_ids[i:i + chunk_size]))
+            for p in q.all():
+                to_update[p.path] = p
+
         added_db_objs = []
         for pi in page_infos:
-            if (pi.path in to_update or
-                    pi.path not in already_added):
+            db_page = to_update.get(pi.path)
+            if db_page is not None:
+                page = FileSystemPage(self.wiki, pi)
+                self._updatePage(db_page, page)
+                added_db_objs.append(db_page)
+            elif pi.path not in already_added:
                 page = FileSystemPage(self.wiki, pi)
                 added_db_objs.append(self._addPage(page))
 
+        self._bumpPageGeneration()
         self.session.commit()
 
         logger.debug("...done updating SQL database.")
@@ -483,6 +609,8 @@ class SQLDatabase(Database):
             raise
 
         db_obj.ready_text = page._data.text
+        db_obj.ready_time = page._data.ready_time = datetime.datetime.now()
+        db_obj.invalidate_time = None
         db_obj.needs_invalidate = False
 
         del db_obj.ready_meta[:]
@@ -503,23 +631,96 @@ class SQLDatabase(Database):
 
         db_obj.is_ready = True
 
+        for hook in self.page_cached_hooks:
+            hook(page)
+
+        self._bumpPageGeneration()
         self.session.commit()
 
     def uncachePages(self, except_url=None, only_required=False):
-        q = self.session.query(SQLPage)\
-                .options(load_only('id', 'url', 'needs_invalidate',
-                                   'is_ready'))
+        # We keep the previously resolved text and metadata around, so
+        # that they can be shown until the page is resolved again.
+        q = self.session.query(SQLPage).\
+            filter(SQLPage.is_ready == True)  # NOQA
         if except_url:
             q = q.filter(SQLPage.url != except_url)
         if only_required:
-            q = q.filter(SQLPage.needs_invalidate is True)
+            q = q.filter(SQLPage.needs_invalidate == True)  # NOQA
+
+        return self._uncachePages(q)
+
+    def uncacheDependentPages(self, urls):
+        # Included pages' URLs are stored as they were written, so we can
+        # only match them with the edited pages' names. This may catch
+        # pages including other pages with the same name, but that's fine.
+        # Pages with queries always need to be resolved again, since an
+        # edit can change which pages they match.
+        names = set(
+            lower_url(os.path.basename(split_page_url(u)[1]))
+            for u in urls)
+        page_ids = set()
+        q = self.session.query(
+                SQLReadyMeta.page_id, SQLReadyMeta.name, SQLReadyMeta.value).\
+            filter(SQLReadyMeta.name.in_(
+                INCLUDE_META_NAMES + QUERY_META_NAMES))
+        for page_id, name, value in q.all():
+            if name in QUERY_META_NAMES:
+                page_ids.add(page_id)
+                continue
+            include_url = value.split('|', 1)[0].strip()
+            include_name = os.path.basename(split_page_url(include_url)[1])
+            if lower_url(include_name) in names:
+                page_ids.add(page_id)
 
         uncached_urls = []
-        for p in q.all():
-            uncached_urls.append(p.url)
-            p.is_ready = False
+        page_ids = sorted(page_ids)
+        chunk_size = self.QUERY_CHUNK_SIZE
+        for i in range(0, len(page_ids), chunk_size):
+            q = self.session.query(SQLPage).\
+                filter(SQLPage.is_ready == True).\
+                filter(SQLPage.id.in_(page_ids[i:i + chunk_size]))  # NOQA
+            uncached_urls += self._uncachePages(q)
+        return uncached_urls
+
+    def _uncachePages(self, q):
+        uncached_urls = [p.url for p in q.options(load_only('url')).all()]
+        if uncached_urls:
+            q.update({SQLPage.is_ready: False,
+                      SQLPage.invalidate_time: datetime.datetime.now()},
+                     synchronize_session=False)
+            self._bumpPageGeneration()
         logger.debug("Uncaching: %s" % ', '.join(uncached_urls))
         self.session.commit()
+        return uncached_urls
+
+    def acquireResolveLease(self, url, owner, duration):
+        now = datetime.datetime.now()
+        expire_time = now + datetime.timedelta(seconds=duration)
+        try:
+            self.session.add(SQLResolveLease(
+                url=url, owner=owner, expire_time=expire_time))
+            self.session.commit()
+            return True
+        except IntegrityError:
+            self.session.rollback()
+
+        # There's already a lease on this page, but it may have expired,
+        # like if whoever took it crashed.
+        count = self.session.query(SQLResolveLease).\
+            filter(SQLResolveLease.url == url).\
+            filter(SQLResolveLease.expire_time < now).\
+            update({SQLResolveLease.owner: owner,
+                    SQLResolveLease.expire_time: expire_time},
+                   synchronize_session=False)
+        self.session.commit()
+        return count == 1
+
+    def releaseResolveLease(self, url, owner):
+        self.session.query(SQLResolveLease).\
+            filter(SQLResolveLease.url == url).\
+            filter(SQLResolveLease.owner == owner).\
+            delete(synchronize_session=False)
+        self.session.commit()
 
     def pageExists(self, url):
         l = lower_url(url)
@@ -545,13 +746,30 @@ class SQLDatabase(Database):
             yield l.source.url
 
     def _getPageByUrl(self, url, fields):
+        cache_key = None
+        if self._page_caches:
+            gen = self._getPageGeneration()
+            if gen is not None:
+                cache_key = (url, frozenset(fields) if fields else None)
+                for i, cache in enumerate(self._page_caches):
+                    data = cache.get(cache_key, gen)
+                    if data is not None:
+                        # Fill the faster caches that missed.
+                        for c in self._page_caches[:i]:
+                            c.put(cache_key, gen, data)
+                        return SQLDatabasePage(self, None, fields, data=data)
+
         q = self.session.query(SQLPage).\
             filter(SQLPage.url == url)
         q = self._addFieldOptions(q, fields)
         page = q.first()
         if page is None:
             return None
-        return SQLDatabasePage(self, page, fields)
+        page = SQLDatabasePage(self, page, fields)
+        if cache_key is not None:
+            for cache in self._page_caches:
+                cache.put(cache_key, gen, page._data)
+        return page
 
     def _getPageByPath(self, path, fields):
         q = self.session.query(SQLPage).\
@@ -614,6 +832,7 @@ class SQLDatabase(Database):
         po.path = page.path
         po.title = page.title
         po.raw_text = page.raw_text
+        po.content_hash = _get_content_hash(page.raw_text)
         po.formatted_text = page.getFormattedText()
         po.ready_text = None
         po.is_ready = False
@@ -634,6 +853,68 @@ class SQLDatabase(Database):
 
         return po
 
+    def _queryPagesForUpdate(self):
+        return self.session.query(SQLPage).\
+            options(
+                subqueryload('meta'),
+                subqueryload('links'),
+                subqueryload('ready_meta'),
+                subqueryload('ready_links'))
+
+    def _touchIfUnchanged(self, po, page_info):
+        """ If the given page's file has the same contents as what we have
+            in the database, just update its cache time and return `True`,
+            so we don't have to format it all over again. """
+        if (po.content_hash is None or po.path != page_info.path or
+                po.content_hash != _get_content_hash(page_info.content)):
+            return False
+        logger.debug("Page '%s' [%d] hasn't changed." % (po.url, po.id))
+        po.cache_time = datetime.datetime.now()
+        return True
+
+    def _updatePage(self, po, page):
+        """ Updates an existing page in place, so that its ID, and
+            anything that references it, doesn't change. """
+        logger.debug("Updating page '%s' [%d] in SQL database." %
+                     (page.url, po.id))
+
+        po.cache_time = datetime.datetime.now()
+        po.path = page.path
+        po.title = page.title
+        po.raw_text = page.raw_text
+        po.content_hash = _get_content_hash(page.raw_text)
+
+        changed = (po.formatted_text != page.getFormattedText())
+        po.formatted_text = page.getFormattedText()
+
+        new_meta = []
+        for name, value in page.getLocalMeta().items():
+            if isinstance(value, bool):
+                value = ""
+            if isinstance(value, str):
+                new_meta.append((name, value))
+            else:
+                for v in value:
+                    new_meta.append((name, v))
+        old_meta = [(m.name, m.value) for m in po.meta]
+        if _update_list(po.meta, old_meta, new_meta,
+                        lambda m: SQLMeta(m[0], m[1])):
+            changed = True
+
+        old_links = [link.target_url for link in po.links]
+        if _update_list(po.links, old_links, page.getLocalLinks(), SQLLink):
+            changed = True
+
+        # Keep the resolved data if nothing that goes into it changed.
+        if changed:
+            po.ready_text = None
+            po.invalidate_time = None
+            po.is_ready = False
+            del po.ready_meta[:]
+            del po.ready_links[:]
+
+        return po
+
     def saveWantedPages(self, wanted_pages):
         # Delete previously cached wanted pages.
         self.session.query(SQLWantedPage).delete()
@@ -736,11 +1017,32 @@ class SQLDatabase(Database):
         self.session.commit()
 
 
+def _get_content_hash(text):
+    return hashlib.sha1(text.encode('utf8')).hexdigest()
+
+
+def _update_list(db_list, old_values, new_values, factory):
+    # Keep the common start of both lists and replace the rest, so that
+    # we touch as few rows as possible while keeping the order.
+    if old_values == new_values:
+        return False
+    common = 0
+    for old, new in zip(old_values, new_values):
+        if old != new:
+            break
+        common += 1
+    del db_list[common:]
+    for v in new_values[common:]:
+        db_list.append(factory(v))
+    return True
+
+
 class SQLDatabasePage(Page):
     """ A page that can load its properties from a database.
     """
-    def __init__(self, db, db_obj, fields):
-        data = self._loadFromDbObject(db_obj, fields)
+    def __init__(self, db, db_obj, fields, data=None):
+        if data is None:
+            data = self._loadFromDbObject(db_obj, fields)
         super(SQLDatabasePage, self).__init__(db.wiki, data)
 
     @property
@@ -756,6 +1058,10 @@ class SQLDatabasePage(Page):
             data.path = db_obj.path
         if fields is None or 'cache_time' in fields:
             data.cache_time = db_obj.cache_time
+        if fields is None or 'ready_time' in fields:
+            data.ready_time = db_obj.ready_time
+        if fields is None or 'invalidate_time' in fields:
+            data.invalidate_time = db_obj.invalidate_time
         if fields is None or 'is_resolved' in fields:
             data.is_resolved = db_obj.is_ready
         if fields is None or 'title' in fields:
@@ -33,6 +33,11 @@ RE_ESCAPED_LINK = re.compile(
 logger = logging.getLogger(__name__)
 
 
+# Formatting results are cached on disk, keyed on this version. Bump it
+# whenever a change to the formatter changes its output.
+FORMATTER_VERSION = 1
+
+
 class BaseContext(object):
     """ Base context for formatting pages. """
     def __init__(self, url):
@@ -1,5 +1,13 @@
 
 
+def get_timestamp(dt):
+    """ Returns the POSIX timestamp stored in the index for the given
+        date, or 0 if there's none. """
+    if dt is None:
+        return 0
+    return dt.timestamp()
+
+
 class HitResult(object):
     def __init__(self, url, title, hl_text=None):
         self.url = url
@@ -11,6 +19,9 @@ class WikiIndex(object):
     """ The search index for the wiki, allowing the user to run queries
         to find pages.
     """
+    # The page fields to load from the database for indexing pages.
+    page_fields = ['url', 'path', 'title', 'text']
+
     def start(self, wiki):
         """ Called when the wiki is started. """
         pass
@@ -23,9 +34,10 @@ class WikiIndex(object):
         """ Called after a new wiki was created. """
         pass
 
-    def reset(self, pages):
+    def reset(self, pages, page_count=None):
         """ Called when the index should be re-created from scratch
-            based on the given pages. """
+            based on the given pages. `page_count` is the number of
+            pages, if known, since `pages` may be an iterator. """
         pass
 
     def updatePage(self, page):
@@ -38,6 +50,11 @@ class WikiIndex(object):
             updated with the latest information. """
         pass
 
+    def flush(self):
+        """ Called when any buffered updates should be written to the
+            index right away. """
+        pass
+
     def search(self, query):
         raise NotImplementedError()
 
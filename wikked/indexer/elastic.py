@@ -1,7 +1,8 @@
 import os.path
+import hashlib
 import logging
 from elasticsearch import Elasticsearch
-from elasticsearch.helpers import bulk_index
+from elasticsearch.helpers import bulk, scan
 from wikked.indexer.base import HitResult, WikiIndex
 
 
@@ -11,21 +12,31 @@ INDEX_VERSION = 1
 logger = logging.getLogger(__name__)
 
 
+def get_doc_id(url):
+    """ Returns the ID of the document for the page at the given URL,
+        so that indexing a page twice replaces the previous document.
+    """
+    return hashlib.sha1(url.encode('utf8')).hexdigest()
+
+
 class ElasticWikiIndex(WikiIndex):
-    def __init__(self):
+    def __init__(self, config):
         WikiIndex.__init__(self)
+        hosts = config.get('elastic', 'hosts')
+        self.hosts = [h.strip() for h in hosts.split(',') if h.strip()]
+        self.index_name = config.get('elastic', 'index')
 
     def start(self, wiki):
-        self.es = Elasticsearch()
-        if not self.es.indices.exists('pages'):
-            logger.debug("Creating the `pages` index.")
-            self.es.indices.create('pages')
+        self.es = Elasticsearch(self.hosts)
+        if not self.es.indices.exists(self.index_name):
+            logger.debug("Creating the `%s` index." % self.index_name)
+            self.es.indices.create(self.index_name)
 
-    def reset(self, pages):
+    def reset(self, pages, page_count=None):
         logger.debug("Reseting the ElasticSearch index.")
-        self.es.indices.delete('pages')
+        self.es.indices.delete(self.index_name, ignore=404)
         self.es.indices.create(
-                'pages',
+                self.index_name,
                 body={
                     'settings': {
                         'analysis': {
@@ -85,88 +96,53 @@ class ElasticWikiIndex(WikiIndex):
         def action_maker():
             for p in pages:
                 logger.debug("Indexing '%s'..." % p.url)
-                a = {
-                        '_index': 'pages',
-                        '_type': 'page',
-                        '_source': self._get_body(p)
-                        }
-                yield a
+                yield self._getIndexAction(p)
 
-        actions = action_maker()
-        bulk_index(self.es, actions)
+        bulk(self.es, action_maker())
 
     def updatePage(self, page):
-        body = {
-                'fields': ['url'],
-                'query': {'term': {'url': page.url}}}
-        docs = self.es.search(index='pages', doc_type='page', body=body)
-        docs = list(docs)
-        if len(docs) > 0:
-            self.es.delete(index='pages', doc_type='page', id=docs[0]['_id'])
-        self.es.index(index='page', doc_type='page', body=self._get_body(page))
+        # Documents are keyed by URL, so this replaces any previous
+        # document for that page in one request.
+        logger.debug("Indexing '%s'..." % page.url)
+        bulk(self.es, [self._getIndexAction(page)])
 
     def updateAll(self, pages):
-        to_reindex = set()
-        already_indexed = set()
-
-        offset = 0
-        bucket_size = 100
-        while True:
-            logger.debug("Grabbing documents %d to %d..." % (offset, offset + bucket_size))
-            body = {
-                    'fields': ['url', 'path', 'time'],
-                    'from': offset,
-                    'size': bucket_size,
-                    'query': {
-                        'match_all': {}
-                        }
+        # Grab the path and time of all indexed documents in one scroll.
+        logger.debug("Grabbing indexed documents...")
+        indexed = {}
+        body = {
+                '_source': ['url', 'path', 'time'],
+                'query': {
+                    'match_all': {}
                     }
-            docs = self.es.search(
-                    index='pages',
-                    doc_type='page',
-                    body=body)
-            total = docs['hits']['total']
-
-            for d in docs['hits']['hits']:
-                indexed_path = d['fields']['path']
-                indexed_time = d['fields']['time']
-
-                if not os.path.isfile(indexed_path):
-                    # File was deleted.
-                    self.es.delete(
-                            index='pages',
-                            doc_type='page',
-                            id=d['_id'])
-                else:
-                    already_indexed.add(indexed_path)
-                    if os.path.getmtime(indexed_path) > indexed_time:
-                        # File has changed since last index.
-                        to_reindex.add(indexed_path)
-
-            if offset + bucket_size < total:
-                offset += bucket_size
-            else:
-                break
+                }
+        for d in scan(self.es, query=body,
+                      index=self.index_name, doc_type='page'):
+            indexed[d['_id']] = d['_source']
 
         def action_maker():
             for p in pages:
-                if p.path in to_reindex or p.path not in already_indexed:
+                doc = indexed.pop(get_doc_id(p.url), None)
+                if doc is None or os.path.getmtime(p.path) > doc['time']:
                     logger.debug("Reindexing '%s'..." % p.url)
-                    a = {
-                            '_index': 'pages',
-                            '_type': 'page',
-                            '_source': self._get_body(p)
-                            }
-                    yield a
+                    yield self._getIndexAction(p)
+
+            # Whatever's left is for pages that don't exist anymore.
+            for doc_id, doc in indexed.items():
+                logger.debug("Removing '%s' from index..." % doc['url'])
+                yield {
+                        '_op_type': 'delete',
+                        '_index': self.index_name,
+                        '_type': 'page',
+                        '_id': doc_id
+                        }
 
         logger.debug("Indexing out-of-date pages...")
-        actions = action_maker()
-        bulk_index(self.es, actions)
+        bulk(self.es, action_maker())
 
     def previewSearch(self, query):
         body = {
-                'explain': True,
-                'fields': ['title_preview', 'url'],
+                '_source': ['url'],
                 'query': {
                     'query_string': {
                         'fields': ['title_preview'],
@@ -183,15 +159,16 @@ class ElasticWikiIndex(WikiIndex):
                     }
                 }
         res = self.es.search(
-                index='pages',
+                index=self.index_name,
                 doc_type='page',
                 body=body)
         for h in res['hits']['hits']:
-            yield HitResult(h['fields']['url'], h['highlight']['title_preview'])
+            yield HitResult(h['_source']['url'],
+                            h['highlight']['title_preview'])
 
     def search(self, query, highlight=False):
         body = {
-                'fields': ['url', 'title', 'text'],
+                '_source': ['url', 'title'],
                 'query': {
                     'query_string': {
                         'fields': ['title', 'text'],
@@ -210,15 +187,23 @@ class ElasticWikiIndex(WikiIndex):
                     }
                 }
         res = self.es.search(
-                index='pages',
+                index=self.index_name,
                 doc_type='page',
                 body=body)
         for h in res['hits']['hits']:
-            yield HitResult(h['fields']['url'],
-                            h['fields']['title'],
-                            h['highlight']['text'])
+            yield HitResult(h['_source']['url'],
+                            h['_source']['title'],
+                            h.get('highlight', {}).get('text'))
 
-    def _get_body(self, page):
+    def _getIndexAction(self, page):
+        return {
+                '_index': self.index_name,
+                '_type': 'page',
+                '_id': get_doc_id(page.url),
+                '_source': self._getBody(page)
+                }
+
+    def _getBody(self, page):
         return {
                 'url': page.url,
                 'path': page.path,
@@ -227,4 +212,3 @@ class ElasticWikiIndex(WikiIndex):
                 'title': page.title,
                 'text': page.text
                 }
-
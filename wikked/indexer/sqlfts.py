@@ -0,0 +1,155 @@
+import os
+import os.path
+import re
+import hashlib
+import logging
+from sqlalchemy import text
+from wikked.indexer.base import WikiIndex, HitResult, get_timestamp
+from wikked.utils import strip_html_tags
+
+
+logger = logging.getLogger(__name__)
+
+
+re_query_token = re.compile(r'\w+', re.UNICODE)
+
+
+def get_row_id(url):
+    """ Returns the row ID of the index entry for the page at the given
+        URL, so that indexing a page twice replaces the previous entry.
+    """
+    digest = hashlib.sha1(url.encode('utf8')).digest()
+    return int.from_bytes(digest[:8], 'big', signed=True)
+
+
+def get_fts_query(query, prefix=False, column=None):
+    """ Turns a user query into a safe FTS5 query that matches all the
+        words in it.
+    """
+    tokens = re_query_token.findall(query)
+    if not tokens:
+        return None
+    terms = ['"%s"%s' % (t, '*' if prefix else '') for t in tokens]
+    fts_query = ' '.join(terms)
+    if column:
+        fts_query = '%s: (%s)' % (column, fts_query)
+    return fts_query
+
+
+class SQLFtsWikiIndex(WikiIndex):
+    """ A search index stored in the wiki's SQLite database, using the
+        FTS5 extension. Pages are indexed as they get resolved and
+        cached, in the same transaction.
+    """
+    page_fields = ['url', 'title', 'text', 'ready_time']
+
+    table_name = 'pages_fts'
+
+    def __init__(self):
+        WikiIndex.__init__(self)
+        self.db = None
+
+    def start(self, wiki):
+        self.db = wiki.db
+        if self.db.engine.dialect.name != 'sqlite':
+            raise Exception("The `sqlfts` indexer needs a SQLite database, "
+                            "got: %s" % self.db.engine.dialect.name)
+        # We may be the first ones to touch the database file, like when
+        # a new wiki is created.
+        db_path = self.db.engine.url.database
+        if db_path and db_path != ':memory:':
+            db_dir = os.path.dirname(db_path)
+            if not os.path.isdir(db_dir):
+                os.makedirs(db_dir)
+        self._ensureTable()
+        self.db.page_cached_hooks.append(self._onPageCached)
+
+    def reset(self, pages, page_count=None):
+        # The pages were already indexed by `_onPageCached` while the wiki
+        # was being resolved, so only catch up on the ones that weren't,
+        # and remove the ones that don't exist anymore.
+        logger.info("Updating full-text search table after reset.")
+        self.updateAll(pages)
+
+    # There's no need to override `updatePage`, since edited pages get
+    # indexed by `_onPageCached` when they're resolved again.
+
+    def updateAll(self, pages):
+        logger.info("Updating index...")
+        session = self.db.session
+        indexed_times = {}
+        res = session.execute(text(
+            'SELECT rowid, time FROM %s' % self.table_name))
+        for row in res:
+            indexed_times[row[0]] = row[1]
+
+        for page in pages:
+            row_id = get_row_id(page.url)
+            indexed_time = indexed_times.pop(row_id, None)
+            if (indexed_time is None or
+                    get_timestamp(page.ready_time) > indexed_time):
+                self._indexPage(session, page)
+
+        # Whatever's left is for pages that don't exist anymore.
+        for row_id in indexed_times.keys():
+            session.execute(
+                text('DELETE FROM %s WHERE rowid = :id' % self.table_name),
+                {'id': row_id})
+        session.commit()
+        logger.debug("...done updating index.")
+
+    def previewSearch(self, query):
+        fts_query = get_fts_query(query, prefix=True, column='title')
+        if fts_query is None:
+            return []
+        res = self.db.session.execute(
+            text(
+                "SELECT url, highlight(%(t)s, 1, '<b>', '</b>') "
+                "FROM %(t)s WHERE %(t)s MATCH :query "
+                "ORDER BY rank LIMIT 10" % {'t': self.table_name}),
+            {'query': fts_query})
+        return [HitResult(row[0], row[1]) for row in res]
+
+    def search(self, query, highlight=True):
+        fts_query = get_fts_query(query)
+        if fts_query is None:
+            return []
+        hl_start, hl_end = ('<b>', '</b>') if highlight else ('', '')
+        res = self.db.session.execute(
+            text(
+                "SELECT url, "
+                "highlight(%(t)s, 1, :hl_start, :hl_end), "
+                "snippet(%(t)s, 2, :hl_start, :hl_end, '...', 32) "
+                "FROM %(t)s WHERE %(t)s MATCH :query "
+                "ORDER BY bm25(%(t)s, 0.0, 4.0, 1.0) LIMIT 50" %
+                {'t': self.table_name}),
+            {'query': fts_query, 'hl_start': hl_start, 'hl_end': hl_end})
+        return [HitResult(row[0], row[1], row[2]) for row in res]
+
+    def _ensureTable(self):
+        # The prefix indexes make title previews fast, since they're
+        # prefix queries on partially typed words.
+        self.db.session.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5("
+            "url UNINDEXED, title, text, time UNINDEXED, "
+            "tokenize='porter unicode61 remove_diacritics 1', "
+            "prefix='2 3 4')" % self.table_name))
+        self.db.session.commit()
+
+    def _onPageCached(self, page):
+        # Called by the database before committing the resolved
+        # information of a page, so both are written together.
+        self._indexPage(self.db.session, page)
+
+    def _indexPage(self, session, page):
+        logger.debug("Indexing '%s'." % page.url)
+        session.execute(
+            text(
+                'INSERT OR REPLACE INTO %s (rowid, url, title, text, time) '
+                'VALUES (:id, :url, :title, :text, :time)' %
+                self.table_name),
+            {'id': get_row_id(page.url),
+             'url': page.url,
+             'title': page.title,
+             'text': strip_html_tags(page.text or ''),
+             'time': get_timestamp(page.ready_time)})
@@ -1,7 +1,11 @@
 import os
 import os.path
+import atexit
 import logging
-from .base import WikiIndex, HitResult
+import multiprocessing
+import threading
+from .base import WikiIndex, HitResult, get_timestamp
+from wikked.utils import strip_html_tags
 from whoosh.analysis import (
     StemmingAnalyzer, CharsetFilter, NgramWordAnalyzer)
 from whoosh.fields import Schema, ID, TEXT, STORED
@@ -14,96 +18,353 @@ from whoosh.support.charset import accent_map
 logger = logging.getLogger(__name__)
 
 
+MERGE_POLICIES = {
+    'small': {'merge': True},
+    'optimize': {'optimize': True},
+    'none': {'merge': False}
+    }
+
+
+class _WhooshIndexState(object):
+    """ The state of a Whoosh index directory, shared by all the wiki
+        instances of a process. The web application creates a new wiki
+        for every request, so the searcher and any buffered updates need
+        to outlive them.
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.ix = None
+        self.lock = threading.RLock()
+        self.commit_delay = 0
+        self.commit_limit = 1
+        self.commit_args = MERGE_POLICIES['small']
+        self.optimize_every = 0
+        self._searcher = None
+        self._pending = {}
+        self._timer = None
+        self._commit_count = 0
+
+    def open(self, schema):
+        with self.lock:
+            if not os.path.isdir(self.store_dir):
+                logger.debug("Creating new index in: " + self.store_dir)
+                os.makedirs(self.store_dir)
+                self.recreate(schema)
+            elif self.ix is None:
+                self.ix = open_dir(self.store_dir)
+
+    def recreate(self, schema):
+        """ Drops any buffered updates and the shared searcher, and
+            creates a new empty index. """
+        with self.lock:
+            self._cancelTimer()
+            self._pending = {}
+            self._searcher = None
+            self.ix = create_in(self.store_dir, schema=schema)
+            self._commit_count = 0
+
+    def searcher(self):
+        """ Returns the shared searcher, re-opening it only if the
+            index generation has changed since it was opened. Don't
+            close it when done!
+        """
+        with self.lock:
+            s = self._searcher
+            if s is None or not s.up_to_date():
+                if s is not None:
+                    logger.debug("Index has changed, opening new searcher.")
+                # Searchers are shared between threads, so another one
+                # may still be using the previous searcher. Don't close
+                # it, and let it release its files when it's garbage
+                # collected instead.
+                s = self._searcher = self.ix.searcher()
+            return s
+
+    def writer(self, procs=1, limitmb=128):
+        if procs > 1:
+            # Each sub-process writes its own segment, which we keep as-is
+            # instead of merging them all into one at the end.
+            return self.ix.writer(procs=procs, limitmb=limitmb,
+                                  multisegment=True, timeout=10.0,
+                                  subargs={'limitmb': limitmb})
+        return self.ix.writer(limitmb=limitmb, timeout=10.0)
+
+    def commit(self, writer):
+        """ Commits the given writer using the configured merge policy,
+            and fully optimizes the index every so often. """
+        self._commit_count += 1
+        if (self.optimize_every > 0 and
+                self._commit_count % self.optimize_every == 0):
+            logger.debug("Optimizing index segments.")
+            writer.commit(optimize=True)
+        else:
+            writer.commit(**self.commit_args)
+
+    def queueUpdate(self, url, doc):
+        """ Buffers an update (or a removal if `doc` is `None`) for the
+            page at the given URL. """
+        with self.lock:
+            self._pending[url] = doc
+            if (self.commit_delay <= 0 or
+                    len(self._pending) >= self.commit_limit):
+                self.flush()
+            elif self._timer is None:
+                self._startTimer()
+
+    def flush(self):
+        """ Writes all buffered updates to the index as one segment. If
+            that fails, the updates stay buffered.
+        """
+        with self.lock:
+            self._cancelTimer()
+            if not self._pending:
+                return
+            pending = self._pending
+            self._pending = {}
+
+            logger.debug("Committing %d buffered index updates." %
+                         len(pending))
+            try:
+                writer = self.writer()
+                try:
+                    for url, doc in pending.items():
+                        writer.delete_by_term('url', url)
+                        if doc is not None:
+                            writer.add_document(**doc)
+                except:  # NOQA
+                    writer.cancel()
+                    raise
+                self.commit(writer)
+            except:  # NOQA
+                # Put the updates back, without overwriting any newer
+                # ones that were queued in the meantime.
+                pending.update(self._pending)
+                self._pending = pending
+                raise
+
+    def _onTimer(self):
+        try:
+            self.flush()
+        except Exception as ex:
+            logger.error("Error committing buffered index updates, "
+                         "will try again later: %s" % ex)
+            logger.exception(ex)
+            with self.lock:
+                self._startTimer()
+
+    def _startTimer(self):
+        if self._timer is None and self._pending:
+            self._timer = threading.Timer(self.commit_delay, self._onTimer)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _cancelTimer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+
+index_states = {}
+states_lock = threading.Lock()
+
+
+def get_index_state(store_dir):
+    with states_lock:
+        state = index_states.get(store_dir)
+        if state is None:
+            state = _WhooshIndexState(store_dir)
+            index_states[store_dir] = state
+            if len(index_states) == 1:
+                atexit.register(flush_all_index_states)
+        return state
+
+
+def flush_all_index_states():
+    for state in list(index_states.values()):
+        try:
+            state.flush()
+        except Exception as ex:
+            logger.error("Error flushing index: %s" % state.store_dir)
+            logger.exception(ex)
+
+
 class WhooshWikiIndex(WikiIndex):
-    def __init__(self):
+    PARALLEL_BATCH_SIZE = 100
+
+    page_fields = ['url', 'path', 'title', 'raw_text']
+
+    def __init__(self, config):
         WikiIndex.__init__(self)
+        self.commit_delay = config.getfloat('whoosh', 'commit_delay')
+        self.commit_limit = config.getint('whoosh', 'commit_limit')
+        self.optimize_every = config.getint('whoosh', 'optimize_every')
+        self.procs = config.getint('whoosh', 'procs')
+        if self.procs <= 0:
+            self.procs = multiprocessing.cpu_count()
+        self.limitmb = config.getint('whoosh', 'limitmb')
+        self.index_rendered_text = config.getboolean(
+            'whoosh', 'index_rendered_text')
+        if self.index_rendered_text:
+            self.page_fields = ['url', 'path', 'title', 'text', 'ready_time']
+        merge_policy = config.get('whoosh', 'merge_policy')
+        self.commit_args = MERGE_POLICIES.get(merge_policy)
+        if self.commit_args is None:
+            raise Exception("Unknown Whoosh merge policy '%s', expected "
+                            "one of: %s" %
+                            (merge_policy, ', '.join(MERGE_POLICIES)))
+
+    @property
+    def ix(self):
+        return self._state.ix
 
     def start(self, wiki):
         self.store_dir = os.path.join(wiki.root, '.wiki', 'index')
-        if not os.path.isdir(self.store_dir):
-            logger.debug("Creating new index in: " + self.store_dir)
-            os.makedirs(self.store_dir)
-            self.ix = create_in(self.store_dir, self._getSchema())
-        else:
-            self.ix = open_dir(self.store_dir)
+        self._state = get_index_state(self.store_dir)
+        self._state.commit_delay = self.commit_delay
+        self._state.commit_limit = self.commit_limit
+        self._state.commit_args = self.commit_args
+        self._state.optimize_every = self.optimize_every
+        self._state.open(self._getSchema())
 
-    def reset(self, pages):
+    def reset(self, pages, page_count=None):
         logger.info("Re-creating new index in: " + self.store_dir)
-        self.ix = create_in(self.store_dir, schema=self._getSchema())
-        writer = self.ix.writer()
-        for page in pages:
-            self._indexPage(writer, page)
-        writer.commit()
+        with self._state.lock:
+            self._state.recreate(self._getSchema())
+            # Don't load all the pages just to count them, they're
+            # streamed to the writer.
+            if page_count is None and isinstance(pages, list):
+                page_count = len(pages)
+            procs = self._getWriterProcs(page_count)
+            writer = self._state.writer(procs, self.limitmb)
+            try:
+                for page in pages:
+                    self._indexPage(writer, page)
+            except:  # NOQA
+                writer.cancel()
+                raise
+            writer.commit()
 
     def updatePage(self, page):
         logger.info("Updating index for page: %s" % page.url)
-        writer = self.ix.writer()
-        self._unindexPage(writer, page.url)
-        self._indexPage(writer, page)
-        writer.commit()
+        self._state.queueUpdate(page.url, self._getDocument(page))
 
     def updateAll(self, pages):
         logger.info("Updating index...")
+        with self._state.lock:
+            self._state.flush()
+            searcher = self._state.searcher()
+            if self.index_rendered_text:
+                to_unindex, to_index = self._getOutdatedByReadyTime(
+                    searcher, pages)
+            else:
+                to_unindex, to_index = self._getOutdatedByFileTime(
+                    searcher, pages)
+            if not to_unindex and not to_index:
+                logger.debug("...index is up to date.")
+                return
+
+            procs = self._getWriterProcs(len(to_index))
+            writer = self._state.writer(procs, self.limitmb)
+            try:
+                for url in to_unindex:
+                    self._unindexPage(writer, url)
+                for page in to_index:
+                    self._indexPage(writer, page)
+            except:  # NOQA
+                writer.cancel()
+                raise
+            self._state.commit(writer)
+        logger.debug("...done updating index.")
+
+    def flush(self):
+        """ Writes any buffered page updates to the index. """
+        self._state.flush()
+
+    def _getWriterProcs(self, page_count):
+        # Only spawn worker processes if there's enough work to give each
+        # of them, since each one leaves its own segment in the index.
+        # When we don't know how much work there is, use them all.
+        if (page_count is not None and
+                page_count < self.procs * self.PARALLEL_BATCH_SIZE):
+            return 1
+        return self.procs
+
+    def _getOutdatedByFileTime(self, searcher, pages):
         to_reindex = set()
         already_indexed = set()
+        to_unindex = []
+        for fields in searcher.all_stored_fields():
+            indexed_url = fields['url']
+            indexed_path = fields['path']
+            indexed_time = fields['time']
 
-        with self.ix.searcher() as searcher:
-            writer = self.ix.writer()
-
-            for fields in searcher.all_stored_fields():
-                indexed_url = fields['url']
-                indexed_path = fields['path']
-                indexed_time = fields['time']
-
-                if not os.path.isfile(indexed_path):
-                    # File was deleted.
-                    self._unindexPage(writer, indexed_url)
-                else:
-                    already_indexed.add(indexed_path)
-                    if os.path.getmtime(indexed_path) > indexed_time:
-                        # File has changed since last index.
-                        self._unindexPage(writer, indexed_url)
-                        to_reindex.add(indexed_path)
-
-            for page in pages:
-                if page.path in to_reindex or page.path not in already_indexed:
-                    self._indexPage(writer, page)
+            if not os.path.isfile(indexed_path):
+                # File was deleted.
+                to_unindex.append(indexed_url)
+            else:
+                already_indexed.add(indexed_path)
+                if os.path.getmtime(indexed_path) > indexed_time:
+                    # File has changed since last index.
+                    to_unindex.append(indexed_url)
+                    to_reindex.add(indexed_path)
 
-            writer.commit()
-        logger.debug("...done updating index.")
+        to_index = [
+            page for page in pages
+            if page.path in to_reindex or page.path not in already_indexed]
+        return to_unindex, to_index
+
+    def _getOutdatedByReadyTime(self, searcher, pages):
+        # The resolve time of a page changes whenever the page or any of
+        # the pages it includes or queries change, so we don't need to
+        # look at the file-system at all.
+        indexed_times = {}
+        for fields in searcher.all_stored_fields():
+            indexed_times[fields['url']] = fields['time']
+
+        to_unindex = []
+        to_index = []
+        for page in pages:
+            indexed_time = indexed_times.pop(page.url, None)
+            if indexed_time is None:
+                to_index.append(page)
+            elif get_timestamp(page.ready_time) > indexed_time:
+                to_unindex.append(page.url)
+                to_index.append(page)
+        # Whatever is left is for pages that don't exist anymore.
+        to_unindex += list(indexed_times.keys())
+        return to_unindex, to_index
 
     def previewSearch(self, query):
-        with self.ix.searcher() as searcher:
-            title_qp = QueryParser(
-                "title_preview", self.ix.schema).parse(query)
-            results = searcher.search(title_qp)
-            results.fragmenter = WholeFragmenter()
-
-            hits = []
-            for result in results:
-                hit = HitResult(
-                    result['url'],
-                    result.highlights('title_preview', text=result['title']))
-                hits.append(hit)
-            return hits
+        searcher = self._state.searcher()
+        title_qp = QueryParser("title_preview", self.ix.schema).parse(query)
+        results = searcher.search(title_qp)
+        results.fragmenter = WholeFragmenter()
+
+        hits = []
+        for result in results:
+            hit = HitResult(
+                result['url'],
+                result.highlights('title_preview', text=result['title']))
+            hits.append(hit)
+        return hits
 
     def search(self, query, highlight=True):
-        with self.ix.searcher() as searcher:
-            title_qp = QueryParser("title", self.ix.schema).parse(query)
-            text_qp = QueryParser("text", self.ix.schema).parse(query)
-            comp_query = title_qp | text_qp
-            results = searcher.search(comp_query)
-            if not highlight:
-                results.formatter = UppercaseFormatter()
-
-            hits = []
-            for result in results:
-                hit = HitResult(
-                        result['url'],
-                        result.highlights('title') or result['title'],
-                        result.highlights('text'))
-                hits.append(hit)
-            return hits
+        searcher = self._state.searcher()
+        title_qp = QueryParser("title", self.ix.schema).parse(query)
+        text_qp = QueryParser("text", self.ix.schema).parse(query)
+        comp_query = title_qp | text_qp
+        results = searcher.search(comp_query)
+        if not highlight:
+            results.formatter = UppercaseFormatter()
+
+        hits = []
+        for result in results:
+            hit = HitResult(
+                    result['url'],
+                    result.highlights('title') or result['title'],
+                    result.highlights('text'))
+            hits.append(hit)
+        return hits
 
     def _getSchema(self):
         preview_analyzer = NgramWordAnalyzer(minsize=2)
@@ -119,16 +380,25 @@ class WhooshWikiIndex(WikiIndex):
                 )
         return schema
 
+    def _getDocument(self, page):
+        if self.index_rendered_text:
+            text = strip_html_tags(page.text or '')
+            time = get_timestamp(page.ready_time)
+        else:
+            text = page.raw_text
+            time = os.path.getmtime(page.path)
+        return {
+            'url': page.url,
+            'title_preview': page.title,
+            'title': page.title,
+            'text': text,
+            'path': page.path,
+            'time': time
+            }
+
     def _indexPage(self, writer, page):
         logger.debug("Indexing '%s'." % page.url)
-        writer.add_document(
-            url=page.url,
-            title_preview=page.title,
-            title=page.title,
-            text=page.raw_text,
-            path=page.path,
-            time=os.path.getmtime(page.path)
-            )
+        writer.add_document(**self._getDocument(page))
 
     def _unindexPage(self, writer, url):
         logger.debug("Removing '%s' from index." % url)
@@ -1,8 +1,10 @@
 import os
 import os.path
 import re
+import json
 import logging
-from .formatter import PageFormatter, FormattingContext
+from .formatter import (
+        PageFormatter, FormattingContext, FORMATTER_VERSION)
 
 
 logger = logging.getLogger(__name__)
@@ -36,6 +38,9 @@ class PageData(object):
         self.url = None
         self.path = None
         self.cache_time = None
+        self.ready_time = None
+        self.invalidate_time = None
+        self.is_stale = False
         self.title = None
         self.raw_text = None
         self.formatted_text = None
@@ -66,10 +71,22 @@ class Page(object):
     def cache_time(self):
         return self._data.cache_time
 
+    @property
+    def ready_time(self):
+        return self._data.ready_time
+
     @property
     def is_resolved(self):
         return self._data.is_resolved
 
+    @property
+    def invalidate_time(self):
+        return self._data.invalidate_time
+
+    @property
+    def is_stale(self):
+        return self._data.is_stale
+
     @property
     def extension(self):
         if self._data.path is None:
@@ -150,12 +167,18 @@ class FileSystemPage(Page):
         data.cache_time = None
         data.raw_text = page_info.content
 
-        # Format the page and get the meta properties.
-        ctx = FormattingContext(page_info.url)
-        f = PageFormatter()
-        data.formatted_text = f.formatText(ctx, data.raw_text)
-        data.local_meta = ctx.meta
-        data.local_links = ctx.out_links
+        # Format the page and get the meta properties. This only depends
+        # on the page's text and URL, so it can be cached on disk, which
+        # saves a lot of time when the whole database gets rebuilt.
+        format_cache = getattr(wiki, 'format_cache', None)
+        if format_cache is not None:
+            key = ('format', str(FORMATTER_VERSION), page_info.url,
+                   data.raw_text)
+            formatted = json.loads(format_cache.getOrCreate(
+                key, lambda: json.dumps(self._formatText(data))))
+        else:
+            formatted = self._formatText(data)
+        data.formatted_text, data.local_meta, data.local_links = formatted
 
         # Add some common meta.
         data.title = data.local_meta.get('title')
@@ -168,6 +191,12 @@ class FileSystemPage(Page):
 
         return data
 
+    def _formatText(self, data):
+        ctx = FormattingContext(data.url)
+        f = PageFormatter()
+        formatted_text = f.formatText(ctx, data.raw_text)
+        return [formatted_text, ctx.meta, ctx.out_links]
+
 
 class WantedPage:
     def __init__(self, url, wanted_by):
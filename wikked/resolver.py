@@ -1,7 +1,9 @@
 import re
+import copy
 import os.path
 import urllib.parse
 import logging
+import threading
 import jinja2
 from wikked.formatter import PageFormatter, FormattingContext
 from wikked.endpoint import SPECIAL_ENDPOINT
@@ -81,6 +83,29 @@ class ResolveContext(object):
         self.url_trail = []
         if root_page:
             self.url_trail.append(root_page.url)
+        self._trail_checks = []
+
+    def isInUrlTrail(self, url):
+        """ Returns whether the given URL is in the URL trail, and
+            remembers that the current include depends on it. """
+        if self._trail_checks:
+            self._trail_checks[-1].add(url)
+        return url in self.url_trail
+
+    def startTrailChecks(self):
+        self._trail_checks.append(set())
+
+    def endTrailChecks(self):
+        """ Returns the URLs checked against the URL trail since the
+            matching call to `startTrailChecks`. """
+        checks = self._trail_checks.pop()
+        if self._trail_checks:
+            self._trail_checks[-1] |= checks
+        return checks
+
+    def addTrailChecks(self, checks):
+        if self._trail_checks:
+            self._trail_checks[-1] |= checks
 
     def shouldRunMeta(self, modifier):
         if modifier is None:
@@ -106,7 +131,11 @@ class ResolveOutput(object):
         self.meta = {}
         self.out_links = []
         if page:
-            self.meta = dict(page.getLocalMeta())
+            # Copy the lists of values, since we'll add values from
+            # included pages to them.
+            self.meta = dict(
+                    (k, list(v) if isinstance(v, list) else v)
+                    for k, v in page.getLocalMeta().items())
 
     def add(self, other):
         for original_key, val in other.meta.items():
@@ -123,6 +152,96 @@ class ResolveOutput(object):
                 self.meta[key] += [v for v in val if v not in existing_metas]
 
 
+def get_include_url(url, base_url, templates_url, page_exists):
+    """ Returns the absolute URL of a page included as `url` from the page
+        at `base_url`. Relative URLs are first looked up in the templates
+        endpoint.
+    """
+    if url[0] == '/':
+        return url
+    include_url = get_absolute_url(templates_url, url)
+    if not page_exists(include_url):
+        include_url = get_absolute_url(base_url, url)
+    return include_url
+
+
+def _freeze_parameters(value):
+    if isinstance(value, dict):
+        return tuple(sorted(
+            (k, _freeze_parameters(v)) for k, v in value.items()))
+    if isinstance(value, list):
+        return tuple(_freeze_parameters(v) for v in value)
+    return value
+
+
+class ResolveMemo(object):
+    """ A cache of resolved includes and queries, shared by all the
+        resolvers of a resolve run, so that a template included by many
+        pages is only resolved once per set of parameters, and a query
+        used by many pages only looks for matching pages once.
+
+        An included page's output can also depend on the URL trail, e.g.
+        when it runs queries or includes other pages. So each entry
+        remembers which URLs were checked against the trail while it was
+        resolved, and is only re-used if the current trail agrees on all
+        of them.
+    """
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.query_hits = 0
+        self.query_misses = 0
+        self._includes = {}
+        self._query_matches = {}
+        self._query_items = {}
+        self._lock = threading.Lock()
+
+    def getInclude(self, key, url_trail):
+        """ Returns a copy of the cached output for the given include,
+            along with the URLs it checked against the trail, or `None`.
+        """
+        with self._lock:
+            for checks, in_trail, output in self._includes.get(key, []):
+                if _get_trail_hits(url_trail, checks) == in_trail:
+                    self.hits += 1
+                    return copy.deepcopy(output), checks
+            self.misses += 1
+        return None
+
+    def putInclude(self, key, url_trail, checks, output):
+        entry = (checks, _get_trail_hits(url_trail, checks),
+                 copy.deepcopy(output))
+        with self._lock:
+            self._includes.setdefault(key, []).append(entry)
+
+    def getQueryMatches(self, key, func):
+        """ Returns the pages matching the given query, calling `func`
+            to find them if needed. Pages in the URL trail are not
+            excluded, so the same matches work for all pages. """
+        with self._lock:
+            matches = self._query_matches.get(key)
+            if matches is not None:
+                self.query_hits += 1
+                return matches
+            self.query_misses += 1
+        matches = func()
+        with self._lock:
+            self._query_matches[key] = matches
+        return matches
+
+    def getQueryItem(self, key):
+        with self._lock:
+            return self._query_items.get(key)
+
+    def putQueryItem(self, key, text):
+        with self._lock:
+            self._query_items[key] = text
+
+
+def _get_trail_hits(url_trail, checks):
+    return frozenset(u for u in url_trail if u in checks)
+
+
 class PageResolver(object):
     """ An object responsible for resolving page queries like
         `include` or `query`.
@@ -135,13 +254,15 @@ class PageResolver(object):
         }
 
     def __init__(self, page, ctx=None, parameters=None, page_getter=None,
-                 pages_meta_getter=None, can_use_resolved_meta=False):
+                 pages_meta_getter=None, can_use_resolved_meta=False,
+                 memo=None, local_only=False):
         self.page = page
         self.ctx = ctx or ResolveContext(page)
         self.parameters = parameters
         self.page_getter = page_getter or self._getPage
         self.pages_meta_getter = pages_meta_getter or self._getPagesMeta
         self.can_use_resolved_meta = can_use_resolved_meta
+        self.memo = memo
         self.output = None
         self.env = None
 
@@ -149,6 +270,10 @@ class PageResolver(object):
                 'query': self._runQuery,
                 'include': self._runInclude
                 }
+        if local_only:
+            # Only run the final steps on the page's own text, leaving
+            # out includes and queries.
+            self.resolvers = {}
 
     @property
     def wiki(self):
@@ -290,18 +415,12 @@ class PageResolver(object):
         # Get the included page. First, try with a page in the special
         # `templates` endpoint, if the included page is not specified with an
         # absolute path.
-        include_url = opts['url']
-        if include_url[0] != '/':
-            include_url = self.ctx.getAbsoluteUrl(
-                    include_url,
-                    self.page.wiki.templates_url)
-            if not self.wiki.pageExists(include_url):
-                include_url = self.ctx.getAbsoluteUrl(opts['url'],
-                                                      self.page.url)
-        # else: include URL is absolute.
+        include_url = get_include_url(
+                opts['url'], self.page.url, self.wiki.templates_url,
+                self.wiki.pageExists)
 
         # Check for circular includes.
-        if include_url in self.ctx.url_trail:
+        if self.ctx.isInUrlTrail(include_url):
             raise CircularIncludeError(include_url, self.page.url,
                                        self.ctx.url_trail)
 
@@ -333,9 +452,7 @@ class PageResolver(object):
             raise IncludeError(include_url, self.page.url, "Page not found")
         current_url_trail = list(self.ctx.url_trail)
         self.ctx.url_trail.append(page.url)
-        child = PageResolver(page, self.ctx, parameters, self.page_getter,
-                             self.pages_meta_getter)
-        child_output = child.run()
+        child_output = self._resolveInclude(page, parameters)
         self.output.add(child_output)
         self.ctx.url_trail = current_url_trail
 
@@ -345,6 +462,34 @@ class PageResolver(object):
 
         return text
 
+    def _resolveInclude(self, page, parameters):
+        if self.memo is None:
+            child = PageResolver(page, self.ctx, parameters, self.page_getter,
+                                 self.pages_meta_getter)
+            return child.run()
+
+        # The parameters are only used if the included page itself
+        # includes other pages.
+        params_key = None
+        if '<div class="wiki-include"' in page.getFormattedText():
+            params_key = _freeze_parameters(parameters)
+        key = (page.url, params_key)
+        cached = self.memo.getInclude(key, self.ctx.url_trail)
+        if cached is not None:
+            child_output, checks = cached
+            self.ctx.addTrailChecks(checks)
+            return child_output
+
+        self.ctx.startTrailChecks()
+        try:
+            child = PageResolver(page, self.ctx, parameters, self.page_getter,
+                                 self.pages_meta_getter, memo=self.memo)
+            child_output = child.run()
+        finally:
+            checks = self.ctx.endTrailChecks()
+        self.memo.putInclude(key, self.ctx.url_trail, checks, child_output)
+        return child_output
+
     def _runQuery(self, opts, query):
         # Should we even run this query?
         if 'mod' in opts:
@@ -363,19 +508,14 @@ class PageResolver(object):
 
         # Find pages that match the query, excluding any page
         # that is in the URL trail.
-        matched_pages = []
-        logger.debug("Running page query: %s" % meta_query)
-        for p in self.pages_meta_getter():
-            if p.url in self.ctx.url_trail:
-                continue
-            for key, value in meta_query.items():
-                try:
-                    if self._isPageMatch(p, key, value):
-                        matched_pages.append(p)
-                except Exception as e:
-                    logger.error("Can't query page '%s' for '%s':" % (
-                            p.url, self.page.url))
-                    logger.exception(e.message)
+        if self.memo is not None:
+            query_key = tuple(sorted(meta_query.items()))
+            all_matched_pages = self.memo.getQueryMatches(
+                    query_key, lambda: self._findQueryMatches(meta_query))
+        else:
+            all_matched_pages = self._findQueryMatches(meta_query)
+        matched_pages = [p for p in all_matched_pages
+                         if not self.ctx.isInUrlTrail(p.url)]
 
         # We'll have to format things...
         fmt_ctx = FormattingContext(self.page.url)
@@ -400,13 +540,7 @@ class PageResolver(object):
         text = tpl_header
         add_trailing_line = tpl_item[-1] == "\n"
         for p in matched_pages:
-            tokens = {
-                    'url': p.url,
-                    'title': p.title}
-            page_local_meta = flatten_single_metas(dict(p.getLocalMeta()))
-            tokens.update(page_local_meta)
-            text += self._renderTemplate(
-                    tpl_item, tokens, error_url=item_url or self.page.url)
+            text += self._renderQueryItem(p, tpl_item, item_url)
             if add_trailing_line:
                 # Jinja2 eats trailing new lines... :(
                 text += "\n"
@@ -414,6 +548,40 @@ class PageResolver(object):
 
         return text
 
+    def _findQueryMatches(self, meta_query):
+        matched_pages = []
+        logger.debug("Running page query: %s" % meta_query)
+        for p in self.pages_meta_getter():
+            for key, value in meta_query.items():
+                try:
+                    if self._isPageMatch(p, key, value):
+                        matched_pages.append(p)
+                except Exception as e:
+                    logger.error("Can't query page '%s' for '%s':" % (
+                            p.url, self.page.url))
+                    logger.exception(e)
+        return matched_pages
+
+    def _renderQueryItem(self, page, tpl_item, item_url):
+        # The item only depends on the template and the page's properties,
+        # so the same page listed by many queries can be rendered once.
+        if self.memo is not None:
+            text = self.memo.getQueryItem((tpl_item, page.url))
+            if text is not None:
+                return text
+
+        tokens = {
+                'url': page.url,
+                'title': page.title}
+        page_local_meta = flatten_single_metas(dict(page.getLocalMeta()))
+        tokens.update(page_local_meta)
+        text = self._renderTemplate(
+                tpl_item, tokens, error_url=item_url or self.page.url)
+
+        if self.memo is not None:
+            self.memo.putQueryItem((tpl_item, page.url), text)
+        return text
+
     def _valueOrPageText(self, value, with_url=False):
         stripped_value = value.strip()
         if re_wiki_query_template_ref.match(stripped_value):
@@ -487,14 +655,8 @@ class PageResolver(object):
             pipe_idx = v.find('|')
             if pipe_idx > 0:
                 v = v[:pipe_idx]
-
-            if v[0] != '/':
-                include_url = self.ctx.getAbsoluteUrl(
-                        v, self.page.wiki.templates_url)
-                if not self.wiki.pageExists(include_url):
-                    include_url = self.ctx.getAbsoluteUrl(v, page.url)
-
-            included_urls.append(include_url)
+            included_urls.append(get_include_url(
+                v, page.url, self.wiki.templates_url, self.wiki.pageExists))
 
         # Recurse into included pages.
         for url in included_urls:
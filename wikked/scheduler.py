@@ -1,11 +1,16 @@
 import os.path
 import logging
 import datetime
+import itertools
 import threading
 import jinja2
-from queue import Queue, Empty
+from queue import Queue, PriorityQueue, Empty
+from collections import deque
 from repoze.lru import LRUCache
-from wikked.resolver import PageResolver, ResolveOutput, CircularIncludeError
+from wikked.resolver import (
+        PageResolver, ResolveOutput, ResolveMemo, IncludeError,
+        CircularIncludeError, get_include_url)
+from wikked.utils import lower_url
 
 
 logger = logging.getLogger(__name__)
@@ -16,18 +21,44 @@ class ResolveScheduler(object):
         multi-threaded way.
     """
     PAGE_REGISTRY_SIZE = 256
+    MAX_RETRIES = 2
 
-    def __init__(self, wiki, page_urls, registry_size=None):
+    def __init__(self, wiki, page_urls, registry_size=None,
+                 priority_urls=None, progress_callback=None,
+                 max_retries=None):
         self.wiki = wiki
         self.page_urls = page_urls
-
-        self._cache = LRUCache(registry_size or self.PAGE_REGISTRY_SIZE)
+        self.priority_urls = set(priority_urls or [])
+        self.progress_callback = progress_callback
+        self.max_retries = max_retries
+        if self.max_retries is None:
+            self.max_retries = self.MAX_RETRIES
+
+        self.registry_size = registry_size or self.PAGE_REGISTRY_SIZE
+        self._cache = LRUCache(self.registry_size)
         self._pages_meta = None
+        self.memo = ResolveMemo()
+        self.circular_urls = []
+        self.failed_urls = []
 
         self._queue = None
         self._results = None
         self._pool = None
         self._done = False
+        self._job_ids = None
+        self._cancelled = threading.Event()
+
+    @property
+    def is_cancelled(self):
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        """ Stops resolving pages. The pages currently being resolved are
+            finished, but the other ones are left unresolved. This can be
+            called from any thread, including from the progress callback.
+        """
+        logger.debug("Cancelling resolve scheduler.")
+        self._cancelled.set()
 
     def getPage(self, url):
         page = self._cache.get(url)
@@ -45,64 +76,207 @@ class ResolveScheduler(object):
             self._pages_meta = list(self.wiki.db.getPages(fields=fields))
         return self._pages_meta
 
+    def getResolveOrder(self):
+        """ Returns the URLs of the pages to resolve, with each page coming
+            after the pages it includes. Pages with circular includes, or
+            including such pages, come last, and are also stored in
+            `circular_urls`.
+        """
+        urls = list(self.page_urls)
+        if len(urls) < 2:
+            return urls
+
+        # Build the graph of includes between the pages we resolve. When
+        # resolving a few pages, only load those, through the registry
+        # since we'll need them again soon. Otherwise, load them all at
+        # once.
+        if len(urls) <= self.registry_size:
+            pages = [self.getPage(u) for u in urls]
+        else:
+            pages = self.getPagesMeta()
+
+        urls_by_key = dict((lower_url(u), u) for u in urls)
+        templates_url = self.wiki.templates_url
+        known_urls = {}
+
+        def page_exists(url):
+            exists = known_urls.get(url)
+            if exists is None:
+                exists = lower_url(url) in urls_by_key
+                if not exists:
+                    exists = self.wiki.db.pageExists(url)
+                known_urls[url] = exists
+            return exists
+
+        dependents = dict((u, []) for u in urls)
+        dep_counts = dict((u, 0) for u in urls)
+        for p in pages:
+            if p.url not in dep_counts:
+                continue
+            include_urls = set()
+            for key in ['include', '+include', '__include']:
+                values = p.getLocalMeta(key)
+                if not isinstance(values, list):
+                    continue
+                for v in values:
+                    v = str(v).split('|', 1)[0].strip()
+                    if not v:
+                        continue
+                    include_url = urls_by_key.get(lower_url(get_include_url(
+                        v, p.url, templates_url, page_exists)))
+                    if include_url is not None:
+                        include_urls.add(include_url)
+            for include_url in include_urls:
+                dependents[include_url].append(p.url)
+                dep_counts[p.url] += 1
+
+        # Resolve leaf pages first, then the pages including them, etc.
+        order = []
+        ready = deque(u for u in urls if dep_counts[u] == 0)
+        while ready:
+            url = ready.popleft()
+            order.append(url)
+            for dep_url in dependents[url]:
+                dep_counts[dep_url] -= 1
+                if dep_counts[dep_url] == 0:
+                    ready.append(dep_url)
+
+        self.circular_urls = [u for u in urls if dep_counts[u] > 0]
+        if self.circular_urls:
+            logger.warning("Found circular includes in pages: %s" %
+                           ', '.join(self.circular_urls))
+            order += self.circular_urls
+        return order
+
+    def resolvePage(self, url, raise_on_failure=True):
+        """ Resolves the given page, and returns it. """
+        page = self.getPage(url)
+        r = PageResolver(
+                page,
+                page_getter=self.getPage,
+                pages_meta_getter=self.getPagesMeta,
+                memo=self.memo)
+        runner = PageResolverRunner(page, r)
+        runner.run(raise_on_failure=raise_on_failure)
+        return page
+
     def run(self, num_workers=1):
         logger.info("Running resolve scheduler (%d workers)" % num_workers)
+        page_urls = self.getResolveOrder()
+        # Pages requested by users go first, but otherwise keep the
+        # resolve order.
+        page_urls.sort(key=lambda u: u not in self.priority_urls)
+        self._cancelled.clear()
+        self.failed_urls = []
 
         if num_workers > 1:
             # Multi-threaded resolving.
             logger.debug("Main thread is %d" % threading.get_ident())
 
             self._done = False
-            self._queue = Queue()
+            self._queue = PriorityQueue()
             self._results = Queue()
 
             self.getPagesMeta()
 
-            job_count = 0
-            for url in self.page_urls:
-                self._queue.put_nowait(JobDesc(url))
-                job_count += 1
+            self._job_ids = itertools.count()
+            for url in page_urls:
+                self.queueJob(JobDesc(url))
 
             self._pool = []
             for i in range(num_workers):
-                ctx = JobContext(self)
-                self._pool.append(JobWorker(i, ctx))
-
-            for thread in self._pool:
-                thread.start()
-
-            while job_count > 0:
-                try:
-                    url, page, exc = self._results.get(True, 10)
-                except Empty:
-                    logger.error("Resolve workers timed out, still have %d "
-                                 "jobs to go." % job_count)
-                    return
-
-                job_count -= 1
-                if page:
-                    self.wiki.db.cachePage(page)
-                if exc:
-                    logger.error("Error resolving page: %s" % url)
-                    logger.exception(exc)
+                self._pool.append(self._startWorker(i))
 
-            logger.debug("Queue is empty... terminating workers.")
-            self._done = True
-
-            for thread in self._pool:
-                thread.join()
-                logger.debug("Worker [%d] ended." % thread.wid)
+            try:
+                self._waitForResults(len(page_urls))
+            except KeyboardInterrupt:
+                self.cancel()
+                raise
+            finally:
+                logger.debug("Terminating workers.")
+                self._done = True
+                for thread in self._pool:
+                    thread.join()
+                    logger.debug("Worker [%d] ended." % thread.wid)
         else:
             # Single-threaded resolving.
-            for url in self.page_urls:
-                page = self.getPage(url)
-                r = PageResolver(
-                        page,
-                        page_getter=self.getPage,
-                        pages_meta_getter=self.getPagesMeta)
-                runner = PageResolverRunner(page, r)
-                runner.run(raise_on_failure=True)
+            total = len(page_urls)
+            for i, url in enumerate(page_urls):
+                if self.is_cancelled:
+                    break
+                page = None
+                for attempt in range(self.max_retries + 1):
+                    try:
+                        page = self.resolvePage(url)
+                        break
+                    except Exception as ex:
+                        if (attempt >= self.max_retries or
+                                not is_retryable_error(ex)):
+                            logger.error("Error resolving page: %s" % url)
+                            logger.exception(ex)
+                            self.failed_urls.append(url)
+                            break
+                        logger.warning("Error resolving page '%s', "
+                                       "retrying: %s" % (url, ex))
+                if page is not None:
+                    self.wiki.db.cachePage(page)
+                self._reportProgress(i + 1, total)
+
+        if self.is_cancelled:
+            logger.info("Resolve scheduler was cancelled.")
+
+    def queueJob(self, job):
+        # Jobs are run by priority, and then in the order they were
+        # queued.
+        priority = 0 if job.url in self.priority_urls else 1
+        self._queue.put_nowait((priority, next(self._job_ids), job))
+
+    def _waitForResults(self, total):
+        job_count = total
+        while job_count > 0 and not self.is_cancelled:
+            try:
+                url, page, exc = self._results.get(True, 1)
+            except Empty:
+                # Nothing came back for a while, so make sure our workers
+                # are still around.
+                self._superviseWorkers()
+                continue
+
+            job_count -= 1
+            if page:
                 self.wiki.db.cachePage(page)
+            if exc:
+                logger.error("Error resolving page: %s" % url)
+                logger.exception(exc)
+                self.failed_urls.append(url)
+            self._reportProgress(total - job_count, total)
+
+    def _startWorker(self, wid):
+        thread = JobWorker(wid, JobContext(self))
+        thread.start()
+        return thread
+
+    def _superviseWorkers(self):
+        for i, thread in enumerate(self._pool):
+            if thread.is_alive():
+                continue
+            logger.error("Resolve worker [%d] died, replacing it." %
+                         thread.wid)
+            job = thread.current_job
+            if job is not None:
+                thread.ctx.retryOrFail(
+                        job, Exception("Resolve worker died."))
+            self._pool[i] = self._startWorker(thread.wid)
+
+    def _reportProgress(self, done, total):
+        if self.progress_callback is not None:
+            self.progress_callback(done, total)
+
+
+def is_retryable_error(exception):
+    """ Returns whether resolving a page again could fix the given error.
+        Include errors, like circular includes, will fail again. """
+    return not isinstance(exception, IncludeError)
 
 
 class PageResolverRunner(object):
@@ -143,6 +317,7 @@ class PageResolverRunner(object):
 class JobDesc(object):
     def __init__(self, url):
         self.url = url
+        self.attempts = 0
 
 
 class JobContext(object):
@@ -151,7 +326,7 @@ class JobContext(object):
         self.abort_on_failure = True
 
     def isDone(self):
-        return self.scheduler._done
+        return self.scheduler._done or self.scheduler.is_cancelled
 
     def getJob(self):
         return self.scheduler._queue.get(True, 0.5)
@@ -161,12 +336,28 @@ class JobContext(object):
         self.scheduler._results.put_nowait(res)
         self.scheduler._queue.task_done()
 
+    def retryOrFail(self, job, exception):
+        """ Queues the given job again, unless it already failed too many
+            times, in which case the failure is reported. """
+        if (job.attempts >= self.scheduler.max_retries or
+                not is_retryable_error(exception)):
+            self.sendResult(job.url, None, exception)
+            return
+
+        job.attempts += 1
+        logger.warning("Error resolving page '%s', retrying (%d/%d): %s" %
+                       (job.url, job.attempts, self.scheduler.max_retries,
+                        exception))
+        self.scheduler.queueJob(job)
+        self.scheduler._queue.task_done()
+
 
 class JobWorker(threading.Thread):
     def __init__(self, wid, ctx):
         super(JobWorker, self).__init__(daemon=True)
         self.wid = wid
         self.ctx = ctx
+        self.current_job = None
 
     def run(self):
         logger.debug("Starting worker on thread %d" % threading.get_ident())
@@ -177,33 +368,32 @@ class JobWorker(threading.Thread):
             logger.critical("Aborting resolver worker.")
 
     def _unsafeRun(self):
-        while True:
+        while not self.ctx.isDone():
             try:
-                job = self.ctx.getJob()
+                _, _, job = self.ctx.getJob()
             except Empty:
-                if self.ctx.isDone():
-                    break
                 continue
+            if self.ctx.isDone():
+                # We got cancelled while waiting for a job.
+                self.ctx.scheduler._queue.task_done()
+                break
+
+            self.current_job = job
             logger.debug("[%d] -> %s" % (self.wid, job.url))
             before = datetime.datetime.now()
 
             try:
-                page = self.ctx.scheduler.getPage(job.url)
-                r = PageResolver(
-                        page,
-                        page_getter=self.ctx.scheduler.getPage,
-                        pages_meta_getter=self.ctx.scheduler.getPagesMeta)
-                runner = PageResolverRunner(page, r)
-                runner.run(raise_on_failure=self.ctx.abort_on_failure)
+                page = self.ctx.scheduler.resolvePage(
+                        job.url,
+                        raise_on_failure=self.ctx.abort_on_failure)
                 self.ctx.sendResult(job.url, page, None)
             except Exception as ex:
                 logger.exception(ex)
-                logger.error("Error resolving page: %s" % job.url)
-                self.ctx.sendResult(job.url, None, ex)
-                return
+                self.ctx.retryOrFail(job, ex)
+            finally:
+                self.current_job = None
 
             after = datetime.datetime.now()
             delta = after - before
             logger.debug("[%d] %s done in %fs" % (
                     self.wid, job.url, delta.total_seconds()))
-
@@ -63,11 +63,12 @@ class Author(object):
 
 
 class FileRevision:
-    def __init__(self, path=None, action=None):
+    def __init__(self, path=None, action=None, url=None):
         self.path = path
         self.action = action
         if action is None:
             self.action = ACTION_OTHER
+        self.url = url
 
 
 class Revision(object):
@@ -87,8 +88,8 @@ class Revision(object):
     def is_committed(self):
         return self.rev_id != -1
 
-    def addFile(self, path, action=None):
-        self.files.append(FileRevision(path, action))
+    def addFile(self, path, action=None, url=None):
+        self.files.append(FileRevision(path, action, url))
 
 
 class SourceControlError(Exception):
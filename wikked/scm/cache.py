@@ -0,0 +1,22 @@
+import re
+from wikked.cache import DiskCache
+
+
+re_full_rev = re.compile(r'^([0-9a-f]{40}|[0-9a-f]{64})$')
+
+
+def is_immutable_rev(rev):
+    """ Returns whether the given revision ID always points to the same
+        revision. Full hashes do, but things like `tip`, `HEAD`, local
+        revision numbers or short hashes may not.
+    """
+    return rev is not None and re_full_rev.match(rev) is not None
+
+
+class RevisionCache(DiskCache):
+    """ A disk cache for things computed from committed revisions, like
+        the text of a file at a given revision, or a diff between two
+        revisions. Those never change, so entries can be keyed on the
+        revision ID.
+    """
+    pass
@@ -1,9 +1,11 @@
 import os
 import os.path
 import logging
-import subprocess
+import threading
+from repoze.lru import LRUCache
 from .base import (
-        SourceControl,
+        SourceControl, Author, Revision, SourceControlError,
+        ACTION_ADD, ACTION_DELETE, ACTION_EDIT,
         STATE_NEW, STATE_MODIFIED, STATE_COMMITTED)
 
 try:
@@ -16,41 +18,49 @@ except ImportError:
 logger = logging.getLogger(__name__)
 
 
+# Commits never change, so we can cache what we compute from them (mostly
+# the list of changed files, which needs a tree diff) for the lifetime of
+# the process, across all the wikis that get created for each request.
+HISTORY_CACHE_SIZE = 4096
+history_cache = LRUCache(HISTORY_CACHE_SIZE)
+repo_lock = threading.Lock()
+
+
 class GitBaseSourceControl(SourceControl):
     def __init__(self, root):
         SourceControl.__init__(self)
         self.root = root
 
     def start(self, wiki):
+        self._doStart()
+
+    def init(self, wiki):
         # Make a Git repo if there's none.
         if not os.path.isdir(os.path.join(self.root, '.git')):
             logger.info("Creating Git repository at: " + self.root)
             self._initRepo(self.root)
 
+        self._doStart()
+
         # Create a `.gitignore` file there's none.
         ignore_path = os.path.join(self.root, '.gitignore')
         if not os.path.isfile(ignore_path):
             logger.info("Creating `.gitignore` file.")
             with open(ignore_path, 'w') as f:
                 f.write('.wiki')
-            self._add(ignore_path)
-            self._commit('Created .gitignore.', [ignore_path])
+            self.commit([ignore_path], {'message': "Created `.gitignore`."})
 
-    def getSpecialFilenames(self):
-        specials = ['.git', '.gitignore']
-        return [os.path.join(self.root, d) for d in specials]
+    def _doStart(self):
+        pass
 
-    def getState(self, path):
-        return self._status(path)
+    def _initRepo(self, path):
+        raise NotImplementedError()
+
+    def getSpecialFilenames(self):
+        return ['.git', '.gitignore']
 
-    def _run(self, cmd, *args, **kwargs):
-        exe = [self.git]
-        if 'norepo' not in kwargs or not kwargs['norepo']:
-            exe.append('--git-dir="%s"' % self.root)
-        exe.append(cmd)
-        exe += args
-        logger.debug("Running Git: " + str(exe))
-        return subprocess.check_output(exe)
+    def _getRepoPath(self, path):
+        return os.path.relpath(path, self.root).replace('\\', '/')
 
 
 class GitLibSourceControl(GitBaseSourceControl):
@@ -59,22 +69,63 @@ class GitLibSourceControl(GitBaseSourceControl):
             raise Exception(
                     "Can't support Git because pygit2 is not available.")
         GitBaseSourceControl.__init__(self, root)
+        self.repo = None
+        self.fs = None
+        self.actions = {
+                pygit2.GIT_DELTA_ADDED: ACTION_ADD,
+                pygit2.GIT_DELTA_DELETED: ACTION_DELETE,
+                pygit2.GIT_DELTA_MODIFIED: ACTION_EDIT
+                }
 
-    def initRepo(self, wiki):
-        GitBaseSourceControl.initRepo(self, wiki)
+    def start(self, wiki):
+        self.fs = wiki.fs
+        GitBaseSourceControl.start(self, wiki)
+
+    def init(self, wiki):
+        self.fs = wiki.fs
+        GitBaseSourceControl.init(self, wiki)
+
+    def _doStart(self):
         self.repo = pygit2.Repository(self.root)
 
     def _initRepo(self, path):
         pygit2.init_repository(path, False)
 
-    def _add(self, paths):
-        pass
-
-    def _commit(self, message, paths):
-        pass
+    def getHistory(self, path=None, limit=10, after_rev=None):
+        if self.repo.head_is_unborn:
+            return []
+
+        repo_path = None
+        if path is not None:
+            repo_path = self._getRepoPath(path)
+
+        # Skip commits until we get past `after_rev`, instead of walking
+        # from its parent, so that we return the same revisions as if we
+        # had asked for a bigger limit in the first place.
+        skipping = bool(after_rev)
+        revisions = []
+        walker = self.repo.walk(
+                self.repo.head.target,
+                pygit2.GIT_SORT_TOPOLOGICAL | pygit2.GIT_SORT_TIME)
+        for commit in walker:
+            if skipping:
+                if str(commit.id).startswith(after_rev):
+                    skipping = False
+                continue
+            rev = self._getCachedRevision(commit)
+            if repo_path is not None:
+                if not any([f.path == repo_path for f in rev.files]):
+                    continue
+            revisions.append(rev)
+            if limit and len(revisions) >= limit:
+                break
+        return revisions
 
-    def _status(self, path):
-        flags = self.repo.status_file(self._getRepoPath(path))
+    def getState(self, path):
+        try:
+            flags = self.repo.status_file(self._getRepoPath(path))
+        except KeyError:
+            return STATE_NEW
         if flags == pygit2.GIT_STATUS_CURRENT:
             return STATE_COMMITTED
         if (flags & pygit2.GIT_STATUS_WT_MODIFIED or
@@ -85,6 +136,118 @@ class GitLibSourceControl(GitBaseSourceControl):
             return STATE_NEW
         raise Exception("Unsupported status flag combination: %s" % flags)
 
-    def _getRepoPath(self, path):
-        return os.path.relpath(path, self.root).replace('\\', '/')
-
+    def getRevision(self, path, rev):
+        commit = self._getCommit(rev)
+        try:
+            blob = commit.tree[self._getRepoPath(path)]
+        except KeyError:
+            raise SourceControlError(
+                    'cat', "No such file in revision %s: %s" % (rev, path),
+                    None, None)
+        return blob.data.decode('utf8')
+
+    def diff(self, path, rev1, rev2):
+        if rev2 is None:
+            # Changes introduced by `rev1`.
+            commit = self._getCommit(rev1)
+            diff = self._diffToParent(commit)
+        else:
+            diff = self.repo.diff(self._getCommit(rev1),
+                                  self._getCommit(rev2))
+
+        if path is None:
+            return diff.patch or ''
+
+        repo_path = self._getRepoPath(path)
+        patches = []
+        for patch in diff:
+            if (patch.delta.new_file.path == repo_path or
+                    patch.delta.old_file.path == repo_path):
+                patches.append(patch.text)
+        return ''.join(patches)
+
+    def commit(self, paths, op_meta):
+        if 'message' not in op_meta or not op_meta['message']:
+            raise ValueError("No commit message specified.")
+
+        with repo_lock:
+            index = self.repo.index
+            index.read()
+            for path in paths:
+                repo_path = self._getRepoPath(path)
+                if os.path.exists(path):
+                    index.add(repo_path)
+                else:
+                    index.remove(repo_path)
+            index.write()
+            tree_id = index.write_tree()
+
+            signature = self._getSignature(op_meta.get('author'))
+            parents = []
+            if not self.repo.head_is_unborn:
+                parents.append(self.repo.head.target)
+            self.repo.create_commit(
+                    'HEAD', signature, signature, op_meta['message'],
+                    tree_id, parents)
+
+    def revert(self, paths=None):
+        kwargs = {}
+        if paths is not None:
+            kwargs['paths'] = [self._getRepoPath(p) for p in paths]
+        self.repo.checkout_head(strategy=pygit2.GIT_CHECKOUT_FORCE, **kwargs)
+
+    def _getSignature(self, author):
+        # Git needs both a name and an email, so fill in whatever is
+        # missing from the repository's configuration, if any.
+        try:
+            default = self.repo.default_signature
+            name, email = default.name, default.email
+        except (KeyError, pygit2.GitError):
+            name, email = 'Wikked', 'wikked@localhost'
+        if author:
+            author = Author(author)
+            name = author.name
+            email = author.email or email
+        return pygit2.Signature(name, email)
+
+    def _getCommit(self, rev):
+        try:
+            return self.repo.revparse_single(rev).peel(pygit2.Commit)
+        except (KeyError, ValueError) as ex:
+            raise SourceControlError('revparse', str(ex), rev, None)
+
+    def _diffToParent(self, commit):
+        if commit.parents:
+            return self.repo.diff(commit.parents[0], commit)
+        # Root commit: diff against the empty tree.
+        return commit.tree.diff_to_tree(swap=True)
+
+    def _getCachedRevision(self, commit):
+        key = (self.root, str(commit.id))
+        rev = history_cache.get(key)
+        if rev is None:
+            rev = self._makeRevision(commit)
+            history_cache.put(key, rev)
+        return rev
+
+    def _makeRevision(self, commit):
+        rev = Revision(str(commit.id))
+        rev.rev_name = str(commit.id)[:12]
+        rev.author = Author(commit.author.name, commit.author.email or None)
+        rev.timestamp = float(commit.author.time)
+        rev.description = commit.message.rstrip('\n')
+        for delta in self._diffToParent(commit).deltas:
+            action = self.actions.get(delta.status)
+            if delta.status == pygit2.GIT_DELTA_DELETED:
+                path = delta.old_file.path
+            else:
+                path = delta.new_file.path
+            rev.addFile(path, action, self._getPageUrl(path))
+        return rev
+
+    def _getPageUrl(self, path):
+        page_info = self.fs.getPageInfo(
+                os.path.join(self.root, path.replace('/', os.sep)))
+        if page_info is not None:
+            return page_info.url
+        return None
@@ -0,0 +1,167 @@
+import os
+import os.path
+import logging
+import contextlib
+import sqlite3
+import threading
+from .base import Author, Revision, FileRevision
+
+
+logger = logging.getLogger(__name__)
+
+
+def _get_author_string(author):
+    if author is None:
+        return None
+    if author.email is None:
+        return author.name
+    return str(author)
+
+
+class RevisionStore(object):
+    """ A persistent index of a repository's revisions, stored in a small
+        SQLite database next to the wiki's cache. Source control backends
+        append new revisions to it as they show up, so that reading the
+        history doesn't need to go through the source control tool.
+    """
+    schema_version = 1
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._checked_schema = False
+
+    def getTip(self):
+        """ Returns the index and ID of the last stored revision, or
+            `(-1, None)` if the store is empty. """
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT idx, rev_id FROM revisions '
+                'ORDER BY idx DESC LIMIT 1').fetchone()
+        if row is None:
+            return -1, None
+        return row[0], row[1]
+
+    def addRevisions(self, revisions, clear=False):
+        """ Stores the given `(index, revision)` pairs. Revisions already
+            in the store are skipped. If `clear` is set, the existing
+            revisions are dropped first. """
+        count = 0
+        with self._lock, self._connect() as conn:
+            if clear:
+                logger.debug("Clearing revision store.")
+                conn.execute('DELETE FROM files')
+                conn.execute('DELETE FROM revisions')
+            for idx, rev in revisions:
+                cur = conn.execute(
+                    'INSERT OR IGNORE INTO revisions '
+                    '(idx, rev_id, rev_name, author, timestamp, description) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (idx, rev.rev_id, rev.rev_name,
+                     _get_author_string(rev.author),
+                     rev.timestamp, rev.description))
+                if cur.rowcount != 1:
+                    continue
+                conn.executemany(
+                    'INSERT INTO files (idx, path, action, url) '
+                    'VALUES (?, ?, ?, ?)',
+                    [(idx, f.path, f.action, f.url) for f in rev.files])
+                count += 1
+        if count > 0:
+            logger.debug("Added %d revisions to the revision store." % count)
+        return count
+
+    def getHistory(self, path=None, limit=10, after_rev=None):
+        """ Returns the stored revisions, most recent first. If `path` is
+            given, only the revisions touching that repository-relative
+            path are returned, and without their list of files. """
+        query = 'SELECT r.idx, r.rev_id, r.rev_name, r.author, ' \
+                'r.timestamp, r.description FROM revisions r'
+        where = []
+        params = []
+        if path is not None:
+            query += ' JOIN files f ON f.idx = r.idx'
+            where.append('f.path = ?')
+            params.append(path)
+        if after_rev:
+            where.append('r.idx < (SELECT idx FROM revisions '
+                         'WHERE rev_id LIKE ? ORDER BY idx LIMIT 1)')
+            params.append(after_rev + '%')
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += ' ORDER BY r.idx DESC'
+        if limit:
+            query += ' LIMIT ?'
+            params.append(limit)
+
+        with self._connect() as conn:
+            rows = conn.execute(query, params).fetchall()
+
+            revisions = []
+            revisions_by_idx = {}
+            for row in rows:
+                rev = Revision(row[1])
+                rev.rev_name = row[2]
+                rev.author = Author(row[3])
+                rev.timestamp = row[4]
+                rev.description = row[5]
+                revisions.append(rev)
+                revisions_by_idx[row[0]] = rev
+
+            if path is None and revisions_by_idx:
+                file_rows = conn.execute(
+                    'SELECT idx, path, action, url FROM files '
+                    'WHERE idx IN (%s) ORDER BY rowid' %
+                    ', '.join('?' * len(revisions_by_idx)),
+                    list(revisions_by_idx.keys()))
+                for idx, fpath, action, url in file_rows:
+                    revisions_by_idx[idx].files.append(
+                        FileRevision(fpath, action, url))
+
+        return revisions
+
+    @contextlib.contextmanager
+    def _connect(self):
+        if not self._checked_schema:
+            self._ensureSchema()
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _ensureSchema(self):
+        dirname = os.path.dirname(self.path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            with conn:
+                version = conn.execute('PRAGMA user_version').fetchone()[0]
+                if version != self.schema_version:
+                    logger.debug("Creating revision store: %s" % self.path)
+                    conn.execute('DROP TABLE IF EXISTS files')
+                    conn.execute('DROP TABLE IF EXISTS revisions')
+                    conn.execute(
+                        'CREATE TABLE revisions ('
+                        'idx INTEGER PRIMARY KEY, '
+                        'rev_id TEXT UNIQUE, '
+                        'rev_name TEXT, '
+                        'author TEXT, '
+                        'timestamp REAL, '
+                        'description TEXT)')
+                    conn.execute(
+                        'CREATE TABLE files ('
+                        'idx INTEGER REFERENCES revisions(idx), '
+                        'path TEXT, '
+                        'action INTEGER, '
+                        'url TEXT)')
+                    conn.execute('CREATE INDEX files_idx ON files(idx)')
+                    conn.execute('CREATE INDEX files_path ON files(path)')
+                    conn.execute('PRAGMA user_version = %d' %
+                                 self.schema_version)
+        finally:
+            conn.close()
+        self._checked_schema = True
@@ -1,17 +1,18 @@
 import re
 import os
 import os.path
-import time
 import logging
 import tempfile
+import contextlib
 import threading
 import subprocess
-from hglib.error import CommandError
+from hglib.error import CommandError, ServerError
 from hglib.util import cmdbuilder
 from .base import (
         SourceControl, Author, Revision, SourceControlError,
         ACTION_ADD, ACTION_EDIT, ACTION_DELETE,
         STATE_NEW, STATE_MODIFIED, STATE_COMMITTED)
+from .history import RevisionStore
 
 
 logger = logging.getLogger(__name__)
@@ -19,6 +20,13 @@ logger = logging.getLogger(__name__)
 
 re_rev = re.compile(r'^[0-9a-f]+$')
 
+# Fields are separated by `\x1f`, file names by `\x1e`, and revisions
+# by `\x1d`, so we don't need to worry about what's in the descriptions.
+HG_LOG_TEMPLATE = (
+        r'{rev}\x1f{node}\x1f{author}\x1f{date|hgdate}\x1f{desc}\x1f'
+        r'{join(file_adds, "\x1e")}\x1f{join(file_dels, "\x1e")}\x1f'
+        r'{join(file_mods, "\x1e")}\x1d')
+
 
 class MercurialBaseSourceControl(SourceControl):
     def __init__(self, root):
@@ -29,8 +37,11 @@ class MercurialBaseSourceControl(SourceControl):
                 'R': ACTION_DELETE,
                 'M': ACTION_EDIT
                 }
+        self.fs = None
+        self.history_store = None
 
     def start(self, wiki):
+        self._startHistoryStore(wiki)
         self._doStart()
 
     def init(self, wiki):
@@ -39,6 +50,7 @@ class MercurialBaseSourceControl(SourceControl):
             logger.info("Creating Mercurial repository at: " + self.root)
             self._initRepo(self.root)
 
+        self._startHistoryStore(wiki)
         self._doStart()
 
         # Create a `.hgignore` file is there's none.
@@ -55,39 +67,83 @@ class MercurialBaseSourceControl(SourceControl):
     def getSpecialFilenames(self):
         return ['.hg*']
 
-
-class MercurialSourceControl(MercurialBaseSourceControl):
-    def __init__(self, root):
-        MercurialBaseSourceControl.__init__(self, root)
-
-        self.hg = 'hg'
-        self.log_style = os.path.join(os.path.dirname(__file__),
-                                      'resources', 'hg_log.style')
-
     def getHistory(self, path=None, limit=10, after_rev=None):
-        if path is not None:
-            st_out = self._run('status', path)
-            if len(st_out) > 0 and st_out[0] == '?':
-                return []
+        if after_rev and not re_rev.match(after_rev):
+            raise ValueError("Invalid revision ID: %s" % after_rev)
 
-        log_args = []
+        self._updateHistoryStore()
         if path is not None:
-            log_args.append(path)
-        log_args += ['--style', self.log_style]
-        log_args += ['-l', limit]
-        if after_rev:
-            if not re_rev.match(after_rev):
-                raise ValueError("Invalid revision ID: %s" % after_rev)
-            log_args += ['-r', 'reverse(:%s^)' % after_rev]
-        log_out = self._run('log', *log_args)
-
+            path = os.path.relpath(path, self.root).replace(os.sep, '/')
+        return self.history_store.getHistory(path, limit, after_rev)
+
+    def _startHistoryStore(self, wiki):
+        self.fs = wiki.fs
+        self.history_store = RevisionStore(
+                os.path.join(self.root, '.wiki', 'history.db'))
+
+    def _updateHistoryStore(self):
+        # Only fetch the revisions we don't know about yet. We also get
+        # back the last one we stored, to check that the history hasn't
+        # been rewritten (stripped, rolled back, etc.) in the meantime.
+        tip_idx, tip_id = self.history_store.getTip()
+        if tip_id is not None:
+            try:
+                revisions = self._getLogRevisions('%s:' % tip_id)
+            except SourceControlError:
+                revisions = []
+            if (len(revisions) > 0 and revisions[0][0] == tip_idx and
+                    revisions[0][1].rev_id == tip_id):
+                self.history_store.addRevisions(revisions[1:])
+                return
+            logger.info("Repository history has changed, re-building the "
+                        "revision store.")
+
+        revisions = self._getLogRevisions('all()')
+        self.history_store.addRevisions(revisions, clear=True)
+
+    def _getLogRevisions(self, revrange):
+        log_out = self._getLog(revrange)
         revisions = []
-        for group in log_out.split("$$$\n"):
+        for group in log_out.split('\x1d'):
             if group == '':
                 continue
             revisions.append(self._parseRevision(group))
         return revisions
 
+    def _parseRevision(self, group):
+        (idx, node, author, date, desc,
+         adds, dels, mods) = group.split('\x1f')
+
+        rev = Revision(node)
+        rev.rev_name = node[:12]
+        rev.author = Author(author)
+        rev.timestamp = float(date.split(' ')[0])
+        rev.description = desc
+        for files, action in [(adds, ACTION_ADD), (dels, ACTION_DELETE),
+                              (mods, ACTION_EDIT)]:
+            if files == '':
+                continue
+            for path in files.split('\x1e'):
+                rev.addFile(path, action, self._getPageUrl(path))
+        return int(idx), rev
+
+    def _getPageUrl(self, path):
+        page_info = self.fs.getPageInfo(
+                os.path.join(self.root, path.replace('/', os.sep)))
+        if page_info is not None:
+            return page_info.url
+        return None
+
+    def _getLog(self, revrange):
+        raise NotImplementedError()
+
+
+class MercurialSourceControl(MercurialBaseSourceControl):
+    def __init__(self, root):
+        MercurialBaseSourceControl.__init__(self, root)
+
+        self.hg = 'hg'
+
     def getState(self, path):
         st_out = self._run('status', path)
         if len(st_out) > 0:
@@ -112,28 +168,27 @@ class MercurialSourceControl(MercurialBaseSourceControl):
         if 'message' not in op_meta or not op_meta['message']:
             raise ValueError("No commit message specified.")
 
-        # Check if any of those paths needs to be added.
-        st_out = self._run('status', *paths)
-        add_paths = []
-        for line in st_out.splitlines():
-            if line[0] == '?':
-                add_paths.append(line[2:])
-        if len(add_paths) > 0:
-            self._run('add', *paths)
-
-        # Create a temp file with the commit message.
+        # Create a temp file with the commit message, and another one
+        # with the list of files, so that big commits don't run into
+        # command line length limits.
         f, temp = tempfile.mkstemp()
         with os.fdopen(f, 'w') as fd:
             fd.write(op_meta['message'])
+        f, temp_list = tempfile.mkstemp()
+        with os.fdopen(f, 'w', encoding='utf8') as fd:
+            fd.write('\n'.join(paths))
 
-        # Commit and clean up the temp file.
+        # Commit and clean up the temp files. We use `--addremove` so
+        # that any new files get added in the same call.
         try:
-            commit_args = list(paths) + ['-l', temp]
+            commit_args = ['-A', '-l', temp]
             if 'author' in op_meta:
                 commit_args += ['-u', op_meta['author']]
+            commit_args.append('listfile:' + temp_list)
             self._run('commit', *commit_args)
         finally:
             os.remove(temp)
+            os.remove(temp_list)
 
     def revert(self, paths=None):
         if paths is not None:
@@ -152,35 +207,12 @@ class MercurialSourceControl(MercurialBaseSourceControl):
                     "run 'wk init --git'." % self.hg)
         self._run('init', path, norepo=True)
 
-    def _parseRevision(self, group):
-        lines = group.split("\n")
-
-        m = re.match(r'(\d+) ([0-9a-f]+) \[([^\]]+)\] ([^ ]+)', lines[0])
-        if m is None:
-            raise Exception('Error parsing history from Mercurial, got: ' +
-                            lines[0])
-
-        rev = Revision()
-        rev.rev_id = int(m.group(1))
-        rev.rev_name = rev.rev_id[:12]
-        rev.rev_hash = m.group(2)
-        rev.author = Author(m.group(3))
-        rev.timestamp = float(m.group(4))
-
-        i = 1
-        rev.description = ''
-        while lines[i] != '---':
-            if i > 1:
-                rev.description += "\n"
-            rev.description += lines[i]
-            i += 1
-
-        for j in range(i + 1, len(lines)):
-            if lines[j] == '':
-                continue
-            rev.addFile(lines[j][2:], self.actions.get(lines[j][0]))
-
-        return rev
+    def _getLog(self, revrange):
+        try:
+            return self._run('log', '-r', revrange,
+                             '--template', HG_LOG_TEMPLATE)
+        except subprocess.CalledProcessError as e:
+            raise SourceControlError('log', str(e), e.cmd, _s(e.output))
 
     def _run(self, cmd, *args, **kwargs):
         exe = [self.hg]
@@ -193,10 +225,6 @@ class MercurialSourceControl(MercurialBaseSourceControl):
         return _s(out)
 
 
-hg_client = None
-cl_lock = threading.Lock()
-
-
 def _b(strs):
     """ Convert a list of strings to binary UTF8 arrays. """
     if strs is None:
@@ -215,25 +243,152 @@ def _s(strs):
     return list([s.decode('utf8') if s is not None else None for s in strs])
 
 
-def create_hg_client(root):
-    logger.debug("Spawning Mercurial command server at: %s" % root)
-    import hglib
-    global hg_client
-    hg_client = hglib.open(root)
-
-    def shutdown_commandserver(num, frame):
-        global hg_client
-        if hg_client is not None:
-            with cl_lock:
-                if hg_client is not None:
-                    logger.debug("Shutting down Mercurial command server.")
-                    hg_client.close()
-                    hg_client = None
+HG_POOL_SIZE = 4
+HG_POOL_TIMEOUT = 30
+
+# Errors that mean a command server is dead or its pipes are broken, as
+# opposed to `CommandError`, which is just Mercurial failing a command.
+BROKEN_CLIENT_ERRORS = (ServerError, OSError)
+
+
+class HgClientPool(object):
+    """ A pool of Mercurial command servers for a repository. Each thread
+        checks out its own client for the duration of a command, so they
+        don't have to share the same pipe. Clients that died are thrown
+        away and replaced with new ones.
+    """
+    def __init__(self, root, size=HG_POOL_SIZE):
+        self.root = root
+        self.size = max(1, size)
+        self._idle = []
+        self._count = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout=HG_POOL_TIMEOUT):
+        with self._cond:
+            while True:
+                while self._idle:
+                    client = self._idle.pop()
+                    if _is_client_alive(client):
+                        return client
+                    logger.debug("Discarding dead Mercurial command server.")
+                    self._count -= 1
+                    _close_client(client)
+                if self._count < self.size:
+                    self._count += 1
+                    break
+                if not self._cond.wait(timeout):
+                    raise Exception(
+                            "Timed out waiting for a Mercurial command "
+                            "server for: %s" % self.root)
+
+        try:
+            return self._createClient()
+        except:  # NOQA
+            with self._cond:
+                self._count -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, client, broken=False):
+        with self._cond:
+            if broken or self._closed or not _is_client_alive(client):
+                self._count -= 1
+                _close_client(client)
+            else:
+                self._idle.append(client)
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def checkout(self):
+        client = self.acquire()
+        broken = False
+        try:
+            yield client
+        except BROKEN_CLIENT_ERRORS:
+            broken = True
+            raise
+        finally:
+            self.release(client, broken)
+
+    def run(self, func, retry=True):
+        """ Runs `func` with a client from the pool. If the client turns
+            out to be dead, it's replaced and `func` is run again, unless
+            `retry` is `False` (e.g. for commands that change things).
+        """
+        try:
+            with self.checkout() as client:
+                return func(client)
+        except BROKEN_CLIENT_ERRORS as ex:
+            if not retry:
+                raise
+            logger.warning("Mercurial command server failed (%s), "
+                           "restarting it." % ex)
+        with self.checkout() as client:
+            return func(client)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            clients = self._idle
+            self._idle = []
+            self._count -= len(clients)
+        if clients:
+            logger.debug("Shutting down %d Mercurial command servers." %
+                         len(clients))
+        for client in clients:
+            _close_client(client)
+
+    def _createClient(self):
+        logger.debug("Spawning Mercurial command server at: %s" % self.root)
+        import hglib
+        return hglib.open(self.root)
+
+
+def _is_client_alive(client):
+    server = client.server
+    return (server is not None and server.poll() is None and
+            not server.stdin.closed)
+
+
+def _close_client(client):
+    try:
+        if client.server is not None:
+            client.close()
+    except Exception as ex:
+        logger.debug("Error closing Mercurial command server: %s" % ex)
+
+
+hg_pools = {}
+pools_lock = threading.Lock()
+
+
+def get_hg_pool(root, size=HG_POOL_SIZE):
+    with pools_lock:
+        pool = hg_pools.get(root)
+        if pool is None:
+            pool = HgClientPool(root, size)
+            hg_pools[root] = pool
+            if len(hg_pools) == 1:
+                _register_shutdown()
+        return pool
+
+
+def shutdown_hg_pools(num=None, frame=None):
+    with pools_lock:
+        pools = list(hg_pools.values())
+        hg_pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+def _register_shutdown():
     import atexit
-    atexit.register(shutdown_commandserver, None, None)
+    atexit.register(shutdown_hg_pools)
     try:
         import signal
-        signal.signal(signal.SIGTERM, shutdown_commandserver)
+        signal.signal(signal.SIGTERM, shutdown_hg_pools)
     except:  # NOQA
         # `mod_wsgi` prevents adding stuff to `SIGTERM`
         # so let's not make a big deal if this doesn't
@@ -242,65 +397,36 @@ def create_hg_client(root):
 
 
 class MercurialCommandServerSourceControl(MercurialBaseSourceControl):
-    def __init__(self, root, client=None):
+    def __init__(self, root, client=None, pool_size=HG_POOL_SIZE):
         MercurialBaseSourceControl.__init__(self, root)
         self._client = client
+        self._client_lock = threading.Lock()
+        self.pool_size = pool_size
 
     def _initRepo(self, root):
         exe = ['hg', 'init', root]
         logger.debug("Running Mercurial: " + str(exe))
         return subprocess.check_output(exe)
 
-    @property
-    def client(self):
-        if self._client is None:
-            if hg_client is None:
-                with cl_lock:
-                    if hg_client is None:
-                        create_hg_client(self.root)
-                self._client = hg_client
-            else:
-                logger.debug("Re-using existing Mercurial command server.")
-                self._client = hg_client
-        return self._client
-
-    def getHistory(self, path=None, limit=10, after_rev=None):
-        if path is not None:
-            status = _s(self.client.status(include=_b([path])))
-            if len(status) > 0 and status[0] == '?':
-                return []
-
-        rev = None
-        if after_rev:
-            if not re_rev.match(after_rev):
-                raise ValueError("Invalid revision ID: %s" % after_rev)
-            rev = 'reverse(:%s^)' % after_rev
-
-        needs_files = False
-        if path is not None:
-            repo_revs = self.client.log(files=_b([path]), follow=True,
-                                        limit=limit, revrange=_b(rev))
-        else:
-            needs_files = True
-            repo_revs = self.client.log(follow=True, limit=limit,
-                                        revrange=_b(rev))
-        revisions = []
-        for rev in repo_revs:
-            r = Revision(_s(rev.node))
-            r.rev_name = _s(rev.node[:12])
-            r.author = Author(_s(rev.author))
-            r.timestamp = time.mktime(rev.date.timetuple())
-            r.description = _s(rev.desc)
-            if needs_files:
-                rev_statuses = self.client.status(change=rev.node)
-                for rev_status in rev_statuses:
-                    r.addFile(_s(rev_status[1]),
-                              self.actions.get(_s(rev_status[0])))
-            revisions.append(r)
-        return revisions
+    def _runClient(self, func, retry=True):
+        if self._client is not None:
+            # We were given a specific client, so just use that one.
+            with self._client_lock:
+                return func(self._client)
+        pool = get_hg_pool(self.root, self.pool_size)
+        return pool.run(func, retry=retry)
+
+    def _getLog(self, revrange):
+        args = cmdbuilder(b'log', r=_b(revrange),
+                          template=_b(HG_LOG_TEMPLATE))
+        try:
+            return _s(self._runClient(lambda c: c.rawcommand(args)))
+        except CommandError as e:
+            raise SourceControlError('log', str(e), _s(e.args), _s(e.out))
 
     def getState(self, path):
-        statuses = self.client.status(include=_b([path]))
+        statuses = self._runClient(
+                lambda c: c.status(include=_b([path])))
         if len(statuses) == 0:
             return STATE_COMMITTED
         status = _s(statuses[0])
@@ -311,16 +437,22 @@ class MercurialCommandServerSourceControl(MercurialBaseSourceControl):
         raise Exception("Unsupported status: %s" % status)
 
     def getRevision(self, path, rev):
-        return _s(self.client.cat(_b([path]), rev=_b(rev)))
+        return _s(self._runClient(
+            lambda c: c.cat(_b([path]), rev=_b(rev))))
 
     def diff(self, path, rev1, rev2):
         if path is None:
-            return _s(self.client.diff(change=rev1, git=True))
-        if rev2 is None:
-            return _s(self.client.diff(files=_b([path]), change=rev1,
-                                       git=True))
-        return _s(self.client.diff(files=_b([path]), revs=[rev1, rev2],
-                                   git=True))
+            out = self._runClient(
+                    lambda c: c.diff(change=_b(rev1), git=True))
+        elif rev2 is None:
+            out = self._runClient(
+                    lambda c: c.diff(files=_b([path]), change=_b(rev1),
+                                     git=True))
+        else:
+            out = self._runClient(
+                    lambda c: c.diff(files=_b([path]),
+                                     revs=_b([rev1, rev2]), git=True))
+        return _s(out)
 
     def commit(self, paths, op_meta):
         if 'message' not in op_meta or not op_meta['message']:
@@ -337,13 +469,19 @@ class MercurialCommandServerSourceControl(MercurialBaseSourceControl):
                     b'commit', *_b(paths),
                     debug=True, m=_b(op_meta['message']), A=True,
                     **kwargs)
-            self.client.rawcommand(args)
+            # Don't retry commits, we don't know if the first one went
+            # through.
+            self._runClient(lambda c: c.rawcommand(args), retry=False)
         except CommandError as e:
             raise SourceControlError('commit', str(e), _s(e.args),
                                      _s(e.out))
 
     def revert(self, paths=None):
         if paths is not None:
-            self.client.revert(files=_b(paths), nobackup=True)
+            self._runClient(
+                    lambda c: c.revert(files=_b(paths), nobackup=True),
+                    retry=False)
         else:
-            self.client.revert(all=True, nobackup=True)
+            self._runClient(
+                    lambda c: c.revert(all=True, nobackup=True),
+                    retry=False)
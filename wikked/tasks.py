@@ -1,5 +1,6 @@
 import logging
 from wikked.wiki import Wiki, WikiParameters, BACKGROUND_CONTEXT
+from wikked.worker import FULL_UPDATE, update_wiki_pages
 
 
 logger = logging.getLogger(__name__)
@@ -35,7 +36,7 @@ class wiki_session(object):
 
 
 @celery_app.task
-def update_wiki(wiki_root):
+def update_wiki(wiki_root, urls=None):
     with wiki_session(wiki_root) as wiki:
-        wiki.updateAll()
+        update_wiki_pages(wiki, urls or [FULL_UPDATE])
 
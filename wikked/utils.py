@@ -1,6 +1,7 @@
 import re
 import os
 import os.path
+import html
 import urllib.error
 import urllib.parse
 import urllib.request
@@ -11,6 +12,9 @@ from xml.sax.saxutils import escape, unescape
 re_terminal_path = re.compile(r'[/\\]|(\w\:)')
 endpoint_regex = re.compile(r'(\w[\w\d]+)?\:(.*)')
 endpoint_prefix_regex = re.compile(r'^(\w[\w\d]+)\:')
+re_html_script = re.compile(r'<(script|style)[^>]*>.*?</\1>',
+                            re.IGNORECASE | re.DOTALL)
+re_html_tag = re.compile(r'<[^>]*>')
 
 
 class PageNotFoundError(Exception):
@@ -155,3 +159,10 @@ def html_escape(text):
 
 def html_unescape(text):
     return unescape(text, html_unescape_table)
+
+
+def strip_html_tags(text):
+    """ Returns the plain text content of the given HTML markup. """
+    text = re_html_script.sub(' ', text)
+    text = re_html_tag.sub(' ', text)
+    return html.unescape(text)
@@ -24,6 +24,10 @@ app.config.setdefault('WIKI_ROOT', None)
 app.config.setdefault('WIKI_UPDATE_ON_START', True)
 app.config.setdefault('WIKI_AUTO_RELOAD', False)
 app.config.setdefault('WIKI_ASYNC_UPDATE', False)
+app.config.setdefault('WIKI_BACKGROUND_EDITS', False)
+app.config.setdefault('WIKI_TASK_RUNNER', 'local')
+app.config.setdefault('WIKI_UPDATE_DELAY', 1)
+app.config.setdefault('WIKI_STALE_PAGE_MAX_AGE', 300)
 app.config.setdefault('WIKI_SERVE_FILES', False)
 app.config.setdefault('WIKI_BROKER_URL',
                       'sqla+sqlite:///%(root)s/.wiki/broker.db')
@@ -190,8 +194,20 @@ import wikked.views.special   # NOQA
 import wikked.views.user      # NOQA
 
 
+# Wikis created for background work, outside of any request.
+def create_worker_wiki():
+    wiki = Wiki(app.wiki_params)
+    for i in app.wikked_post_init:
+        i(wiki)
+    wiki.start()
+    return wiki
+
+
 # Async wiki update.
-if app.config['WIKI_ASYNC_UPDATE']:
+app.wiki_task_runner = None
+app.wiki_async_updater = None
+if (app.config['WIKI_ASYNC_UPDATE'] and
+        app.config['WIKI_TASK_RUNNER'] == 'celery'):
     app.logger.debug("Will use Celery tasks to update the wiki...")
     from wikked.tasks import celery_app, update_wiki
 
@@ -202,10 +218,50 @@ if app.config['WIKI_ASYNC_UPDATE']:
     app.logger.debug("Using Celery broker: %s" % app.config['WIKI_BROKER_URL'])
 
     # Make the wiki use the background update task.
-    def async_updater(wiki):
+    def run_async_update(urls):
         app.logger.debug("Running update task on Celery.")
-        update_wiki.delay(wiki.root)
-    app.wiki_params.wiki_updater = async_updater
+        update_wiki.delay(wiki_root, urls)
+
+elif app.config['WIKI_ASYNC_UPDATE']:
+    app.logger.debug("Will use the local task runner to update the wiki...")
+    from wikked.worker import TaskRunner, TaskStore
+
+    app.wiki_task_runner = TaskRunner(
+            create_worker_wiki,
+            TaskStore(os.path.join(wiki_root, '.wiki', 'tasks.db')))
+    app.wiki_task_runner.start()
+
+    def run_async_update(urls):
+        app.logger.debug("Queuing update task for: %s" % urls)
+        app.wiki_task_runner.queueUpdates(urls)
+
+if app.config['WIKI_ASYNC_UPDATE']:
+    # Merge the updates for edits made in quick succession.
+    from wikked.worker import CoalescingUpdater
+    app.wiki_async_updater = CoalescingUpdater(
+            run_async_update,
+            delay=float(app.config['WIKI_UPDATE_DELAY']))
+    app.wiki_params.wiki_updater = app.wiki_async_updater
+
+
+# Background edit processing and page resolving. Each gets its own worker
+# so that background resolves don't make pages look like they have edits
+# pending.
+app.wiki_edit_worker = None
+if app.config['WIKI_BACKGROUND_EDITS']:
+    from wikked.worker import WikiWorker
+    app.logger.debug("Will resolve and index edited pages in the "
+                     "background...")
+    app.wiki_edit_worker = WikiWorker(create_worker_wiki)
+    app.wiki_params.edit_worker = app.wiki_edit_worker
+
+app.wiki_resolve_worker = None
+if app.config['WIKI_STALE_PAGE_MAX_AGE'] > 0:
+    from wikked.worker import WikiWorker
+    app.logger.debug("Will show stale pages while they get resolved in "
+                     "the background...")
+    app.wiki_resolve_worker = WikiWorker(create_worker_wiki)
+    app.wiki_params.resolve_worker = app.wiki_resolve_worker
 
 
 # InfluxDB metrics.
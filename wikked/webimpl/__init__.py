@@ -4,6 +4,7 @@ import logging
 import datetime
 import urllib.parse
 from wikked.auth import PERM_READ, PERM_EDIT, PERM_NAMES
+from wikked.resolver import PageResolver
 from wikked.utils import (
         get_absolute_url, PageNotFoundError, split_page_url, is_endpoint_url)
 from wikked.web import app
@@ -48,6 +49,14 @@ def split_url_from_viewarg(url):
     return (None, '/' + path)
 
 
+def _can_serve_stale_page(page, max_age):
+    # Pages that were just edited have no previous version to show.
+    if max_age <= 0 or page.invalidate_time is None:
+        return False
+    age = datetime.datetime.now() - page.invalidate_time
+    return age.total_seconds() <= max_age
+
+
 def get_page_or_raise(wiki, url, fields=None, check_perms=None):
     auto_reload = app.config.get('WIKI_AUTO_RELOAD', False)
     if auto_reload is True and fields is not None:
@@ -57,9 +66,12 @@ def get_page_or_raise(wiki, url, fields=None, check_perms=None):
             fields.append('cache_time')
 
     async_update = app.config.get('WIKI_ASYNC_UPDATE', False)
+    stale_max_age = app.config.get('WIKI_STALE_PAGE_MAX_AGE', 0)
     if not async_update and fields is not None:
         if 'is_resolved' not in fields:
             fields.append('is_resolved')
+        if stale_max_age > 0 and 'invalidate_time' not in fields:
+            fields.append('invalidate_time')
 
     if check_perms is not None and fields is not None:
         if 'local_meta' not in fields:
@@ -75,13 +87,34 @@ def get_page_or_raise(wiki, url, fields=None, check_perms=None):
             wiki.updatePage(path=page.path)
             page = wiki.getPage(url, fields=fields)
 
-    if not async_update:
+    if (not async_update and not page.is_resolved and
+            _can_serve_stale_page(page, stale_max_age) and
+            wiki.revalidatePage(url)):
+        # The page was invalidated recently, so show what it looked like
+        # before while it gets resolved again in the background.
+        logger.debug("Page '%s' is stale, resolving in the background." %
+                     url)
+        page._data.is_stale = True
+
+    elif not async_update and not page.is_resolved:
+        logger.info("Page '%s' was not resolved, resolving now." % url)
+        wiki.resolvePage(url)
+        page = wiki.getPage(url, fields=fields)
+
         if not page.is_resolved:
-            logger.info("Page '%s' was not resolved, resolving now." % url)
-            wiki.resolve(only_urls=[url])
-            wiki.index.updatePage(wiki.db.getPage(
-                url, fields=['url', 'path', 'title', 'text']))
-            page = wiki.getPage(url, fields=fields)
+            # Someone else is resolving the page. Show it without its
+            # includes and queries in the meantime instead of waiting more.
+            logger.debug("Page '%s' is being resolved, showing it without "
+                         "includes or queries for now." % url)
+            if fields is not None:
+                for f in ['url', 'title', 'path', 'formatted_text',
+                          'local_meta']:
+                    if f not in fields:
+                        fields.append(f)
+                page = wiki.getPage(url, fields=fields)
+            output = PageResolver(page, local_only=True).run()
+            page._data.text = output.text
+            page._data.ext_meta = page._data.local_meta
 
     if check_perms is not None:
         user, modes = check_perms
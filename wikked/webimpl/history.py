@@ -1,9 +1,11 @@
 import os.path
 import datetime
+import pygments
 from pygments import highlight
 from pygments.formatters import get_formatter_by_name
 from pygments.lexers import get_lexer_by_name
 from wikked.scm.base import ACTION_NAMES, ACTION_ADD, ACTION_EDIT
+from wikked.scm.cache import is_immutable_rev
 from wikked.webimpl import get_page_meta, get_page_or_raise
 
 
@@ -23,12 +25,18 @@ def get_history_data(wiki, user, history, needs_files=False):
         if needs_files:
             rev_data['pages'] = []
             for f in rev.files:
-                path = os.path.join(wiki.root, f.path)
-                page_info = wiki.fs.getPageInfo(path)
+                url = f.url
+                if url is None:
+                    # The source control didn't map this file to a page
+                    # URL, so let's see if it's a page.
+                    page_info = wiki.fs.getPageInfo(
+                            os.path.join(wiki.root, f.path))
+                    if page_info is not None:
+                        url = page_info.url
                 action_name = ACTION_NAMES[f.action]
-                if page_info is not None:
+                if url is not None:
                     rev_data['pages'].append({
-                        'url': page_info.url,
+                        'url': url,
                         'is_add_or_edit': (f.action == ACTION_ADD or
                                            f.action == ACTION_EDIT),
                         'action': action_name})
@@ -59,9 +67,34 @@ def get_page_history(wiki, user, url):
     return result
 
 
+def _get_cached(wiki, key, revs, func):
+    # Only cache things for revisions that can't change.
+    if all([is_immutable_rev(r) for r in revs if r is not None]):
+        return wiki.rev_cache.getOrCreate(key, func)
+    return func()
+
+
+def _get_page_cache_path(wiki, page):
+    return os.path.relpath(page.path, wiki.root).replace(os.sep, '/')
+
+
+def _highlight_diff(wiki, key, revs, diff):
+    def _do_highlight():
+        lexer = get_lexer_by_name('diff')
+        formatter = get_formatter_by_name('html')
+        return highlight(diff, lexer, formatter)
+
+    # Include the Pygments version so we don't serve stale markup after
+    # an upgrade.
+    key = key + ('html', pygments.__version__)
+    return _get_cached(wiki, key, revs, _do_highlight)
+
+
 def read_page_rev(wiki, user, url, rev):
     page = get_page_or_raise(wiki, url, check_perms=(user, 'read,history'))
-    page_rev = page.getRevision(rev)
+    page_rev = _get_cached(
+            wiki, ('rev', rev, _get_page_cache_path(wiki, page)), [rev],
+            lambda: page.getRevision(rev))
     meta = dict(get_page_meta(page, True), rev=rev)
     result = {'meta': meta, 'text': page_rev}
     return result
@@ -69,11 +102,11 @@ def read_page_rev(wiki, user, url, rev):
 
 def diff_page_revs(wiki, user, url, rev1, rev2=None, raw=False):
     page = get_page_or_raise(wiki, url, check_perms=(user, 'read,history'))
-    diff = page.getDiff(rev1, rev2)
+    key = ('diff', rev1, rev2 or '', _get_page_cache_path(wiki, page))
+    revs = [rev1, rev2]
+    diff = _get_cached(wiki, key, revs, lambda: page.getDiff(rev1, rev2))
     if not raw:
-        lexer = get_lexer_by_name('diff')
-        formatter = get_formatter_by_name('html')
-        diff = highlight(diff, lexer, formatter)
+        diff = _highlight_diff(wiki, key, revs, diff)
     if rev2 is None:
         meta = dict(get_page_meta(page, True), change=rev1)
     else:
@@ -83,11 +116,11 @@ def diff_page_revs(wiki, user, url, rev1, rev2=None, raw=False):
 
 
 def diff_revs(wiki, user, rev, raw=False):
-    diff = wiki.scm.diff(path=None, rev1=rev, rev2=None)
+    key = ('diff', rev, '', '')
+    diff = _get_cached(wiki, key, [rev],
+                       lambda: wiki.scm.diff(path=None, rev1=rev, rev2=None))
     if not raw:
-        lexer = get_lexer_by_name('diff')
-        formatter = get_formatter_by_name('html')
-        diff = highlight(diff, lexer, formatter)
+        diff = _highlight_diff(wiki, key, [rev], diff)
     return {'diff': diff, 'disp_rev': rev}
 
 
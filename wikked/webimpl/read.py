@@ -24,6 +24,9 @@ def read_page(wiki, user, url, *, no_redirect=False):
 
         ext = os.path.splitext(page.path)[1].lstrip('.')
 
+        if page.is_stale:
+            additional_info['is_stale'] = True
+
         result = {'meta': get_page_meta(page), 'text': page.text,
                   'page_title': page.title, 'format': ext}
         result.update(additional_info)
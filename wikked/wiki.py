@@ -1,8 +1,10 @@
 import os
 import os.path
 import time
+import uuid
 import logging
 import importlib
+import threading
 import multiprocessing
 from configparser import SafeConfigParser, NoOptionError
 from wikked.db.base import DatabaseUpgradeRequired
@@ -10,6 +12,7 @@ from wikked.endpoint import create_endpoint_infos
 from wikked.fs import FileSystem
 from wikked.auth import UserManager
 from wikked.scheduler import ResolveScheduler
+from wikked.worker import update_wiki_pages, FULL_UPDATE
 
 
 logger = logging.getLogger(__name__)
@@ -32,10 +35,51 @@ INIT_CONTEXT = 1
 BACKGROUND_CONTEXT = 2
 
 
+# How long a page can be marked as being resolved, in case whoever does it
+# crashes, and how long other readers wait for it.
+RESOLVE_LEASE_TIME = 60
+RESOLVE_WAIT_TIME = 10
+
+
+class _ResolveLocks(object):
+    """ Per-page locks, so that only one thread of this process resolves
+        a given page at a time. """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}
+
+    def acquire(self, key, timeout):
+        with self._lock:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = [threading.Lock(), 0]
+                self._locks[key] = entry
+            entry[1] += 1
+        if entry[0].acquire(timeout=timeout):
+            return True
+        self._unref(key, entry)
+        return False
+
+    def release(self, key):
+        with self._lock:
+            entry = self._locks[key]
+        entry[0].release()
+        self._unref(key, entry)
+
+    def _unref(self, key, entry):
+        with self._lock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+
+resolve_locks = _ResolveLocks()
+
+
 def synchronous_wiki_updater(wiki, url):
-    logger.debug("Synchronous wiki update: update all pages because %s was "
-                 "edited." % url)
-    wiki.updateAll()
+    logger.debug("Synchronous wiki update: update the pages depending on "
+                 "%s because it was edited." % url)
+    update_wiki_pages(wiki, [url or FULL_UPDATE])
 
 
 class WikiParameters(object):
@@ -48,6 +92,8 @@ class WikiParameters(object):
         self.context = ctx
         self.custom_heads = {}
         self.wiki_updater = synchronous_wiki_updater
+        self.edit_worker = None
+        self.resolve_worker = None
         self._config = None
         self._index_factory = None
         self._scm_factory = None
@@ -77,6 +123,20 @@ class WikiParameters(object):
     def auth_factory(self):
         return UserManager(self.config)
 
+    def rev_cache_factory(self):
+        from wikked.scm.cache import RevisionCache
+        max_size = self.config.getint('wiki', 'revision_cache_size')
+        return RevisionCache(
+                os.path.join(self.root, '.wiki', 'revisions'),
+                max_size * 1024 * 1024)
+
+    def format_cache_factory(self):
+        from wikked.cache import DiskCache
+        max_size = self.config.getint('wiki', 'format_cache_size')
+        return DiskCache(
+                os.path.join(self.root, '.wiki', 'formatted'),
+                max_size * 1024 * 1024)
+
     @property
     def formatters(self):
         if self._formatters is None:
@@ -197,12 +257,17 @@ class WikiParameters(object):
             if index_type == 'whoosh':
                 def impl():
                     from wikked.indexer.whooshidx import WhooshWikiIndex
-                    return WhooshWikiIndex()
+                    return WhooshWikiIndex(self.config)
                 self._index_factory = impl
             elif index_type == 'elastic':
                 def impl():
                     from wikked.indexer.elastic import ElasticWikiIndex
-                    return ElasticWikiIndex()
+                    return ElasticWikiIndex(self.config)
+                self._index_factory = impl
+            elif index_type == 'sqlfts':
+                def impl():
+                    from wikked.indexer.sqlfts import SQLFtsWikiIndex
+                    return SQLFtsWikiIndex()
                 self._index_factory = impl
             else:
                 raise InitializationError("No such indexer: " + index_type)
@@ -230,11 +295,21 @@ class WikiParameters(object):
                 logger.debug("Forcing `hgexe` source-control for new repo.")
                 scm_type = 'hgexe'
 
+            if (self.context == BACKGROUND_CONTEXT and scm_type == 'hg' and
+                    self.config.get('mercurial', 'background_client') ==
+                    'hgexe'):
+                logger.debug("Using `hgexe` source-control for background "
+                             "tasks.")
+                scm_type = 'hgexe'
+
             if scm_type == 'hg':
+                pool_size = self.config.getint('mercurial', 'pool_size')
+
                 def impl():
                     from wikked.scm.mercurial import \
                             MercurialCommandServerSourceControl
-                    return MercurialCommandServerSourceControl(self.root)
+                    return MercurialCommandServerSourceControl(
+                            self.root, pool_size=pool_size)
                 self._scm_factory = impl
 
             elif scm_type == 'hgexe':
@@ -282,8 +357,12 @@ class Wiki(object):
         self.db = parameters.db_factory()
         self.scm = parameters.scm_factory()
         self.auth = parameters.auth_factory()
+        self.rev_cache = parameters.rev_cache_factory()
+        self.format_cache = parameters.format_cache_factory()
 
         self._wiki_updater = parameters.wiki_updater
+        self.edit_worker = parameters.edit_worker
+        self.resolve_worker = parameters.resolve_worker
         self.post_update_hooks = []
 
     @property
@@ -315,18 +394,24 @@ class Wiki(object):
         """
         self.db.close(exception)
 
-    def reset(self, parallel=False):
+    def reset(self, parallel=False, progress_callback=None):
         """ Clears all the cached data and rebuilds it from scratch.
         """
         logger.info("Resetting wiki data...")
         page_infos = self.fs.getPageInfos()
         self.db.reset(page_infos)
-        self.resolve(force=True, parallel=parallel)
-        self.index.reset(self.getPages())
+        self.resolve(force=True, parallel=parallel,
+                     progress_callback=progress_callback)
+        self.index.reset(self.getPages(fields=self.index.page_fields),
+                         page_count=len(list(self.db.getPageUrls())))
 
-    def resolve(self, only_urls=None, force=False, parallel=False):
+    def resolve(self, only_urls=None, force=False, parallel=False,
+                priority_urls=None, progress_callback=None):
         """ Compute the final info (text, meta, links) of all or a subset of
-            the pages, and caches it in the DB.
+            the pages, and caches it in the DB. Pages in `priority_urls`
+            are resolved first, and `progress_callback` gets called with
+            the number of resolved pages and the total number of pages
+            as they get resolved.
         """
         logger.debug("Resolving pages...")
         if only_urls:
@@ -335,9 +420,66 @@ class Wiki(object):
             page_urls = self.db.getPageUrls(uncached_only=(not force))
 
         num_workers = multiprocessing.cpu_count() if parallel else 1
-        s = ResolveScheduler(self, page_urls)
+        s = ResolveScheduler(self, page_urls,
+                             priority_urls=priority_urls,
+                             progress_callback=progress_callback)
         s.run(num_workers)
 
+    def resolvePage(self, url, wait_time=RESOLVE_WAIT_TIME):
+        """ Resolves and re-indexes a page that isn't resolved, unless
+            someone else is already doing it, in which case we wait for
+            them for at most `wait_time` seconds. Returns whether the page
+            is resolved.
+        """
+        key = (self.root, url)
+        deadline = time.time() + wait_time
+        if not resolve_locks.acquire(key, wait_time):
+            logger.debug("Timed out waiting for page to resolve: %s" % url)
+            return False
+        try:
+            # Another thread may have resolved the page while we waited.
+            if self._isPageResolved(url):
+                return True
+
+            # Another process may be resolving the page right now.
+            owner = uuid.uuid4().hex
+            while not self.db.acquireResolveLease(
+                    url, owner, RESOLVE_LEASE_TIME):
+                if time.time() >= deadline:
+                    logger.debug("Timed out waiting for page to resolve: "
+                                 "%s" % url)
+                    return False
+                time.sleep(0.1)
+                if self._isPageResolved(url):
+                    return True
+
+            try:
+                if not self._isPageResolved(url):
+                    self.resolve(only_urls=[url])
+                    self.index.updatePage(self.db.getPage(
+                        url, fields=self.index.page_fields))
+            finally:
+                self.db.releaseResolveLease(url, owner)
+            return True
+        finally:
+            resolve_locks.release(key)
+
+    def revalidatePage(self, url):
+        """ Queues a background `resolvePage` for the given page, if
+            there's a resolve worker. Returns whether the page will get
+            resolved.
+        """
+        worker = self.resolve_worker
+        if worker is None:
+            return False
+        if not worker.isPending(url):
+            logger.debug("Queuing background resolve for: %s" % url)
+            worker.enqueue(_revalidate_page, url, urls=[url])
+        return True
+
+    def _isPageResolved(self, url):
+        return self.db.getPage(url, fields=['is_resolved']).is_resolved
+
     def updatePage(self, url=None, path=None):
         """ Completely updates a single page, i.e. read it from the file-system
             and have it fully resolved and cached in the DB.
@@ -353,7 +495,7 @@ class Wiki(object):
         self.resolve(only_urls=[page_info.url])
         self.index.updatePage(self.db.getPage(
             page_info.url,
-            fields=['url', 'path', 'title', 'text']))
+            fields=self.index.page_fields))
 
     def updateAll(self, parallel=False, reset_on_db_upgrade_required=True):
         """ Completely updates all pages, i.e. read them from the file-system
@@ -367,7 +509,7 @@ class Wiki(object):
             self.db.updateAll(page_infos)
             self.resolve(parallel=parallel)
             self.index.updateAll(self.db.getPages(
-                fields=['url', 'path', 'title', 'text']))
+                fields=self.index.page_fields))
         except DatabaseUpgradeRequired:
             logger.info("Database upgrade required... running full reset.")
             self.reset(parallel=parallel)
@@ -419,16 +561,42 @@ class Wiki(object):
             'message': page_fields['message']}
         self.scm.commit([page_info.path], commit_meta)
 
-        # Update the DB and index with the new/modified page.
-        self.updatePage(path=page_info.path)
+        # Update the DB, index, and all the other pages.
+        self._updateEditedPages([page_info])
 
-        # Invalidate all page lists.
-        self.db.removeAllPageLists()
+    def setPages(self, pages, page_fields):
+        """ Updates or creates several pages at once, as a single
+            source-control commit. `pages` is a dictionary mapping page
+            URLs to their new text, and `page_fields` has the author and
+            message of the commit.
+        """
+        # Validate the parameters.
+        if 'author' not in page_fields:
+            raise ValueError("No author specified for editing pages.")
+        if 'message' not in page_fields:
+            raise ValueError("No commit message specified for editing pages.")
+        if not pages:
+            return
+
+        # Save all the new/modified texts.
+        page_infos = []
+        for url, text in pages.items():
+            page_infos.append(self.fs.setPage(url, text))
+
+        # Commit all the files to the source-control at once.
+        commit_meta = {
+            'author': page_fields['author'],
+            'message': page_fields['message']}
+        self.scm.commit([pi.path for pi in page_infos], commit_meta)
 
-        # Update all the other pages.
-        self._wiki_updater(self, url)
-        for hook in self.post_update_hooks:
-            hook(self, url)
+        # Update the DB, index, and all the other pages.
+        self._updateEditedPages(page_infos)
+
+    def bulkEdit(self, page_fields):
+        """ Returns a context manager that collects page edits, and
+            applies them with `setPages` when it exits without error.
+        """
+        return BulkEdit(self, page_fields)
 
     def revertPage(self, url, page_fields):
         """ Reverts the page with the given URL to an older revision.
@@ -457,13 +625,15 @@ class Wiki(object):
             'message': page_fields['message']}
         self.scm.commit([path], commit_meta)
 
-        # Update the DB and index with the modified page.
-        self.updatePage(url)
+        # Update the DB, index, and all the other pages.
+        self._updateEditedPages([self.fs.getPageInfo(path)])
 
-        # Update all the other pages.
-        self._wiki_updater(self, url)
-        for hook in self.post_update_hooks:
-            hook(self, url)
+    def isPagePending(self, url):
+        """ Returns whether the given page was edited, but the edit worker
+            hasn't indexed it and updated the pages that depend on it yet.
+        """
+        return (self.edit_worker is not None and
+                self.edit_worker.isPending(url))
 
     def pageExists(self, url):
         """ Returns whether a page exists at the given URL.
@@ -478,6 +648,23 @@ class Wiki(object):
     def getSpecialFilenames(self):
         return self.special_filenames
 
+    def _updateEditedPages(self, page_infos):
+        # The DB is always updated, and the edited pages resolved, right
+        # away, so the author sees the new pages as soon as we return.
+        # Indexing, and updating the other pages is done in the
+        # background if we have an edit worker.
+        self.db.updatePages(page_infos)
+
+        urls = [pi.url for pi in page_infos]
+        self.resolve(only_urls=urls)
+        hooks = list(self.post_update_hooks)
+        if self.edit_worker is None:
+            _finish_page_edits(self, urls, hooks)
+        else:
+            logger.debug("Queuing background update for: %s" % urls)
+            self.edit_worker.enqueue(
+                    _finish_page_edits, urls, hooks, urls=urls)
+
     def getEndpoints(self):
         return self.endpoints.values()
 
@@ -490,6 +677,55 @@ class Wiki(object):
                 yield ep
 
 
+def _revalidate_page(wiki, url):
+    wiki.resolvePage(url)
+
+
+def _finish_page_edits(wiki, urls, hooks):
+    # Index the edited pages.
+    for url in urls:
+        wiki.index.updatePage(wiki.db.getPage(
+            url, fields=wiki.index.page_fields))
+    # Don't wait for the commit delay, the author will probably look
+    # for the edited pages soon.
+    wiki.index.flush()
+
+    # Invalidate all page lists.
+    wiki.db.removeAllPageLists()
+
+    # Update the pages that depend on the edited ones. Asynchronous
+    # updaters merge these into one update.
+    for url in urls:
+        wiki._wiki_updater(wiki, url)
+    for hook in hooks:
+        for url in urls:
+            hook(wiki, url)
+
+
+class BulkEdit(object):
+    """ A batch of page edits, to be committed all at once.
+
+        with wiki.bulkEdit({'author': 'joe', 'message': 'Import'}) as e:
+            e.setPage('/foo', 'Some text')
+            e.setPage('/bar', 'Some other text')
+    """
+    def __init__(self, wiki, page_fields):
+        self.wiki = wiki
+        self.page_fields = page_fields
+        self.pages = {}
+
+    def setPage(self, url, text):
+        self.pages[url] = text
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.wiki.setPages(self.pages, self.page_fields)
+        return False
+
+
 def reloader_stat_loop(wiki, interval=1):
     mtimes = {}
     while 1:
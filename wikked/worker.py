@@ -0,0 +1,355 @@
+import os
+import os.path
+import time
+import queue
+import logging
+import sqlite3
+import contextlib
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class WikiWorker(object):
+    """ A background thread that runs jobs against the wiki, one at a
+        time and in the order they were queued. Each job gets a fresh
+        wiki instance, created with the given factory.
+
+        Jobs can be tagged with the page URLs they're about, so that
+        others can know whether some work is still pending on a page.
+    """
+    def __init__(self, wiki_factory):
+        self.wiki_factory = wiki_factory
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def enqueue(self, func, *args, urls=None):
+        """ Queues a call to `func(wiki, *args)`. """
+        urls = list(urls or [])
+        with self._lock:
+            for url in urls:
+                self._pending[url] = self._pending.get(url, 0) + 1
+            self._ensureThread()
+        self._queue.put((func, args, urls))
+
+    def isPending(self, url):
+        """ Returns whether some queued job is about the given page. """
+        with self._lock:
+            return url in self._pending
+
+    def join(self):
+        """ Waits until all queued jobs have been run. """
+        self._queue.join()
+
+    def stop(self):
+        """ Runs all queued jobs and stops the worker thread. """
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def _ensureThread(self):
+        if self._thread is None:
+            logger.debug("Starting wiki worker thread.")
+            self._thread = threading.Thread(
+                    target=self._run, name='WikiWorker')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                break
+
+            func, args, urls = job
+            try:
+                run_wiki_job(self.wiki_factory, func, *args)
+            finally:
+                with self._lock:
+                    for url in urls:
+                        count = self._pending[url] - 1
+                        if count > 0:
+                            self._pending[url] = count
+                        else:
+                            del self._pending[url]
+                self._queue.task_done()
+
+
+def run_wiki_job(wiki_factory, func, *args):
+    """ Runs `func(wiki, *args)` with a new wiki, and logs any error.
+        Returns whether the job succeeded. """
+    wiki = None
+    try:
+        wiki = wiki_factory()
+        func(wiki, *args)
+        return True
+    except Exception as ex:
+        logger.error("Error running wiki job: %s" % ex)
+        logger.exception(ex)
+        return False
+    finally:
+        if wiki is not None:
+            wiki.stop()
+
+
+FULL_UPDATE = '*'
+
+
+def update_wiki_pages(wiki, urls):
+    """ Updates the wiki after the given pages have been edited. Only the
+        pages that include the edited pages, or that run queries, are
+        re-resolved and re-indexed. If `FULL_UPDATE` is in the list, the
+        whole wiki is updated instead.
+    """
+    if FULL_UPDATE in urls:
+        logger.debug("Running full wiki update.")
+        wiki.updateAll()
+        return
+
+    logger.debug("Updating wiki after edits to: %s" % urls)
+    uncached_urls = wiki.db.uncacheDependentPages(urls)
+    if not uncached_urls:
+        return
+    # Resolve the edited pages first, if they need it, since their
+    # authors are likely to look at them right away.
+    wiki.resolve(only_urls=uncached_urls, priority_urls=urls)
+    for url in uncached_urls:
+        wiki.index.updatePage(wiki.db.getPage(
+            url, fields=wiki.index.page_fields))
+
+
+class TaskStore(object):
+    """ A persistent queue of wiki updates to run, stored in a small SQLite
+        database. There's at most one entry per page URL, so queuing an
+        update for a page that's already waiting for one doesn't add more
+        work.
+    """
+    schema_version = 1
+
+    def __init__(self, path):
+        self.path = path
+        self._checked_schema = False
+
+    def addJob(self, url):
+        self.addJobs([url])
+
+    def addJobs(self, urls):
+        now = time.time()
+        with self._connect() as conn:
+            # Replacing an entry gives it a new ID, so that it doesn't get
+            # removed by a runner that already picked up the old one.
+            conn.executemany(
+                'INSERT OR REPLACE INTO jobs (url, time) VALUES (?, ?)',
+                [(u, now) for u in urls])
+
+    def getJobs(self):
+        """ Returns the queued `(id, url)` pairs, oldest first. """
+        with self._connect() as conn:
+            return conn.execute(
+                'SELECT id, url FROM jobs ORDER BY id').fetchall()
+
+    def removeJobs(self, job_ids):
+        with self._connect() as conn:
+            conn.executemany(
+                'DELETE FROM jobs WHERE id = ?',
+                [(i,) for i in job_ids])
+
+    def getCount(self):
+        with self._connect() as conn:
+            return conn.execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
+
+    @contextlib.contextmanager
+    def _connect(self):
+        if not self._checked_schema:
+            self._ensureSchema()
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _ensureSchema(self):
+        dirname = os.path.dirname(self.path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            with conn:
+                version = conn.execute('PRAGMA user_version').fetchone()[0]
+                if version != self.schema_version:
+                    logger.debug("Creating task store: %s" % self.path)
+                    conn.execute('DROP TABLE IF EXISTS jobs')
+                    conn.execute(
+                        'CREATE TABLE jobs ('
+                        'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                        'url TEXT NOT NULL UNIQUE, '
+                        'time REAL)')
+                    conn.execute('PRAGMA user_version = %d' %
+                                 self.schema_version)
+        finally:
+            conn.close()
+        self._checked_schema = True
+
+
+class TaskRunner(object):
+    """ Runs the wiki updates queued in a `TaskStore` on a background
+        thread. All the updates queued while the runner is busy are merged
+        into one pass. Updates left over by a previous process are run
+        when the runner starts. Failed updates stay queued, and are tried
+        again after a delay that doubles with each failure.
+    """
+    RETRY_DELAY = 5
+    MAX_RETRY_DELAY = 300
+
+    def __init__(self, wiki_factory, store):
+        self.wiki_factory = wiki_factory
+        self.store = store
+        self.failure_count = 0
+        self._retry_time = 0
+        self._thread = None
+        self._wake = threading.Event()
+        self._stopping = False
+
+    def start(self):
+        if self._thread is not None:
+            return
+        logger.debug("Starting task runner thread.")
+        self._stopping = False
+        self._thread = threading.Thread(
+                target=self._run, name='TaskRunner')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stops the runner thread once it's done with the current
+            updates. Whatever is still queued stays in the store. """
+        if self._thread is None:
+            return
+        self._stopping = True
+        self._wake.set()
+        self._thread.join()
+        self._thread = None
+
+    def queueUpdate(self, url=None):
+        """ Queues an update of the wiki after the given page has been
+            edited, or a full update if no URL is given. """
+        self.queueUpdates([url])
+
+    def queueUpdates(self, urls):
+        """ Same as `queueUpdate`, but for several pages at once. """
+        self.store.addJobs([u or FULL_UPDATE for u in urls])
+        self._wake.set()
+
+    def getQueueDepth(self):
+        """ Returns the number of pages waiting for an update. """
+        return self.store.getCount()
+
+    def runPending(self):
+        """ Runs all the queued updates, and returns how many there
+            were. If the update fails, the updates stay queued, and zero
+            is returned. """
+        jobs = self.store.getJobs()
+        if not jobs:
+            return 0
+        urls = [j[1] for j in jobs]
+        if not run_wiki_job(self.wiki_factory, update_wiki_pages, urls):
+            self.failure_count += 1
+            delay = min(self.MAX_RETRY_DELAY,
+                        self.RETRY_DELAY * 2 ** (self.failure_count - 1))
+            self._retry_time = time.time() + delay
+            logger.warning("Wiki update failed, retrying in %ds." % delay)
+            return 0
+
+        self.failure_count = 0
+        self._retry_time = 0
+        self.store.removeJobs([j[0] for j in jobs])
+        return len(jobs)
+
+    def _run(self):
+        while not self._stopping:
+            self._wake.clear()
+            retry_wait = self._retry_time - time.time()
+            if retry_wait > 0:
+                self._wake.wait(retry_wait)
+                continue
+            try:
+                count = self.runPending()
+            except Exception as ex:
+                logger.error("Error reading task store: %s" % ex)
+                logger.exception(ex)
+                count = 0
+            if count == 0 and self.failure_count == 0:
+                self._wake.wait()
+
+
+DEFAULT_UPDATE_DELAY = 1
+
+
+class CoalescingUpdater(object):
+    """ A wiki updater that collects the URLs of the pages edited within
+        `delay` seconds of each other, and then calls `func(urls)` once
+        for all of them. A `None` URL means a full update is needed.
+    """
+    def __init__(self, func, delay=DEFAULT_UPDATE_DELAY):
+        self.func = func
+        self.delay = delay
+        self.requested_count = 0
+        self.executed_count = 0
+        self.coalesced_count = 0
+        self._lock = threading.Lock()
+        self._dirty_urls = set()
+        self._pending_count = 0
+        self._timer = None
+
+    def __call__(self, wiki, url):
+        with self._lock:
+            self.requested_count += 1
+            self._pending_count += 1
+            self._dirty_urls.add(url or FULL_UPDATE)
+            # Only the first edit of a burst arms the timer, so updates
+            # get delayed by at most `delay` seconds.
+            if self._timer is None:
+                self._timer = threading.Timer(self.delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def getStats(self):
+        with self._lock:
+            return {
+                'requested': self.requested_count,
+                'executed': self.executed_count,
+                'coalesced': self.coalesced_count,
+                'pending': len(self._dirty_urls)}
+
+    def flush(self):
+        """ Runs the update for all the dirty URLs right away. """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            urls = sorted(self._dirty_urls)
+            self._dirty_urls = set()
+            if not urls:
+                return
+            # All the requests but one were saved by merging them.
+            self.executed_count += 1
+            self.coalesced_count += self._pending_count - 1
+            self._pending_count = 0
+
+        if FULL_UPDATE in urls:
+            urls = [FULL_UPDATE]
+        logger.debug("Running coalesced wiki update for: %s" % urls)
+        try:
+            self.func(urls)
+        except Exception as ex:
+            logger.error("Error running wiki update: %s" % ex)
+            logger.exception(ex)